@@ -0,0 +1,69 @@
+"""
+    CPU time versus bytes saved of the response encodings at several contact page sizes.
+
+    Usage: python -m benchmarks.compression [--sizes 10 100 1000 5000] [--repeat 20]
+"""
+import argparse
+import hashlib
+import json
+import statistics
+import sys
+import time
+from datetime import date, timedelta
+from os.path import abspath, dirname
+
+sys.path.append(dirname(dirname(abspath(__file__))))
+
+from src.services.compression import BrotliEncoder, GzipEncoder, ZstdEncoder, brotli, zstandard  # noqa: E402
+
+
+def page(size: int) -> bytes:
+    """
+        A contacts page as the list endpoint returns it.
+        """
+    contacts = [{"id": i, "name": f"Name{i}", "surname": f"Surname{i % 97}", "email": f"user{i}@example.com",
+                 "phone": f"+38097{i:07d}", "description": "met at the conference" if i % 3 else None,
+                 "birth_date": (date(1980, 1, 1) + timedelta(days=i * 37 % 15000)).isoformat(),
+                 "created_at": "2026-10-19T08:00:00", "updated_at": "2026-10-19T08:00:00"} for i in range(size)]
+    return json.dumps(contacts).encode()
+
+
+def encoders():
+    yield from (GzipEncoder(level) for level in (1, 6, 9))
+    if brotli is not None:
+        yield from (BrotliEncoder(quality) for quality in (1, 4, 11))
+    if zstandard is not None:
+        yield from (ZstdEncoder(level) for level in (1, 3, 10))
+
+
+def timed(fn, body: bytes, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(body)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 5000], help="contacts per page")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args(argv)
+
+    print(f"{'contacts':>8} {'encoding':>10} {'bytes':>10} {'ratio':>6} {'ms':>8} {'MB/s':>8}")
+    for size in args.sizes:
+        body = page(size)
+        digest = timed(lambda b: hashlib.blake2b(b, digest_size=16).digest(), body, args.repeat)
+        print(f"{size:>8} {'identity':>10} {len(body):>10} {1:>6.2f} {0:>8.3f} {'':>8}")
+        print(f"{size:>8} {'cache hit':>10} {'':>10} {'':>6} {digest * 1000:>8.3f} {'':>8}")
+        for encoder in encoders():
+            seconds = timed(encoder.compress, body, args.repeat)
+            compressed = len(encoder.compress(body))
+            name = f"{encoder.name}-{getattr(encoder, 'level', getattr(encoder, 'quality', ''))}"
+            print(f"{size:>8} {name:>10} {compressed:>10} {len(body) / compressed:>6.2f} {seconds * 1000:>8.3f} "
+                  f"{len(body) / seconds / 1e6:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Per-user contact queries on a plain heap versus the hash-partitioned, clustered table.
+
+Needs PostgreSQL. Loads --rows contacts for --users users into two schemas, then runs
+the repository queries for random users with EXPLAIN (ANALYZE, BUFFERS).
+
+Usage: python -m benchmarks.partitioning [--url postgresql://...] [--rows 50000000] [--users 500000]
+"""
+import argparse
+import json
+import random
+import statistics
+import sys
+import time
+from os.path import abspath, dirname
+
+from sqlalchemy import create_engine, make_url, text
+
+sys.path.append(dirname(dirname(abspath(__file__))))
+
+from src.conf.config import config  # noqa: E402
+
+PARTITIONS = 16
+COLUMNS = """
+    id bigint NOT NULL, name varchar(50), surname varchar(50), email varchar(50), phone varchar(50),
+    description varchar(250), birth_date date NOT NULL, created_at timestamp, updated_at timestamp,
+    user_id integer NOT NULL, email_norm varchar(50), phone_norm varchar(20)
+"""
+INDEXES = ("(user_id, email_norm)", "(user_id, phone_norm)", "(user_id, created_at)")
+QUERIES = {
+    "get_contacts": "SELECT * FROM {schema}.contacts WHERE user_id = :user_id LIMIT 10 OFFSET 0",
+    "get_contact_stats": "SELECT * FROM {schema}.contacts WHERE user_id = :user_id "
+                         "ORDER BY created_at DESC, id DESC LIMIT 5",
+    "by_email": "SELECT * FROM {schema}.contacts WHERE user_id = :user_id AND email_norm = :email",
+    "by_phone": "SELECT * FROM {schema}.contacts WHERE user_id = :user_id AND phone_norm = :phone",
+    "by_name": "SELECT * FROM {schema}.contacts WHERE user_id = :user_id AND name = :name LIMIT 1",
+}
+# consecutive rows belong to different users, as when many users add contacts over time
+GENERATE = """
+    SELECT i, 'Name' || (i % 1000), 'Surname' || (i % 997), 'user' || i || '@example.com', '097' || i,
+           'note', DATE '1970-01-01' + (i % 15000), now(), now(), (i * 7919) % {users} + 1,
+           'user' || i || '@example.com', '+38097' || i
+    FROM generate_series({first}, {last}) AS i
+"""
+
+
+def load(conn, rows: int, users: int, batch: int = 1_000_000):
+    conn.execute(text("DROP SCHEMA IF EXISTS bench_heap CASCADE"))
+    conn.execute(text("DROP SCHEMA IF EXISTS bench_part CASCADE"))
+    conn.execute(text("CREATE SCHEMA bench_heap"))
+    conn.execute(text("CREATE SCHEMA bench_part"))
+    conn.execute(text(f"CREATE TABLE bench_heap.contacts ({COLUMNS}, PRIMARY KEY (id))"))
+    conn.execute(text(f"CREATE TABLE bench_part.contacts ({COLUMNS}, PRIMARY KEY (user_id, id)) "
+                      f"PARTITION BY HASH (user_id)"))
+    for remainder in range(PARTITIONS):
+        conn.execute(text(f"CREATE TABLE bench_part.contacts_p{remainder} PARTITION OF bench_part.contacts "
+                          f"FOR VALUES WITH (MODULUS {PARTITIONS}, REMAINDER {remainder}) WITH (fillfactor = 90)"))
+    for first in range(1, rows + 1, batch):
+        last = min(first + batch - 1, rows)
+        conn.execute(text("INSERT INTO bench_heap.contacts " + GENERATE.format(users=users, first=first, last=last)))
+        print(f"loaded {last} rows", end="\r", flush=True)
+    print()
+    conn.execute(text("INSERT INTO bench_part.contacts SELECT * FROM bench_heap.contacts"))
+    for schema in ("bench_heap", "bench_part"):
+        for columns in INDEXES:
+            conn.execute(text(f"CREATE INDEX ON {schema}.contacts {columns}"))
+    for remainder in range(PARTITIONS):
+        conn.execute(text(f"CLUSTER bench_part.contacts_p{remainder} USING contacts_p{remainder}_pkey"))
+    conn.execute(text("ANALYZE bench_heap.contacts"))
+    conn.execute(text("ANALYZE bench_part.contacts"))
+
+
+def measure(conn, schema: str, query: str, params: list[dict]) -> tuple[float, float]:
+    times, buffers = [], []
+    for values in params:
+        plan = conn.execute(text("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + query.format(schema=schema)),
+                            values).scalar()
+        plan = plan if isinstance(plan, list) else json.loads(plan)
+        times.append(plan[0]["Execution Time"])
+        buffers.append(plan[0]["Plan"]["Shared Hit Blocks"] + plan[0]["Plan"]["Shared Read Blocks"])
+    return statistics.median(times), statistics.median(buffers)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--url", default=config.DB_URL)
+    parser.add_argument("--rows", type=int, default=50_000_000)
+    parser.add_argument("--users", type=int, default=500_000)
+    parser.add_argument("--samples", type=int, default=200)
+    parser.add_argument("--skip-load", action="store_true", help="reuse the data of a previous run")
+    args = parser.parse_args(argv)
+
+    url = make_url(args.url)
+    if url.get_dialect().is_async:
+        url = url.set(drivername="postgresql+psycopg2")
+    engine = create_engine(url)
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        if not args.skip_load:
+            start = time.perf_counter()
+            load(conn, args.rows, args.users)
+            print(f"loaded in {time.perf_counter() - start:.0f} s")
+        sample = random.Random(42).sample(range(1, args.rows + 1), args.samples)
+        params = [{"user_id": (i * 7919) % args.users + 1, "email": f"user{i}@example.com", "phone": f"+38097{i}",
+                   "name": f"Name{i % 1000}"} for i in sample]
+        print(f"{'query':>18} {'heap ms':>9} {'heap buf':>9} {'part ms':>9} {'part buf':>9}")
+        for name, query in QUERIES.items():
+            heap_ms, heap_buffers = measure(conn, "bench_heap", query, params)
+            part_ms, part_buffers = measure(conn, "bench_part", query, params)
+            print(f"{name:>18} {heap_ms:>9.3f} {heap_buffers:>9.0f} {part_ms:>9.3f} {part_buffers:>9.0f}")
+
+
+if __name__ == "__main__":
+    main()
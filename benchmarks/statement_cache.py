@@ -0,0 +1,96 @@
+"""
+Per-call overhead of building and compiling the contact lookup in different ways.
+
+Runs against an in-memory SQLite database by default, so the numbers are mostly
+Python time: building the query, computing its cache key, compiling on a cache miss.
+Against PostgreSQL (--url) planning is added on top, which prepared statements save.
+
+Usage: python -m benchmarks.statement_cache [--url sqlite://] [--calls 20000]
+"""
+import argparse
+import sys
+import time
+from datetime import date
+from os.path import abspath, dirname
+
+from sqlalchemy import create_engine, lambda_stmt, select
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import StaticPool
+
+sys.path.append(dirname(dirname(abspath(__file__))))
+
+from src.database.models import Base, Contact, User  # noqa: E402
+from src.repository.contacts import CONTACT_BY_ID  # noqa: E402
+
+USER_ID = 1
+
+
+def query_chain(db, contact_id):
+    return db.query(Contact).filter(Contact.user_id == USER_ID).filter(Contact.id == contact_id).first()
+
+
+def select_per_call(db, contact_id):
+    return db.scalars(select(Contact).where(Contact.user_id == USER_ID, Contact.id == contact_id).limit(1)).first()
+
+
+def module_statement(db, contact_id):
+    return db.scalars(CONTACT_BY_ID, {"user_id": USER_ID, "contact_id": contact_id}).first()
+
+
+def lambda_statement(db, contact_id):
+    statement = lambda_stmt(lambda: select(Contact))
+    statement += lambda s: s.where(Contact.user_id == USER_ID, Contact.id == contact_id).limit(1)
+    return db.scalars(statement).first()
+
+
+VARIANTS = {
+    "query chain": query_chain,
+    "select per call": select_per_call,
+    "module statement": module_statement,
+    "lambda statement": lambda_statement,
+}
+
+
+def measure(engine, fn, calls: int, contacts: int) -> float:
+    with Session(engine) as db:
+        for contact_id in range(1, 101):
+            fn(db, contact_id)
+        start = time.perf_counter()
+        for call in range(calls):
+            fn(db, call % contacts + 1)
+            if call % 100 == 0:
+                db.expunge_all()
+        return (time.perf_counter() - start) / calls * 1_000_000
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--url", default="sqlite://")
+    parser.add_argument("--calls", type=int, default=20_000)
+    parser.add_argument("--contacts", type=int, default=1000)
+    args = parser.parse_args(argv)
+
+    options = dict(poolclass=StaticPool, connect_args={"check_same_thread": False}) \
+        if args.url.startswith("sqlite") else {}
+    engines = {"cached": create_engine(args.url, **options),
+               "no cache": create_engine(args.url, query_cache_size=0, **options)}
+    Base.metadata.create_all(engines["cached"])
+    with Session(engines["cached"]) as db:
+        if db.get(User, USER_ID) is None:
+            db.add(User(id=USER_ID, username="bench", email="bench@example.com", password="x"))
+            db.add_all([Contact(name=f"Name{number}", birth_date=date(1990, 1, 1), user_id=USER_ID)
+                        for number in range(args.contacts)])
+            db.commit()
+    if args.url.startswith("sqlite"):
+        # the in-memory database lives in the connection of the first engine
+        engines["no cache"].pool = engines["cached"].pool
+
+    print(f"{'variant':>18} {'cached us':>10} {'no cache us':>12}")
+    for name, fn in VARIANTS.items():
+        cached = measure(engines["cached"], fn, args.calls, args.contacts)
+        uncached = measure(engines["no cache"], fn, args.calls, args.contacts)
+        print(f"{name:>18} {cached:>10.1f} {uncached:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,15 +2,28 @@ import redis.asyncio as redis
 import uvicorn
 from fastapi import FastAPI, Depends, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi_limiter import FastAPILimiter
+from redis.exceptions import RedisError
 from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
 
 from src.conf.config import config
-from src.database.db import get_db
+from src.database.db import get_db, pool_status, warm_up_pool, replica_pool
 from src.routes import contacts, users
+from src.services import limiter, token_store, idempotency, events, email_filter, tracing
+from src.services.admission import AdmissionController, AdmissionMiddleware
+from src.services.compression import CompressedCache, CompressionMiddleware
+from src.services.idempotency import IdempotencyMiddleware
+from src.services.single_flight import flight
 
 app = FastAPI()
+app.add_middleware(IdempotencyMiddleware)
+admission = AdmissionController(config.ADMISSION_MAX_CONCURRENCY, min_limit=config.ADMISSION_MIN_CONCURRENCY,
+                                queue_size=config.ADMISSION_QUEUE_SIZE, queue_timeout=config.ADMISSION_QUEUE_TIMEOUT,
+                                target_latency=config.ADMISSION_TARGET_LATENCY)
+if config.ADMISSION_ENABLED:
+    app.add_middleware(AdmissionMiddleware, controller=admission)
 origins = [
     "http://localhost:3000"
 ]
@@ -21,6 +34,14 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+compressed_cache = CompressedCache(config.COMPRESSION_CACHE_SIZE)
+app.add_middleware(CompressionMiddleware, minimum_size=config.COMPRESSION_MINIMUM_SIZE, cache=compressed_cache)
+if config.TRACING_ENABLED:
+    if config.TRACING_FILE:
+        tracing.init(tracing.Tracer(tracing.FileExporter(config.TRACING_FILE)))
+    tracing.instrument_sqlalchemy()
+    # added last, so the time spent in the other middlewares is part of the request span
+    app.add_middleware(tracing.TracingMiddleware)
 
 db = Session(get_db())
 
@@ -42,15 +63,20 @@ def healthchecker(db: Session = Depends(get_db)):
                 Checks connection to db
                 :param db: The database session.
                 :type db: Session
-                :return: The message if connection is ok.
-                :rtype: {"message": "Welcome to FastAPI!"} | Error
+                :return: The message and pool stats if connection is ok.
+                :rtype: {"message": "Welcome to FastAPI!", "pool": dict} | Error
                 """
     try:
         # Make request
         result = db.execute(text("SELECT 1")).fetchone()
         if result is None:
             raise HTTPException(status_code=500, detail="Database is not configured correctly")
-        return {"message": "Welcome to FastAPI!"}
+        return {"message": "Welcome to FastAPI!", "pool": pool_status(),
+                "replicas": [dict(pool_status(replica), healthy=replica_pool.is_healthy(replica))
+                             for replica in replica_pool.engines],
+                "single_flight": flight.stats(), "admission": admission.stats(),
+                "events": events.broker.stats(), "compression": compressed_cache.stats(),
+                "email_filter": email_filter.registered.stats(), "tracing": tracing.tracer.stats()}
     except Exception as e:
         print(e)
         raise HTTPException(status_code=500, detail="Error connecting to the database")
@@ -58,9 +84,37 @@ def healthchecker(db: Session = Depends(get_db)):
 
 @app.on_event("startup")
 async def startup():
-    r = await redis.Redis(host=config.REDIS_DOMAIN, port=config.REDIS_PORT, db=0, encoding="utf-8",
-                          decode_responses=True)
-    await FastAPILimiter.init(r)
+    client = tracing.TracedRedis if config.TRACING_ENABLED else redis.Redis
+    r = client(host=config.REDIS_DOMAIN, port=config.REDIS_PORT, password=config.REDIS_PASSWORD, db=0,
+               encoding="utf-8", decode_responses=True)
+    try:
+        await r.ping()
+        if config.RATE_LIMIT_BACKEND == "redis":
+            limiter.init(limiter.RedisBackend(r))
+        token_store.init(token_store.RedisTokenStore(r))
+        idempotency.init(idempotency.RedisIdempotencyStore(r))
+        events.init(events.RedisBroker(r))
+        if config.EMAIL_FILTER_ENABLED:
+            email_filter.init(email_filter.RedisEmailFilter(r, fallback=email_filter.registered))
+    except RedisError as err:
+        print(err)
+    try:
+        await run_in_threadpool(warm_up_pool)
+    except SQLAlchemyError as err:
+        print(err)
+    if config.EMAIL_FILTER_ENABLED:
+        try:
+            await email_filter.registered.warm_up()
+        except (SQLAlchemyError, RedisError) as err:
+            print(err)
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    if isinstance(events.broker, events.RedisBroker):
+        await events.broker.aclose()
+    # flushes and closes the trace file
+    tracing.tracer.close()
 
 
 app.include_router(contacts.router, prefix='/api')
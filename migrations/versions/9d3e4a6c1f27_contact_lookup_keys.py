@@ -0,0 +1,57 @@
+"""Contact lookup keys
+
+Revision ID: 9d3e4a6c1f27
+Revises: 5b1c7e2f9a41
+Create Date: 2026-10-19 13:40:02.553147
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from src.database.normalize import normalize_email, normalize_phone
+
+# revision identifiers, used by Alembic.
+revision: str = '9d3e4a6c1f27'
+down_revision: Union[str, None] = '5b1c7e2f9a41'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+BATCH_SIZE = 1000
+
+contacts = sa.table('contacts', sa.column('id', sa.Integer), sa.column('email', sa.String),
+                    sa.column('phone', sa.String), sa.column('email_norm', sa.String),
+                    sa.column('phone_norm', sa.String))
+
+
+def backfill() -> None:
+    # keyset pagination by id keeps every batch an index range scan
+    connection = op.get_bind()
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            sa.select(contacts.c.id, contacts.c.email, contacts.c.phone)
+            .where(contacts.c.id > last_id).order_by(contacts.c.id).limit(BATCH_SIZE)).all()
+        if not rows:
+            break
+        connection.execute(
+            contacts.update().where(contacts.c.id == sa.bindparam('row_id'))
+            .values(email_norm=sa.bindparam('email_key'), phone_norm=sa.bindparam('phone_key')),
+            [{"row_id": row.id, "email_key": normalize_email(row.email), "phone_key": normalize_phone(row.phone)}
+             for row in rows])
+        last_id = rows[-1].id
+
+
+def upgrade() -> None:
+    op.add_column('contacts', sa.Column('email_norm', sa.String(length=50), nullable=True))
+    op.add_column('contacts', sa.Column('phone_norm', sa.String(length=20), nullable=True))
+    backfill()
+    op.create_index('ix_contacts_user_id_email_norm', 'contacts', ['user_id', 'email_norm'], unique=False)
+    op.create_index('ix_contacts_user_id_phone_norm', 'contacts', ['user_id', 'phone_norm'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_contacts_user_id_phone_norm', table_name='contacts')
+    op.drop_index('ix_contacts_user_id_email_norm', table_name='contacts')
+    op.drop_column('contacts', 'phone_norm')
+    op.drop_column('contacts', 'email_norm')
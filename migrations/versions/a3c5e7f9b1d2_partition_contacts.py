@@ -0,0 +1,120 @@
+"""Hash partition contacts by user_id
+
+Revision ID: a3c5e7f9b1d2
+Revises: f2a9d4b6c8e1
+Create Date: 2026-10-19 20:11:48.602317
+
+PostgreSQL only, other databases keep the plain table. The partitioned table is
+filled while the service runs: a trigger mirrors every write to contacts into
+it, existing rows are copied in batches, and only the final rename takes a
+lock. The old table stays as contacts_old until it is dropped by hand. Contacts
+without a user are not copied. The primary key becomes (user_id, id), ids stay
+unique through contacts_id_seq.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision: str = 'a3c5e7f9b1d2'
+down_revision: Union[str, None] = 'f2a9d4b6c8e1'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+PARTITIONS = 16
+BATCH_SIZE = 50000
+COLUMNS = ("name", "surname", "email", "phone", "description", "birth_date", "created_at", "updated_at",
+           "email_norm", "phone_norm")
+INDEXES = {
+    "ix_contacts_user_id_email_norm": "(user_id, email_norm)",
+    "ix_contacts_user_id_phone_norm": "(user_id, phone_norm)",
+    "ix_contacts_user_id_created_at": "(user_id, created_at)",
+}
+
+MIRROR_FUNCTION = f"""
+CREATE FUNCTION contacts_mirror() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' OR (TG_OP = 'UPDATE' AND OLD.user_id IS DISTINCT FROM NEW.user_id) THEN
+        DELETE FROM contacts_partitioned WHERE user_id = OLD.user_id AND id = OLD.id;
+    END IF;
+    IF TG_OP <> 'DELETE' AND NEW.user_id IS NOT NULL THEN
+        INSERT INTO contacts_partitioned SELECT NEW.*
+        ON CONFLICT (user_id, id) DO UPDATE SET {", ".join(f"{name} = EXCLUDED.{name}" for name in COLUMNS)};
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql
+"""
+
+
+def is_postgresql() -> bool:
+    return op.get_bind().dialect.name == "postgresql"
+
+
+def copy_rows() -> None:
+    # FOR SHARE keeps a copied row from being changed until the batch commits, after that the trigger
+    # carries its changes over; rows the trigger already wrote are newer and win the conflict
+    connection = op.get_bind()
+    max_id = connection.execute(sa.text("SELECT COALESCE(MAX(id), 0) FROM contacts")).scalar()
+    last_id = 0
+    while last_id < max_id:
+        with op.get_context().autocommit_block():
+            connection.execute(sa.text(
+                "INSERT INTO contacts_partitioned "
+                "SELECT * FROM contacts WHERE id > :first AND id <= :last AND user_id IS NOT NULL "
+                "ORDER BY user_id, id FOR SHARE "
+                "ON CONFLICT (user_id, id) DO NOTHING"), {"first": last_id, "last": last_id + BATCH_SIZE})
+        last_id += BATCH_SIZE
+
+
+def upgrade() -> None:
+    if not is_postgresql():
+        return
+    op.execute("CREATE TABLE contacts_partitioned (LIKE contacts INCLUDING DEFAULTS) PARTITION BY HASH (user_id)")
+    op.execute("ALTER TABLE contacts_partitioned ALTER COLUMN user_id SET NOT NULL")
+    op.execute("ALTER TABLE contacts_partitioned ADD CONSTRAINT contacts_partitioned_pkey PRIMARY KEY (user_id, id)")
+    op.execute("ALTER TABLE contacts_partitioned ADD CONSTRAINT contacts_partitioned_user_id_fkey "
+               "FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE")
+    for remainder in range(PARTITIONS):
+        # free space in every page lets updates stay on the page, which keeps the clustering
+        op.execute(f"CREATE TABLE contacts_p{remainder} PARTITION OF contacts_partitioned "
+                   f"FOR VALUES WITH (MODULUS {PARTITIONS}, REMAINDER {remainder}) WITH (fillfactor = 90)")
+    # indexes on the parent are created on every partition; building them before the copy is slower
+    # but doesn't block the writes the trigger mirrors
+    for name, columns in INDEXES.items():
+        op.execute(f"CREATE INDEX {name}_new ON contacts_partitioned {columns}")
+    op.execute(MIRROR_FUNCTION)
+    op.execute("CREATE TRIGGER contacts_mirror AFTER INSERT OR UPDATE OR DELETE ON contacts "
+               "FOR EACH ROW EXECUTE FUNCTION contacts_mirror()")
+    copy_rows()
+
+    op.execute("LOCK TABLE contacts IN ACCESS EXCLUSIVE MODE")
+    op.execute("DROP TRIGGER contacts_mirror ON contacts")
+    op.execute("DROP FUNCTION contacts_mirror()")
+    op.execute("ALTER TABLE contacts RENAME TO contacts_old")
+    op.execute("ALTER TABLE contacts_old RENAME CONSTRAINT contacts_pkey TO contacts_old_pkey")
+    for name in INDEXES:
+        op.execute(f"ALTER INDEX {name} RENAME TO {name}_old")
+        op.execute(f"ALTER INDEX {name}_new RENAME TO {name}")
+    op.execute("ALTER TABLE contacts_partitioned RENAME TO contacts")
+    op.execute("ALTER TABLE contacts RENAME CONSTRAINT contacts_partitioned_pkey TO contacts_pkey")
+    op.execute("ALTER TABLE contacts RENAME CONSTRAINT contacts_partitioned_user_id_fkey TO contacts_user_id_fkey")
+    op.execute("ALTER SEQUENCE contacts_id_seq OWNED BY contacts.id")
+
+
+def downgrade() -> None:
+    if not is_postgresql():
+        return
+    op.execute("DROP TABLE IF EXISTS contacts_old")
+    op.execute("CREATE TABLE contacts_plain (LIKE contacts INCLUDING DEFAULTS)")
+    op.execute("ALTER TABLE contacts_plain ALTER COLUMN user_id DROP NOT NULL")
+    op.execute("INSERT INTO contacts_plain SELECT * FROM contacts ORDER BY user_id, id")
+    op.execute("ALTER SEQUENCE contacts_id_seq OWNED BY contacts_plain.id")
+    op.execute("DROP TABLE contacts")
+    op.execute("ALTER TABLE contacts_plain RENAME TO contacts")
+    op.execute("ALTER TABLE contacts ADD CONSTRAINT contacts_pkey PRIMARY KEY (id)")
+    op.execute("ALTER TABLE contacts ADD CONSTRAINT contacts_user_id_fkey "
+               "FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE")
+    for name, columns in INDEXES.items():
+        op.execute(f"CREATE INDEX {name} ON contacts {columns}")
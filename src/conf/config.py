@@ -1,3 +1,4 @@
+import ipaddress
 from typing import Any
 
 from pydantic import ConfigDict, field_validator, EmailStr
@@ -19,6 +20,65 @@ class Settings(BaseSettings):
     CLD_NAME: str = 'abc'
     CLD_API_KEY: int = 326488457974591
     CLD_API_SECRET: str = "secret"
+    DB_POOL_SIZE: int = 20
+    DB_MAX_OVERFLOW: int = 10
+    DB_POOL_TIMEOUT: float = 10
+    DB_POOL_RECYCLE: int = 1800
+    DB_POOL_PRE_PING: bool = True
+    DB_POOL_WARMUP: int = 5
+    DB_CONNECTION_BUDGET: int = 90
+    DB_STATEMENT_TIMEOUT: float = 5
+    DB_COMPILED_CACHE_SIZE: int = 1000
+    DB_PREPARED_STATEMENT_CACHE_SIZE: int = 500
+    DB_PGBOUNCER: bool = False
+    DB_REPLICA_URLS: list[str] = []
+    DB_REPLICA_COOLDOWN: float = 30
+    DB_SHARD_URLS: dict[str, str] = {}
+    DB_SHARD_CACHE_TTL: float = 5
+    DB_SHARD_CACHE_SIZE: int = 100_000
+    TOKEN_CACHE_SIZE: int = 10000
+    PASSWORD_SCHEME: str = "argon2"
+    ARGON2_MEMORY_COST: int = 65536
+    ARGON2_TIME_COST: int = 3
+    ARGON2_PARALLELISM: int = 4
+    BCRYPT_ROUNDS: int = 12
+    EMAIL_FILTER_ENABLED: bool = True
+    EMAIL_FILTER_CAPACITY: int = 1_000_000
+    EMAIL_FILTER_ERROR_RATE: float = 0.01
+    EMAIL_FILTER_SYNC_INTERVAL: float = 5
+    EMAIL_FILTER_SYNC_WINDOW: int = 100
+    TRACING_ENABLED: bool = True
+    TRACING_SAMPLE_RATE: float = 0.01
+    TRACING_FILE: str | None = None
+    TRACING_BUFFER_SIZE: int = 2000
+    # addresses or networks of the proxies and services whose sampled flag is followed, "*" for any caller
+    TRACING_TRUSTED_UPSTREAMS: list[str] = []
+    ACCESS_TOKEN_TTL: int = 120 * 60
+    REFRESH_TOKEN_TTL: int = 7 * 24 * 3600
+    ADMISSION_ENABLED: bool = True
+    ADMISSION_MAX_CONCURRENCY: int = 30
+    ADMISSION_MIN_CONCURRENCY: int = 4
+    ADMISSION_QUEUE_SIZE: int = 100
+    ADMISSION_QUEUE_TIMEOUT: float = 2.0
+    ADMISSION_TARGET_LATENCY: float = 0.5
+    PHONE_DEFAULT_COUNTRY_CODE: str = "380"
+    BIRTHDAY_WINDOW_DAYS: int = 7
+    BIRTHDAY_BATCH_SIZE: int = 100
+    BIRTHDAY_RUN_HOUR: int = 8
+    BIRTHDAY_CHECKPOINT_FILE: str = "birthday_checkpoint.json"
+    BIRTHDAY_RETRY_DELAY: float = 60
+    BIRTHDAY_MAX_RETRY_DELAY: float = 3600
+    # "local" limits per process. "redis" shares limits between workers, but only once Redis at REDIS_DOMAIN
+    # answers the startup ping; without a reachable Redis the local backend stays in use
+    RATE_LIMIT_BACKEND: str = "local"
+    RATE_LIMIT_PREFIX: str = "rl"
+    IDEMPOTENCY_TTL: int = 24 * 3600
+    # a claimed key whose request never finished, e.g. its worker was killed, is free again after this
+    IDEMPOTENCY_LEASE: int = 60
+    COMPRESSION_MINIMUM_SIZE: int = 500
+    COMPRESSION_CACHE_SIZE: int = 256
+    WORKER_MAX_REQUESTS: int = 10000
+    WORKER_MAX_REQUESTS_JITTER: int = 1000
 
     @field_validator("ALGORITHM")
     @classmethod
@@ -27,6 +87,51 @@ class Settings(BaseSettings):
             raise ValueError("algorithm must be HS256 or HS512")
         return v
 
+    @field_validator("RATE_LIMIT_BACKEND")
+    @classmethod
+    def validate_rate_limit_backend(cls, v: Any):
+        if v not in ["local", "redis"]:
+            raise ValueError("rate limit backend must be local or redis")
+        return v
+
+    @field_validator("PASSWORD_SCHEME")
+    @classmethod
+    def validate_password_scheme(cls, v: Any):
+        if v not in ["argon2", "bcrypt"]:
+            raise ValueError("password scheme must be argon2 or bcrypt")
+        return v
+
+    @field_validator("EMAIL_FILTER_ERROR_RATE")
+    @classmethod
+    def validate_email_filter_error_rate(cls, v: Any):
+        if not 0 < v < 1:
+            raise ValueError("EMAIL_FILTER_ERROR_RATE must be between 0 and 1")
+        return v
+
+    @field_validator("TRACING_SAMPLE_RATE")
+    @classmethod
+    def validate_tracing_sample_rate(cls, v: Any):
+        if not 0 <= v <= 1:
+            raise ValueError("TRACING_SAMPLE_RATE must be between 0 and 1")
+        return v
+
+    @field_validator("TRACING_TRUSTED_UPSTREAMS")
+    @classmethod
+    def validate_tracing_trusted_upstreams(cls, v: Any):
+        for upstream in v:
+            if upstream != "*":
+                # raises ValueError for anything that is not an address or a network
+                ipaddress.ip_network(upstream, strict=False)
+        return v
+
+    @field_validator("DB_POOL_WARMUP")
+    @classmethod
+    def validate_pool_warmup(cls, v: Any, info):
+        pool_size = info.data.get("DB_POOL_SIZE")
+        if pool_size is not None and v > pool_size:
+            raise ValueError("DB_POOL_WARMUP must not exceed DB_POOL_SIZE")
+        return v
+
     model_config = ConfigDict(extra='ignore', env_file=".env", env_file_encoding="utf-8")  # noqa
 
 
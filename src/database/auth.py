@@ -1,23 +1,127 @@
+import hashlib
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from typing import Optional
 
 from fastapi import Depends, HTTPException
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
-from passlib.context import CryptContext
 from sqlalchemy.orm import Session
 from src.conf.config import config
 from src.database.db import get_db
 from src.repository import users as repository_users
+from src.services import passwords, tracing
 from starlette import status
 
 
+class TokenCache:
+    """
+        Bounded LRU of verified tokens, keyed by a digest of the token.
+
+        Entries expire at the token's ``exp``. Revoked tokens and subjects are
+        remembered so a revoked token is not verified and cached again. Revocations
+        live in the memory of this process only; other workers keep accepting the
+        tokens until they expire. A subject is remembered for ``subject_ttl`` seconds,
+        the lifetime of access tokens; refresh tokens are revoked in the token store.
+        """
+
+    def __init__(self, maxsize: int = 10000, subject_ttl: float = config.ACCESS_TOKEN_TTL):
+        self.maxsize = maxsize
+        self.subject_ttl = subject_ttl
+        self._entries = OrderedDict()
+        self._revoked = {}
+        self._revoked_subjects = {}
+
+    @staticmethod
+    def digest(token: str) -> bytes:
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token: str) -> dict | None:
+        """
+            Get payload of a verified token
+
+            :param token: token.
+            :type token: str
+            :return: The decoded payload, or None if the token is not cached or expired.
+            :rtype: dict | None
+            """
+        key = self.digest(token)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        payload, exp = entry
+        if exp <= time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return payload
+
+    def put(self, token: str, payload: dict):
+        exp = payload.get("exp")
+        if exp is None or self.is_revoked(token, payload):
+            return
+        key = self.digest(token)
+        self._entries[key] = (payload, exp)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def is_revoked(self, token: str, payload: dict) -> bool:
+        if self.digest(token) in self._revoked:
+            return True
+        revoked_at = self._revoked_subjects.get(payload.get("sub"))
+        # iat has sub-second precision, a token issued right after the revocation is valid
+        return revoked_at is not None and payload.get("iat", 0) < revoked_at
+
+    def revoke(self, token: str, exp: float | None = None):
+        """
+            Revokes a single token
+
+            :param token: token.
+            :type token: str
+            :param exp: The expiry of the token, the revocation is kept until then.
+            :type exp: float
+            :return: Nothing.
+            :rtype: None
+            """
+        key = self.digest(token)
+        entry = self._entries.pop(key, None)
+        if exp is None:
+            exp = entry[1] if entry else time.time() + 7 * 24 * 3600
+        self._revoked[key] = exp
+        self._purge_revoked()
+
+    def revoke_subject(self, subject: str):
+        """
+            Revokes every token of the subject issued until now
+
+            :param subject: The subject (email) of tokens.
+            :type subject: str
+            :return: Nothing.
+            :rtype: None
+            """
+        now = time.time()
+        self._revoked_subjects = {other: revoked_at for other, revoked_at in self._revoked_subjects.items()
+                                  if revoked_at > now - self.subject_ttl}
+        self._revoked_subjects[subject] = now
+        for key in [key for key, (payload, _) in self._entries.items() if payload.get("sub") == subject]:
+            del self._entries[key]
+
+    def _purge_revoked(self):
+        now = time.time()
+        if len(self._revoked) > self.maxsize:
+            self._revoked = {key: exp for key, exp in self._revoked.items() if exp > now}
+
+
 class Auth:
-    pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+    pwd_context = passwords.build_context()
     SECRET_KEY = config.SECRET_KEY_JWT
     ALGORITHM = config.ALGORITHM
     oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/users/login")
+    token_cache = TokenCache(config.TOKEN_CACHE_SIZE, config.ACCESS_TOKEN_TTL)
 
+    @tracing.traced
     def verify_password(self, plain_password, hashed_password):
         """
               verify_password
@@ -31,6 +135,21 @@ class Auth:
               """
         return self.pwd_context.verify(plain_password, hashed_password)
 
+    @tracing.traced
+    def verify_and_update_password(self, plain_password, hashed_password):
+        """
+              Verify a password and rehash it when its hash is of an old scheme or old costs
+
+              :param plain_password: the password was typed by user.
+              :type plain_password: str
+              :param hashed_password: The real password.
+              :type hashed_password: str
+              :return: Whether the password matches, and the new hash to store or None.
+              :rtype: tuple[bool, str | None]
+              """
+        return self.pwd_context.verify_and_update(plain_password, hashed_password)
+
+    @tracing.traced
     def get_password_hash(self, password: str):
         """
               Get password hash
@@ -57,8 +176,9 @@ class Auth:
         if expires_delta:
             expire = datetime.utcnow() + timedelta(seconds=expires_delta)
         else:
-            expire = datetime.utcnow() + timedelta(minutes=120)
-        to_encode.update({"iat": datetime.utcnow(), "exp": expire, "scope": "access_token"})
+            expire = datetime.utcnow() + timedelta(seconds=config.ACCESS_TOKEN_TTL)
+        # a float, whole seconds would revoke tokens issued in the second of a revocation
+        to_encode.update({"iat": time.time(), "exp": expire, "scope": "access_token"})
         encoded_access_token = jwt.encode(to_encode, self.SECRET_KEY, algorithm=self.ALGORITHM)
         return encoded_access_token
 
@@ -79,28 +199,70 @@ class Auth:
             expire = datetime.utcnow() + timedelta(seconds=expires_delta)
         else:
             expire = datetime.utcnow() + timedelta(days=7)
-        to_encode.update({"iat": datetime.utcnow(), "exp": expire, "scope": "refresh_token"})
+        to_encode.update({"iat": time.time(), "exp": expire, "scope": "refresh_token"})
         encoded_refresh_token = jwt.encode(to_encode, self.SECRET_KEY, algorithm=self.ALGORITHM)
         return encoded_refresh_token
 
+    @tracing.traced
+    def verify_token(self, token: str) -> dict:
+        """
+              Verify token, repeated tokens are served from the cache
+
+              :param token: token.
+              :type token: str
+              :return: The decoded payload.
+              :rtype: dict
+              :raises JWTError: If the token is invalid, expired or revoked.
+              """
+        payload = self.token_cache.get(token)
+        if payload is not None:
+            return payload
+        payload = jwt.decode(token, self.SECRET_KEY, algorithms=[self.ALGORITHM])
+        if self.token_cache.is_revoked(token, payload):
+            raise JWTError("Token has been revoked")
+        self.token_cache.put(token, payload)
+        return payload
+
+    def revoke_token(self, token: str):
+        """
+              Revoke token
+
+              :param token: token.
+              :type token: str
+              :return: Nothing.
+              :rtype: None
+              """
+        self.token_cache.revoke(token)
+
+    def revoke_user_tokens(self, email: str):
+        """
+              Revoke all tokens of a user issued until now, in this process only
+
+              :param email: the email of user.
+              :type email: str
+              :return: Nothing.
+              :rtype: None
+              """
+        self.token_cache.revoke_subject(email)
+
     async def decode_refresh_token(self, refresh_token: str):
         """
                       Decoding refresh token
 
                       :param refresh_token: refresh toke for user.
                       :type refresh_token: str
-                      :return: decode refresh token.
-                      :rtype: str
+                      :return: decoded refresh token.
+                      :rtype: dict
                       """
         try:
-            payload = jwt.decode(refresh_token, self.SECRET_KEY, algorithms=[self.ALGORITHM])
+            payload = self.verify_token(refresh_token)
             if payload['scope'] == 'refresh_token':
-                email = payload['sub']
-                return email
+                return payload
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Invalid scope for token')
         except JWTError:
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Could not validate credentials')
 
+    @tracing.traced
     async def get_current_user(self, token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
         """
                               Get current user
@@ -120,7 +282,7 @@ class Auth:
 
         try:
             # Decode JWT
-            payload = jwt.decode(token, self.SECRET_KEY, algorithms=[self.ALGORITHM])
+            payload = self.verify_token(token)
             if payload['scope'] == 'access_token':
                 email = payload["sub"]
                 if email is None:
@@ -130,9 +292,13 @@ class Auth:
         except JWTError as e:
             raise credentials_exception
 
-        user = await repository_users.find_user_by_email(email, db)
-        if user is None:
+        row = await repository_users.get_authenticated_user(email, db)
+        if row is None:
             raise credentials_exception
+        # the snapshot may be shared with other requests, the request gets an instance of its own session
+        user = repository_users.attach_user(row, db)
+        # contacts of the request go to the shard of this user
+        db.info["user_id"] = user.id
         return user
 
     def create_email_token(self, data: dict):
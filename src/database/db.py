@@ -1,24 +1,370 @@
-from fastapi import HTTPException
+import asyncio
+import threading
+import time
+import uuid
 
-from sqlalchemy import create_engine
-from sqlalchemy.exc import SQLAlchemyError
+from fastapi import HTTPException, Depends, Request
+
+from sqlalchemy import create_engine, make_url, event, inspect
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import SQLAlchemyError, OperationalError, TimeoutError as PoolTimeoutError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.pool import Pool, QueuePool, AsyncAdaptedQueuePool
 from src.conf.config import config
+from src.database.replicas import ReplicaPool, RoutingSession
+from src.database.shards import ShardMoving, ShardRouter
 from starlette import status
 
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class PoolStats:
+    """
+        Counters of waiting for a connection from the pool.
+        """
+
+    def __init__(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def record_wait(self, seconds: float):
+        self.checkouts += 1
+        self.wait_total += seconds
+        self.wait_max = max(self.wait_max, seconds)
+
+
+class InstrumentedPoolMixin:
+    """
+        Measures how long callers wait for a connection from the pool.
+        """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            self.stats.timeouts += 1
+            raise
+        finally:
+            self.stats.record_wait(time.perf_counter() - start)
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.stats = self.stats
+        return pool
+
+
+class InstrumentedQueuePool(InstrumentedPoolMixin, QueuePool):
+    pass
+
+
+class InstrumentedAsyncAdaptedQueuePool(InstrumentedPoolMixin, AsyncAdaptedQueuePool):
+    pass
+
+
+def engine_options(db_url: str = config.DB_URL) -> dict:
+    """
+        Pool settings for create_engine taken from the config.
+
+        :param db_url: The database url the engine is created for.
+        :type db_url: str
+        :return: Keyword arguments for create_engine.
+        :rtype: dict
+        """
+    dialect = make_url(db_url).get_dialect()
+    options = dict(
+        echo=False,
+        poolclass=InstrumentedAsyncAdaptedQueuePool if dialect.is_async else InstrumentedQueuePool,
+        pool_size=config.DB_POOL_SIZE,
+        max_overflow=config.DB_MAX_OVERFLOW,
+        pool_timeout=config.DB_POOL_TIMEOUT,
+        pool_recycle=config.DB_POOL_RECYCLE,
+        pool_pre_ping=config.DB_POOL_PRE_PING,
+        query_cache_size=config.DB_COMPILED_CACHE_SIZE,
+    )
+    connect_args = prepared_statement_args(dialect.driver)
+    if connect_args:
+        options["connect_args"] = connect_args
+    return options
+
+
+def prepared_statement_args(driver: str, pgbouncer: bool = config.DB_PGBOUNCER) -> dict:
+    """
+        Driver arguments for server side prepared statements.
+
+        PgBouncer in transaction mode hands every transaction to any server connection,
+        where a statement prepared by another transaction doesn't exist, so behind it
+        statements are not cached and get unique names.
+
+        :param driver: The DBAPI driver of the url, e.g. asyncpg.
+        :type driver: str
+        :param pgbouncer: Whether the database is reached through PgBouncer in transaction mode.
+        :type pgbouncer: bool
+        :return: Keyword arguments for connect_args.
+        :rtype: dict
+        """
+    if driver == "asyncpg":
+        if pgbouncer:
+            return dict(statement_cache_size=0, prepared_statement_cache_size=0,
+                        prepared_statement_name_func=unique_statement_name)
+        return dict(prepared_statement_cache_size=config.DB_PREPARED_STATEMENT_CACHE_SIZE)
+    if driver == "psycopg" and pgbouncer:
+        # psycopg prepares a statement on its fifth execution by itself, None turns that off
+        return dict(prepare_threshold=None)
+    return {}
+
+
+def unique_statement_name() -> str:
+    return f"__asyncpg_{uuid.uuid4().hex}__"
+
+
 url = config.DB_URL
 Base = declarative_base()
-engine = create_engine(url, echo=False, pool_size=5)
-DBSession = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+engine = create_engine(url, **engine_options(url))
+replica_pool = ReplicaPool([create_engine(replica_url, **engine_options(replica_url))
+                            for replica_url in config.DB_REPLICA_URLS], cooldown=config.DB_REPLICA_COOLDOWN)
+shard_router = ShardRouter({name: create_engine(shard_url, **engine_options(shard_url))
+                            for name, shard_url in config.DB_SHARD_URLS.items()}, directory=engine,
+                           cache_ttl=config.DB_SHARD_CACHE_TTL,
+                           cache_size=config.DB_SHARD_CACHE_SIZE) if config.DB_SHARD_URLS else None
+DBSession = sessionmaker(class_=RoutingSession, bind=engine, replicas=replica_pool, shards=shard_router,
+                         autoflush=False, autocommit=False)
+
+
+def warm_up_pool(target_engine=engine, size: int = config.DB_POOL_WARMUP) -> int:
+    """
+        Opens connections up front so the first requests don't pay for connecting.
+
+        :param target_engine: The engine to warm up.
+        :type target_engine: Engine
+        :param size: The number of connections to open.
+        :type size: int
+        :return: The number of connections opened.
+        :rtype: int
+        """
+    connections = []
+    try:
+        for _ in range(size):
+            connections.append(target_engine.connect())
+    finally:
+        for connection in connections:
+            connection.close()
+    return len(connections)
+
+
+def pool_status(target_engine=engine) -> dict:
+    """
+        Current state of the connection pool.
+
+        :param target_engine: The engine to inspect.
+        :type target_engine: Engine
+        :return: Pool size, checked out and overflow connections, wait times.
+        :rtype: dict
+        """
+    pool = target_engine.pool
+    result = {}
+    for name in ("size", "checkedin", "checkedout", "overflow"):
+        method = getattr(pool, name, None)
+        # SingletonThreadPool has a plain size attribute
+        if callable(method):
+            result[name] = method()
+    stats = getattr(pool, "stats", None)
+    if stats is not None:
+        result["checkouts"] = stats.checkouts
+        result["timeouts"] = stats.timeouts
+        result["wait_avg_ms"] = round(stats.wait_total / stats.checkouts * 1000, 3) if stats.checkouts else 0.0
+        result["wait_max_ms"] = round(stats.wait_max * 1000, 3)
+    return result
+
+
+def dialect_insert(db, entity):
+    """
+        INSERT construct of the session's dialect, it supports ON CONFLICT clauses.
+
+        :param db: The database session, or a connection or engine.
+        :type db: Session | Connection | Engine
+        :param entity: The model or table to insert into.
+        :type entity: Base | Table
+        :return: The insert statement.
+        :rtype: Insert
+        :raises ValueError: If the dialect has no ON CONFLICT.
+        """
+    if isinstance(db, Session):
+        db = db.get_bind(mapper=inspect(entity)) if isinstance(entity, type) else db.get_bind()
+    dialect = db.dialect.name
+    if dialect == "postgresql":
+        return postgresql.insert(entity)
+    if dialect == "sqlite":
+        return sqlite.insert(entity)
+    raise ValueError(f"ON CONFLICT is not supported for {dialect}")
+
+
+@event.listens_for(Session, "after_begin")
+def apply_deadline(session, transaction, connection):
+    """
+        Limits statements of a transaction to the time left until the deadline of the session.
+        """
+    deadline = session.info.get("deadline")
+    dbapi_connection = connection.connection.dbapi_connection
+    if connection.dialect.name == "sqlite":
+        # the handler stays on the pooled connection, so it is replaced at every begin
+        dbapi_connection.set_progress_handler(
+            (lambda: time.monotonic() > deadline) if deadline is not None else None, 1000)
+    if deadline is None:
+        return
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise DeadlineExceeded()
+    session.info.setdefault("running", RunningConnections()).add(connection.connection)
+    if connection.dialect.name == "postgresql":
+        connection.exec_driver_sql(f"SET LOCAL statement_timeout = {max(int(remaining * 1000), 1)}")
+
+
+class RunningConnections:
+    """
+        The DBAPI connections a session has checked out of the pool, the ones its statements run on.
+
+        A connection is dropped when it goes back to the pool, under the same lock as ``cancel``,
+        so a connection another request may already use is never cancelled.
+        """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._connections = {}
+
+    def add(self, checkout):
+        with self._lock:
+            self._connections[id(checkout.dbapi_connection)] = checkout.dbapi_connection
+        checkout.info["running"] = self
+
+    def discard(self, dbapi_connection):
+        with self._lock:
+            self._connections.pop(id(dbapi_connection), None)
+
+    def cancel(self) -> int:
+        """
+            Cancels the statements running on the connections.
+
+            psycopg and psycopg2 connections have ``cancel``, sqlite ones ``interrupt``. The adapted
+            asyncpg connections have neither: their statements run on until the ``statement_timeout``
+            the deadline set for the transaction.
+
+            :return: The number of connections that were sent a cancel.
+            :rtype: int
+            """
+        cancelled = 0
+        with self._lock:
+            for dbapi_connection in self._connections.values():
+                cancel = getattr(dbapi_connection, "cancel", None) or getattr(dbapi_connection, "interrupt", None)
+                if cancel is None:
+                    continue
+                try:
+                    cancel()
+                    cancelled += 1
+                except Exception as err:
+                    print(err)
+        return cancelled
+
+
+@event.listens_for(Pool, "checkin")
+def forget_running(dbapi_connection, connection_record):
+    # before the pool can hand the connection to anyone else
+    running = connection_record.info.pop("running", None)
+    if running is not None:
+        running.discard(dbapi_connection)
+
+
+@event.listens_for(Pool, "reset")
+def clear_deadline(dbapi_connection, connection_record, reset_state):
+    if hasattr(dbapi_connection, "set_progress_handler"):
+        dbapi_connection.set_progress_handler(None, 0)
+
+
+def cancel_queries(db: Session) -> int:
+    """
+        Cancels the statements the session is running, safe to call from another thread.
+
+        :param db: The database session.
+        :type db: Session
+        :return: The number of connections that were sent a cancel.
+        :rtype: int
+        """
+    running = db.info.get("running")
+    return running.cancel() if running is not None else 0
+
+
+def is_deadline_error(err: Exception) -> bool:
+    """
+        Whether a database error means the statement ran out of time.
+
+        :param err: The error.
+        :type err: Exception
+        :return: True for statement timeouts and cancelled statements.
+        :rtype: bool
+        """
+    if isinstance(err, DeadlineExceeded):
+        return True
+    orig = getattr(err, "orig", None)
+    return getattr(orig, "pgcode", None) == "57014" or "interrupted" in str(orig)
 
 
 # Dependency
 def get_db():
     db = DBSession()
+    db.info["deadline"] = time.monotonic() + config.DB_STATEMENT_TIMEOUT
     try:
         yield db
+    except DeadlineExceeded:
+        raise HTTPException(status_code=status.HTTP_504_GATEWAY_TIMEOUT, detail="Request took too long")
+    except ShardMoving as err:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(err),
+                            headers={"Retry-After": "5"})
+    except PoolTimeoutError as err:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(err))
+    except OperationalError as err:
+        if is_deadline_error(err):
+            raise HTTPException(status_code=status.HTTP_504_GATEWAY_TIMEOUT, detail="Request took too long")
+        if err.connection_invalidated:
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(err))
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(err))
     except SQLAlchemyError as err:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(err))
     finally:
         db.close()
+
+
+async def _cancel_on_disconnect(request: Request, db: Session, interval: float):
+    while not await request.is_disconnected():
+        await asyncio.sleep(interval)
+    cancel_queries(db)
+
+
+class Deadline:
+    """
+        Dependency that gives the database work of a route `seconds` to finish.
+
+        Statements past the deadline are cancelled by the database and the route
+        answers 504. Statements still running when the client disconnects are
+        cancelled as well.
+        """
+
+    def __init__(self, seconds: float, poll_interval: float = 0.25):
+        self.seconds = seconds
+        self.poll_interval = poll_interval
+
+    async def __call__(self, request: Request, db: Session = Depends(get_db)):
+        db.info["deadline"] = time.monotonic() + self.seconds
+        watcher = asyncio.create_task(_cancel_on_disconnect(request, db, self.poll_interval))
+        try:
+            yield
+        finally:
+            watcher.cancel()
@@ -1,9 +1,14 @@
-from sqlalchemy import Column, Integer, String, Date, DateTime, func, ForeignKey, Boolean
-from sqlalchemy.orm import declarative_base, relationship
+from sqlalchemy import Column, Integer, String, Date, DateTime, func, ForeignKey, Boolean, Index, LargeBinary
+from sqlalchemy.orm import declarative_base, relationship, validates
+from src.database.normalize import normalize_email, normalize_phone
 
 Base = declarative_base()
 
 
+# the fields merging duplicates fills in on the contact that is kept
+MERGED_FIELDS = ("name", "surname", "email", "phone", "description", "birth_date")
+
+
 class Contact(Base):
     __tablename__ = 'contacts'
     id = Column(Integer, primary_key=True)
@@ -17,6 +22,27 @@ class Contact(Base):
     updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
     user_id = Column('user_id', ForeignKey('users.id', ondelete='CASCADE'), default=None)
     user = relationship('User', backref='contacts')
+    email_norm = Column(String(50), nullable=True)
+    phone_norm = Column(String(20), nullable=True)
+
+    __table_args__ = (
+        Index('ix_contacts_user_id_email_norm', 'user_id', 'email_norm'),
+        Index('ix_contacts_user_id_phone_norm', 'user_id', 'phone_norm'),
+        Index('ix_contacts_user_id_created_at', 'user_id', 'created_at'),
+    )
+    # the key of the partitioned PostgreSQL table, so updates and deletes of the ORM name the partition and
+    # use the primary key index instead of scanning every partition for the id
+    __mapper_args__ = {"primary_key": [user_id, id]}
+
+    @validates('email')
+    def validate_email(self, key, value):
+        self.email_norm = normalize_email(value)
+        return value
+
+    @validates('phone')
+    def validate_phone(self, key, value):
+        self.phone_norm = normalize_phone(value)
+        return value
 
 
 class User(Base):
@@ -25,6 +51,37 @@ class User(Base):
     username = Column(String(50))
     email = Column(String(150), nullable=False, unique=True)
     password = Column(String(255), nullable=False)
-    refresh_token = Column(String(255), nullable=True)
     avatar = Column(String(255), nullable=True)
     confirmed = Column(Boolean, default=False, nullable=True)
+
+
+class RefreshToken(Base):
+    __tablename__ = "refresh_tokens"
+    family_id = Column(String(64), primary_key=True)
+    user_id = Column('user_id', ForeignKey('users.id', ondelete='CASCADE'), nullable=False, index=True)
+    jti = Column(String(64), nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+
+
+class ContactCounter(Base):
+    __tablename__ = "contact_counters"
+    user_id = Column('user_id', ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    birth_month = Column(Integer, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+
+class UserShard(Base):
+    __tablename__ = "user_shards"
+    user_id = Column('user_id', ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    shard = Column(String(50), nullable=False, index=True)
+    moving = Column(Boolean, nullable=False, default=False)
+
+
+class IdempotencyKey(Base):
+    __tablename__ = "idempotency_keys"
+    key = Column(String(64), primary_key=True)
+    request_hash = Column(String(64), nullable=False)
+    status_code = Column(Integer, nullable=True)
+    content_type = Column(String(100), nullable=True)
+    body = Column(LargeBinary, nullable=True)
+    expires_at = Column(DateTime, nullable=False, index=True)
@@ -0,0 +1,90 @@
+import re
+import unicodedata
+
+from src.conf.config import config
+
+# E.164 numbers have at most 15 digits, the lookup column fits them with the +
+MAX_PHONE_DIGITS = 15
+
+SOUNDEX_CODES = {
+    **dict.fromkeys("bfpv", "1"),
+    **dict.fromkeys("cgjkqsxz", "2"),
+    **dict.fromkeys("dt", "3"),
+    "l": "4",
+    **dict.fromkeys("mn", "5"),
+    "r": "6",
+}
+
+
+def normalize_email(email: str | None) -> str | None:
+    """
+        Lookup key of an email: trimmed and lower-cased.
+
+        :param email: The email as typed.
+        :type email: str
+        :return: The normalized email, or None if it is empty.
+        :rtype: str | None
+        """
+    if not email:
+        return None
+    return email.strip().lower() or None
+
+
+def normalize_phone(phone: str | None, default_country_code: str = config.PHONE_DEFAULT_COUNTRY_CODE) -> str | None:
+    """
+        Lookup key of a phone number in E.164 form: ``+`` and digits only.
+
+        National numbers with a trunk ``0`` get the default country code, ``00`` is
+        read as the international prefix.
+
+        :param phone: The phone number as typed.
+        :type phone: str
+        :param default_country_code: The country code of national numbers.
+        :type default_country_code: str
+        :return: The normalized phone number, or None if it has no digits or more than E.164 allows.
+        :rtype: str | None
+        """
+    if not phone:
+        return None
+    phone = phone.strip()
+    digits = re.sub(r"\D", "", phone)
+    if not digits:
+        return None
+    if not phone.startswith("+"):
+        if digits.startswith("00"):
+            digits = digits[2:]
+        elif digits.startswith("0"):
+            digits = default_country_code + digits[1:]
+    if len(digits) > MAX_PHONE_DIGITS:
+        return None
+    return "+" + digits
+
+
+def soundex(name: str | None) -> str:
+    """
+        Phonetic key of a name, names that sound alike get the same key.
+
+        Names without latin letters are keyed by their case-folded form.
+
+        :param name: The name.
+        :type name: str
+        :return: The key, empty for an empty name.
+        :rtype: str
+        """
+    if not name:
+        return ""
+    ascii_name = unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode().lower()
+    letters = [char for char in ascii_name if char.isalpha()]
+    if not letters:
+        return name.strip().casefold()
+    code = letters[0].upper()
+    previous = SOUNDEX_CODES.get(letters[0], "")
+    for char in letters[1:]:
+        digit = SOUNDEX_CODES.get(char, "")
+        if digit and digit != previous:
+            code += digit
+            if len(code) == 4:
+                break
+        if char not in "hw":
+            previous = digit
+    return code.ljust(4, "0")
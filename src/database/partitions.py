@@ -0,0 +1,93 @@
+"""
+Periodic clustering of the contacts partitions by (user_id, id).
+
+Run with ``python -m src.database.partitions``, e.g. weekly from cron. CLUSTER
+locks one partition at a time, so only a sixteenth of the users wait, and only
+partitions whose rows drifted out of user order are rewritten.
+"""
+import argparse
+
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from src.database.db import engine as default_engine
+
+
+def partitions(conn, table: str = "contacts") -> list[str]:
+    """
+        The partitions of a table, empty for a plain table.
+
+        :param conn: A connection to PostgreSQL.
+        :type conn: Connection
+        :param table: The partitioned table.
+        :type table: str
+        :return: The partition names.
+        :rtype: list[str]
+        """
+    return conn.execute(text("SELECT inhrelid::regclass::text FROM pg_inherits "
+                             "WHERE inhparent = CAST(:table AS regclass) ORDER BY 1"), {"table": table}).scalars().all()
+
+
+def correlation(conn, partition: str) -> float | None:
+    """
+        How closely the physical order of a partition follows user_id, from the last ANALYZE.
+
+        :return: 1.0 for a perfectly clustered partition, None if it has not been analyzed.
+        :rtype: float | None
+        """
+    return conn.execute(text("SELECT correlation FROM pg_stats WHERE tablename = :partition AND attname = 'user_id'"),
+                        {"partition": partition}).scalar()
+
+
+def cluster(target_engine=default_engine, names: list[str] | None = None, min_correlation: float = 0.9,
+            lock_timeout: str = "5s") -> list[str]:
+    """
+        Rewrites the partitions in primary key order, the ones still in order are skipped.
+
+        :param target_engine: The engine of the database.
+        :type target_engine: Engine
+        :param names: The partitions to cluster, all by default.
+        :type names: list[str] | None
+        :param min_correlation: Partitions at or above this correlation are skipped.
+        :type min_correlation: float
+        :param lock_timeout: How long to wait for the lock of a partition before skipping it.
+        :type lock_timeout: str
+        :return: The clustered partitions.
+        :rtype: list[str]
+        """
+    clustered = []
+    with target_engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        for name in names or partitions(conn):
+            conn.execute(text(f"ANALYZE {name}"))
+            current = correlation(conn, name)
+            if current is not None and abs(current) >= min_correlation:
+                continue
+            primary_key = conn.execute(text("SELECT indexrelid::regclass::text FROM pg_index "
+                                            "WHERE indrelid = CAST(:name AS regclass) AND indisprimary"),
+                                       {"name": name}).scalar()
+            conn.execute(text(f"SET lock_timeout = '{lock_timeout}'"))
+            try:
+                # a waiting CLUSTER would queue every query of the partition behind it, so give up instead
+                conn.execute(text(f"CLUSTER {name} USING {primary_key}"))
+            except OperationalError as err:
+                print(f"{name}: {err.orig}")
+                continue
+            finally:
+                conn.execute(text("RESET lock_timeout"))
+            conn.execute(text(f"ANALYZE {name}"))
+            clustered.append(name)
+    return clustered
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cluster the contacts partitions by user")
+    parser.add_argument("--partition", action="append", dest="partitions", help="only this partition, repeatable")
+    parser.add_argument("--min-correlation", type=float, default=0.9)
+    parser.add_argument("--lock-timeout", default="5s")
+    args = parser.parse_args()
+    clustered = cluster(names=args.partitions, min_correlation=args.min_correlation, lock_timeout=args.lock_timeout)
+    print(f"Clustered {len(clustered)} partitions: {', '.join(clustered)}")
+
+
+if __name__ == "__main__":
+    main()
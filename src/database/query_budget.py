@@ -0,0 +1,142 @@
+"""
+Counting the SQL statements and rows of a block of code, to keep endpoints from growing queries.
+
+Routes declare their maximum with the ``query_budget`` decorator, the test suite runs
+every request of the test client inside a ``QueryCounter`` and fails with the SQL of
+the request when it runs over, so an N+1 or a redundant lookup breaks a test instead
+of production.
+"""
+import re
+import threading
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from starlette.routing import Match
+
+# transaction control of the database and the test fixtures is not a query of the code under test
+IGNORED = re.compile(r"^\s*(BEGIN|COMMIT|ROLLBACK|SAVEPOINT|RELEASE|SET LOCAL|SHOW)\b", re.IGNORECASE)
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+class QueryCounter:
+    """
+        Counts the statements sent to any engine and the rows they read or wrote, while entered.
+
+        Rows of statements that return rows are counted when they are executed through a
+        Session, which buffers their results; for the others the affected row count is used.
+        """
+
+    def __init__(self):
+        self.statements: list[str] = []
+        self.rows = 0
+        self._lock = threading.Lock()
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if IGNORED.match(statement):
+            return
+        with self._lock:
+            self.statements.append(f"{statement} {parameters!r}" if parameters else statement)
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if IGNORED.match(statement) or cursor.description is not None:
+            return
+        with self._lock:
+            self.rows += max(cursor.rowcount, 0)
+
+    def _do_orm_execute(self, orm_execute_state):
+        result = orm_execute_state.invoke_statement()
+        if not getattr(result, "returns_rows", True):
+            return result
+        frozen = result.freeze()
+        with self._lock:
+            self.rows += len(frozen.data)
+        return frozen()
+
+    def __enter__(self):
+        event.listen(Engine, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", self._after_cursor_execute)
+        event.listen(Session, "do_orm_execute", self._do_orm_execute)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        event.remove(Engine, "before_cursor_execute", self._before_cursor_execute)
+        event.remove(Engine, "after_cursor_execute", self._after_cursor_execute)
+        event.remove(Session, "do_orm_execute", self._do_orm_execute)
+
+
+class QueryBudget:
+    """
+        The most statements and rows a block of code may use, None for no limit.
+        """
+
+    def __init__(self, statements: int | None = None, rows: int | None = None):
+        self.statements = statements
+        self.rows = rows
+
+    def check(self, counter: QueryCounter, label: str = "block"):
+        """
+            Fails when the counter is over the budget.
+
+            :param counter: The counts of the block.
+            :type counter: QueryCounter
+            :param label: What ran, for the message.
+            :type label: str
+            :return: Nothing.
+            :rtype: None
+            :raises QueryBudgetExceeded: With every statement of the block.
+            """
+        problems = []
+        if self.statements is not None and len(counter.statements) > self.statements:
+            problems.append(f"{len(counter.statements)} statements, budget {self.statements}")
+        if self.rows is not None and counter.rows > self.rows:
+            problems.append(f"{counter.rows} rows, budget {self.rows}")
+        if problems:
+            sql = "\n".join(f"  {number}. {statement}" for number, statement in enumerate(counter.statements, 1))
+            raise QueryBudgetExceeded(f"{label} ran {' and '.join(problems)}:\n{sql}")
+
+    def __repr__(self):
+        return f"QueryBudget(statements={self.statements}, rows={self.rows})"
+
+
+def query_budget(statements: int | None = None, rows: int | None = None):
+    """
+        Declares the budget of a route, put it below the route decorator.
+
+        :param statements: The most SQL statements of one request.
+        :type statements: int | None
+        :param rows: The most rows one request reads or writes.
+        :type rows: int | None
+        :return: The decorator, it returns the endpoint unchanged.
+        :rtype: Callable
+        """
+
+    def decorator(func):
+        func.query_budget = QueryBudget(statements, rows)
+        return func
+
+    return decorator
+
+
+def route_budget(app, method: str, path: str) -> QueryBudget | None:
+    """
+        The budget of the route that serves a request.
+
+        :param app: The application.
+        :type app: FastAPI
+        :param method: The HTTP method.
+        :type method: str
+        :param path: The path of the request.
+        :type path: str
+        :return: The budget, None if the route has none or no route matches.
+        :rtype: QueryBudget | None
+        """
+    scope = {"type": "http", "method": method.upper(), "path": path}
+    for route in app.router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return getattr(getattr(route, "endpoint", None), "query_budget", None)
+    return None
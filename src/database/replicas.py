@@ -0,0 +1,142 @@
+import functools
+import inspect
+import itertools
+import time
+from contextlib import contextmanager
+
+from sqlalchemy.exc import DBAPIError, OperationalError
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.dml import UpdateBase
+
+
+class ReplicaPool:
+    """
+        Round-robin choice between read replicas, skipping the ones that failed recently.
+        """
+
+    def __init__(self, engines, cooldown: float = 30.0):
+        self.engines = list(engines)
+        self.cooldown = cooldown
+        self._down_until = {}
+        self._counter = itertools.count()
+
+    def choose(self):
+        """
+            Next healthy replica
+
+            :return: The engine of a healthy replica, or None if there is none.
+            :rtype: Engine | None
+            """
+        now = time.monotonic()
+        for _ in range(len(self.engines)):
+            engine = self.engines[next(self._counter) % len(self.engines)]
+            if self._down_until.get(engine, 0) <= now:
+                return engine
+        return None
+
+    def mark_down(self, engine):
+        """
+            Takes a replica out of rotation for the cooldown period.
+
+            :param engine: The engine of the failed replica.
+            :type engine: Engine
+            :return: Nothing.
+            :rtype: None
+            """
+        self._down_until[engine] = time.monotonic() + self.cooldown
+
+    def is_healthy(self, engine) -> bool:
+        return self._down_until.get(engine, 0) <= time.monotonic()
+
+
+class RoutingSession(Session):
+    """
+        Session that routes statements to the primary, or to the shard of their owner with a shard router.
+
+        Read-only repository calls run in a session of their own bound to a replica, see ``read_only``.
+        """
+
+    def __init__(self, bind=None, replicas: ReplicaPool | None = None, shards=None, **kwargs):
+        super().__init__(bind=bind, **kwargs)
+        self.replicas = replicas
+        self.shards = shards
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        writing = self._flushing or isinstance(clause, UpdateBase)
+        if self.shards is not None:
+            shard = self.shards.route(self.info, mapper, clause, writing)
+            if shard is not None:
+                return shard
+        if writing:
+            self.info["wrote"] = True
+        return super().get_bind(mapper=mapper, clause=clause, **kwargs)
+
+
+def _choose_replica(db):
+    # once the session has written, or is about to flush, its reads stay on the primary to see the writes
+    if not db.replicas or db.info.get("wrote") or db.new or db.dirty or db.deleted:
+        return None
+    return db.replicas.choose()
+
+
+@contextmanager
+def _replica_session(db, replica):
+    # a failing replica never touches the transaction, pending changes or loaded objects of the request
+    replica_db = RoutingSession(bind=replica, shards=db.shards, autoflush=False)
+    # the same deadline, shard owner and running connections as the request
+    replica_db.info = db.info
+    try:
+        yield replica_db
+    finally:
+        replica_db.close()
+
+
+def _is_outage(err: DBAPIError) -> bool:
+    return isinstance(err, OperationalError) or err.connection_invalidated
+
+
+def read_only(func):
+    """
+        Marks a repository function, sync or async, as read-only so its queries may go to a replica.
+
+        The decorated function must take the session as ``db``; on a replica it gets a session
+        of its own, so what it returns must not need the request session (rows, or objects
+        whose attributes are loaded). If the replica fails, it is taken out of rotation and the
+        call is repeated on the primary with the session of the request.
+        """
+    signature = inspect.signature(func)
+
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            call = signature.bind(*args, **kwargs)
+            db = call.arguments["db"]
+            replica = _choose_replica(db) if isinstance(db, RoutingSession) else None
+            if replica is not None:
+                with _replica_session(db, replica) as replica_db:
+                    call.arguments["db"] = replica_db
+                    try:
+                        return await func(*call.args, **call.kwargs)
+                    except DBAPIError as err:
+                        if not _is_outage(err):
+                            raise
+                        db.replicas.mark_down(replica)
+            return await func(*args, **kwargs)
+    else:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            call = signature.bind(*args, **kwargs)
+            db = call.arguments["db"]
+            replica = _choose_replica(db) if isinstance(db, RoutingSession) else None
+            if replica is not None:
+                with _replica_session(db, replica) as replica_db:
+                    call.arguments["db"] = replica_db
+                    try:
+                        return func(*call.args, **call.kwargs)
+                    except DBAPIError as err:
+                        if not _is_outage(err):
+                            raise
+                        db.replicas.mark_down(replica)
+            return func(*args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,367 @@
+"""
+Horizontal sharding of contacts by user.
+
+The user_shards table of the primary database is the authority on where the
+contacts of a user live. Users are placed by consistent hashing and pinned
+there at signup (users from before sharding on their first write, or with
+``python -m src.database.shards place``), so adding a shard moves nobody until
+the rebalance tool does: ``python -m src.database.shards rebalance``.
+"""
+import argparse
+import bisect
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+from sqlalchemy import delete, func, select, update
+from sqlalchemy.schema import CreateIndex, CreateTable
+
+from src.database.models import Contact, ContactCounter, User, UserShard
+
+SHARDED_TABLES = (Contact.__table__, ContactCounter.__table__)
+# contact ids of each shard start here, so that moved contacts keep their ids
+ID_RANGE = 2 ** 40
+
+
+class ShardingError(Exception):
+    pass
+
+
+class ShardMoving(Exception):
+    """
+        Writes of a user are refused while the user is moved to another shard.
+        """
+
+    def __init__(self, user_id: int):
+        super().__init__(f"Contacts of user {user_id} are being moved, try again later")
+        self.user_id = user_id
+
+
+class HashRing:
+    """
+        Consistent hashing of user ids onto shard names, with `vnodes` points per shard.
+        """
+
+    def __init__(self, names, vnodes: int = 64):
+        self.names = list(names)
+        self._points = sorted((self._hash(f"{name}#{i}"), name) for name in self.names for i in range(vnodes))
+        self._keys = [point for point, _ in self._points]
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+    def get(self, user_id: int) -> str:
+        index = bisect.bisect(self._keys, self._hash(str(user_id))) % len(self._keys)
+        return self._points[index][1]
+
+
+def _insert(bind, table):
+    # db imports this module, so its helper is imported when it is first needed
+    from src.database.db import dialect_insert
+
+    return dialect_insert(bind, table)
+
+
+class ShardRouter:
+    """
+        Maps users to shard engines.
+
+        Placements are read from user_shards in the directory (primary) database
+        and cached for `cache_ttl` seconds, for at most `cache_size` users. The
+        rebalance tool waits longer than the TTL before relying on every process
+        having seen a change.
+        """
+
+    def __init__(self, engines: dict, directory, vnodes: int = 64, cache_ttl: float = 5.0, cache_size: int = 100_000):
+        if not engines:
+            raise ShardingError("no shards configured")
+        self.engines = dict(engines)
+        self.directory = directory
+        self.ring = HashRing(self.engines, vnodes)
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        # user id: (expiry, (shard, moving), pinned), least recently used first
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def pin(self, db, user_id: int):
+        """
+            Pins a user to its shard on the ring, e.g. in the transaction that creates the user.
+
+            :param db: The session or connection of the directory database.
+            :type db: Session | Connection
+            :param user_id: The id of the user.
+            :type user_id: int
+            :return: Nothing.
+            :rtype: None
+            """
+        db.execute(_insert(db, UserShard.__table__).values(user_id=user_id, shard=self.ring.get(user_id),
+                                                             moving=False).on_conflict_do_nothing())
+
+    def placement(self, user_id: int, pin: bool = False) -> tuple[str, bool]:
+        """
+            The shard of a user and whether the user is being moved.
+
+            A user without a placement is on its ring shard; it is only pinned there with `pin`,
+            so reads never write to the directory.
+
+            :param user_id: The id of the user.
+            :type user_id: int
+            :param pin: Whether to pin a user without a placement.
+            :type pin: bool
+            :return: The shard name and the moving flag.
+            :rtype: tuple[str, bool]
+            """
+        now = time.monotonic()
+        with self._lock:
+            cached = self._cache.get(user_id)
+            if cached is not None and cached[0] > now and (cached[2] or not pin):
+                self._cache.move_to_end(user_id)
+                return cached[1]
+        table = UserShard.__table__
+        query = select(table.c.shard, table.c.moving).where(table.c.user_id == user_id)
+        with self.directory.connect() as conn:
+            row = conn.execute(query).first()
+        if row is None and pin:
+            with self.directory.begin() as conn:
+                self.pin(conn, user_id)
+                row = conn.execute(query).one()
+        value = (row.shard, bool(row.moving)) if row is not None else (self.ring.get(user_id), False)
+        with self._lock:
+            self._cache[user_id] = (now + self.cache_ttl, value, row is not None)
+            self._cache.move_to_end(user_id)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return value
+
+    def shard_for(self, user_id: int, write: bool = False) -> str:
+        # users from before sharding are pinned on their first write
+        shard, moving = self.placement(user_id, pin=write)
+        if moving and write:
+            raise ShardMoving(user_id)
+        return shard
+
+    def route(self, info: dict, mapper=None, clause=None, write: bool = False):
+        """
+            The engine for a statement of a session, None if it doesn't touch a sharded table.
+
+            The shard comes from ``info["shard"]`` when a job works shard by shard,
+            otherwise from the owner in ``info["user_id"]``, set on authentication.
+
+            :raises ShardingError: If a sharded table is used without a user or a shard.
+            :raises ShardMoving: If the owner is being moved and the statement writes.
+            """
+        table = mapper.persist_selectable if mapper is not None else getattr(clause, "table", None)
+        if table not in SHARDED_TABLES:
+            return None
+        if info.get("shard") is not None:
+            return self.engines[info["shard"]]
+        if info.get("user_id") is None:
+            raise ShardingError(f"{table.name} used without a user or a shard")
+        return self.engines[self.shard_for(info["user_id"], write)]
+
+    def group_by_shard(self, user_ids) -> dict[str, list[int]]:
+        groups = {}
+        for user_id in user_ids:
+            groups.setdefault(self.shard_for(user_id), []).append(user_id)
+        return groups
+
+    def forget(self, user_id: int):
+        with self._lock:
+            self._cache.pop(user_id, None)
+
+
+def create_shard_schema(engine, index: int):
+    """
+        Creates the sharded tables on a shard, without foreign keys to tables of the primary.
+
+        :param engine: The engine of the shard.
+        :type engine: Engine
+        :param index: The position of the shard, its contact ids start at index * ID_RANGE.
+        :type index: int
+        :return: Nothing.
+        :rtype: None
+        """
+    with engine.begin() as conn:
+        for table in SHARDED_TABLES:
+            if engine.dialect.has_table(conn, table.name):
+                continue
+            conn.execute(CreateTable(table, include_foreign_key_constraints=[]))
+            for index_ in table.indexes:
+                conn.execute(CreateIndex(index_))
+        if engine.dialect.name == "postgresql":
+            conn.exec_driver_sql(f"SELECT setval('contacts_id_seq', GREATEST({index * ID_RANGE}, "
+                                 f"(SELECT COALESCE(MAX(id), 1) FROM contacts)))")
+
+
+def _copy(target, table, rows):
+    if not rows:
+        return
+    statement = _insert(target, table).values(rows)
+    if table is Contact.__table__:
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c.id], set_={column.name: statement.excluded[column.name] for column in table.c},
+            where=table.c.user_id == statement.excluded.user_id).returning(table.c.id)
+        copied = target.execute(statement).all()
+        if len(copied) != len(rows):
+            raise ShardingError("contact ids collide with contacts of another user on the target shard")
+    else:
+        statement = statement.on_conflict_do_update(
+            index_elements=list(table.primary_key.columns), set_={"count": statement.excluded["count"]})
+        target.execute(statement)
+
+
+def move_user(router: ShardRouter, user_id: int, target_shard: str, batch_size: int = 1000,
+              settle: float | None = None) -> int:
+    """
+        Moves the contacts of a user to another shard while the service keeps running.
+
+        Contacts are copied in batches while the user keeps working. Then writes of the
+        user are refused (503) for a moment: once every process has seen that, contacts
+        changed since the copy started are synced, the placement is switched and
+        contacts are deleted from the old shard when no process reads them any more.
+
+        :param router: The shard router.
+        :type router: ShardRouter
+        :param user_id: The id of the user.
+        :type user_id: int
+        :param target_shard: The name of the shard to move to.
+        :type target_shard: str
+        :param batch_size: The number of contacts copied at once.
+        :type batch_size: int
+        :param settle: Seconds to wait for other processes to see a placement change, the cache TTL by default.
+        :type settle: float
+        :return: The number of contacts moved.
+        :rtype: int
+        """
+    settle = router.cache_ttl + 1 if settle is None else settle
+    router.forget(user_id)
+    source_shard, moving = router.placement(user_id, pin=True)
+    if source_shard == target_shard:
+        return 0
+    if moving:
+        raise ShardingError(f"user {user_id} is already being moved")
+    source, target = router.engines[source_shard], router.engines[target_shard]
+    contacts, counters = Contact.__table__, ContactCounter.__table__
+    shards = UserShard.__table__
+
+    with source.connect() as conn:
+        # with a margin for writes whose transaction began before and for the precision of stored timestamps
+        started = conn.execute(select(func.now())).scalar() - timedelta(minutes=1)
+    last_id = 0
+    while True:
+        with source.connect() as conn:
+            rows = [dict(row._mapping) for row in conn.execute(
+                select(contacts).where(contacts.c.user_id == user_id, contacts.c.id > last_id).order_by(
+                    contacts.c.id).limit(batch_size))]
+        if not rows:
+            break
+        with target.begin() as conn:
+            _copy(conn, contacts, rows)
+        last_id = rows[-1]["id"]
+
+    with router.directory.begin() as conn:
+        conn.execute(update(shards).where(shards.c.user_id == user_id).values(moving=True))
+    try:
+        time.sleep(settle)
+        with source.connect() as src, target.begin() as dst:
+            ids = [contact_id for contact_id, in src.execute(select(contacts.c.id).where(
+                contacts.c.user_id == user_id))]
+            stale = dst.execute(select(contacts.c.id).where(contacts.c.user_id == user_id)).scalars().all()
+            removed = sorted(set(stale) - set(ids))
+            for i in range(0, len(removed), batch_size):
+                dst.execute(delete(contacts).where(contacts.c.id.in_(removed[i:i + batch_size])))
+            changed = [dict(row._mapping) for row in src.execute(select(contacts).where(
+                contacts.c.user_id == user_id, contacts.c.updated_at >= started))]
+            for i in range(0, len(changed), batch_size):
+                _copy(dst, contacts, changed[i:i + batch_size])
+            dst.execute(delete(counters).where(counters.c.user_id == user_id))
+            _copy(dst, counters, [dict(row._mapping) for row in src.execute(
+                select(counters).where(counters.c.user_id == user_id))])
+        with router.directory.begin() as conn:
+            conn.execute(update(shards).where(shards.c.user_id == user_id).values(shard=target_shard, moving=False))
+    except BaseException:
+        with router.directory.begin() as conn:
+            conn.execute(update(shards).where(shards.c.user_id == user_id).values(moving=False))
+        router.forget(user_id)
+        raise
+    router.forget(user_id)
+
+    time.sleep(settle)
+    with source.begin() as conn:
+        conn.execute(delete(counters).where(counters.c.user_id == user_id))
+        conn.execute(delete(contacts).where(contacts.c.user_id == user_id))
+    return len(ids)
+
+
+def misplaced_users(router: ShardRouter) -> list[tuple[int, str, str]]:
+    """
+        Users whose shard differs from their place on the ring, e.g. after a shard was added.
+
+        :param router: The shard router.
+        :type router: ShardRouter
+        :return: The user id, the current shard and the ring shard of each.
+        :rtype: list[tuple[int, str, str]]
+        """
+    table = UserShard.__table__
+    with router.directory.connect() as conn:
+        rows = conn.execute(select(table.c.user_id, table.c.shard).order_by(table.c.user_id)).all()
+    return [(user_id, shard, router.ring.get(user_id)) for user_id, shard in rows
+            if shard != router.ring.get(user_id)]
+
+
+def place_all(router: ShardRouter, batch_size: int = 1000) -> int:
+    """
+        Pins every user to a shard, run it before changing the shards of a running service.
+        """
+    placed = 0
+    last_id = 0
+    while True:
+        with router.directory.connect() as conn:
+            user_ids = conn.execute(select(User.id).where(User.id > last_id).order_by(User.id).limit(
+                batch_size)).scalars().all()
+        if not user_ids:
+            return placed
+        for user_id in user_ids:
+            router.placement(user_id, pin=True)
+        placed += len(user_ids)
+        last_id = user_ids[-1]
+
+
+def main():
+    from src.database.db import shard_router
+
+    parser = argparse.ArgumentParser(description="Manage contact shards")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("init", help="create the sharded tables on every shard")
+    commands.add_parser("place", help="pin every user to a shard")
+    commands.add_parser("plan", help="list users to move after the shards changed")
+    move = commands.add_parser("move", help="move a user to a shard")
+    move.add_argument("user_id", type=int)
+    move.add_argument("shard")
+    rebalance = commands.add_parser("rebalance", help="move misplaced users to their ring shard")
+    rebalance.add_argument("--limit", type=int, default=None)
+    args = parser.parse_args()
+
+    if shard_router is None:
+        parser.error("DB_SHARD_URLS is not configured")
+    if args.command == "init":
+        for index, shard_engine in enumerate(shard_router.engines.values()):
+            create_shard_schema(shard_engine, index)
+    elif args.command == "place":
+        print(f"Placed {place_all(shard_router)} users")
+    elif args.command == "plan":
+        for user_id, shard, ring_shard in misplaced_users(shard_router):
+            print(f"user {user_id}: {shard} -> {ring_shard}")
+    elif args.command == "move":
+        print(f"Moved {move_user(shard_router, args.user_id, args.shard)} contacts")
+    else:
+        for user_id, shard, ring_shard in misplaced_users(shard_router)[:args.limit]:
+            print(f"user {user_id}: {shard} -> {ring_shard}, {move_user(shard_router, user_id, ring_shard)} contacts")
+
+
+if __name__ == "__main__":
+    main()
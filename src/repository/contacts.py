@@ -1,12 +1,55 @@
+from collections import Counter
+from dataclasses import make_dataclass
 from datetime import datetime, timedelta
 
-from sqlalchemy import extract
+from sqlalchemy import Integer, bindparam, extract, func, select
 from sqlalchemy.orm import Session
-from src.database.models import Contact, User
+from src.database.db import dialect_insert
+from src.database.models import MERGED_FIELDS, Contact, ContactCounter, User
+from src.database.replicas import read_only
 from src.schemas import ContactModel
+from src.database.normalize import normalize_email, normalize_phone
+from src.services import events, tracing
+from src.services.single_flight import coalesce, flight
 
+# built once, so a call only binds its parameters: SQLAlchemy finds the compiled SQL in its cache and
+# the driver reuses the prepared statement instead of building, compiling and planning the query again
+CONTACT_BY_ID = select(Contact).where(Contact.user_id == bindparam("user_id"),
+                                      Contact.id == bindparam("contact_id")).limit(1)
 
-async def get_contacts(limit, offset, db: Session, current_user: User):
+# coalesced lookups read plain columns, their result is shared between requests
+ContactRow = make_dataclass("ContactRow", [column.key for column in Contact.__table__.columns], frozen=True)
+CONTACT_COLUMNS = select(*(getattr(Contact, column.key) for column in Contact.__table__.columns))
+CONTACTS_PAGE = CONTACT_COLUMNS.where(Contact.user_id == bindparam("user_id")).limit(
+    bindparam("limit", type_=Integer)).offset(bindparam("offset", type_=Integer))
+CONTACT_ROW_BY_ID = CONTACT_COLUMNS.where(Contact.user_id == bindparam("user_id"),
+                                          Contact.id == bindparam("contact_id")).limit(1)
+CONTACT_BY_NAME = CONTACT_COLUMNS.where(Contact.user_id == bindparam("user_id"),
+                                        Contact.name == bindparam("name")).limit(1)
+CONTACT_BY_SURNAME = CONTACT_COLUMNS.where(Contact.user_id == bindparam("user_id"),
+                                           Contact.surname == bindparam("surname")).limit(1)
+CONTACT_BY_EMAIL = CONTACT_COLUMNS.where(Contact.user_id == bindparam("user_id"),
+                                         Contact.email_norm == bindparam("email")).limit(1)
+CONTACT_BY_PHONE = CONTACT_COLUMNS.where(Contact.user_id == bindparam("user_id"),
+                                         Contact.phone_norm == bindparam("phone")).limit(1)
+BIRTHDAYS = CONTACT_COLUMNS.where(Contact.user_id == bindparam("user_id"),
+                                  extract('month', Contact.birth_date) == bindparam("month", type_=Integer),
+                                  extract('day', Contact.birth_date).between(
+                                      bindparam("first_day", type_=Integer), bindparam("last_day", type_=Integer)))
+CONTACT_COUNTS = select(ContactCounter.birth_month, ContactCounter.count).where(
+    ContactCounter.user_id == bindparam("user_id"))
+RECENT_CONTACTS = select(Contact).where(Contact.user_id == bindparam("user_id")).order_by(
+    Contact.created_at.desc(), Contact.id.desc()).limit(bindparam("recent", type_=Integer))
+
+
+def _row(row) -> ContactRow | None:
+    return ContactRow(**row._mapping) if row is not None else None
+
+
+@tracing.traced
+@coalesce(key=lambda limit, offset, db, current_user: (current_user.id, limit, offset))
+@read_only
+def get_contacts(limit, offset, db: Session, current_user: User):
     """
         Get list of contacts with the specified number of them for a specific user.
 
@@ -18,13 +61,14 @@ async def get_contacts(limit, offset, db: Session, current_user: User):
         :type current_user: User
         :param db: The database session.
         :type db: Session
-        :return: A list of contacts.
-        :rtype: List[Contact]
+        :return: The contacts of the page.
+        :rtype: tuple[ContactRow]
         """
-    contacts = db.query(Contact).filter(Contact.user_id == current_user.id).limit(limit).offset(offset).all()
-    return contacts
+    rows = db.execute(CONTACTS_PAGE, {"user_id": current_user.id, "limit": limit, "offset": offset})
+    return tuple(_row(row) for row in rows)
 
 
+@tracing.traced
 async def create_contacts(contact, db: Session, current_user):
     """
         Creates a new contact for a specific user.
@@ -38,14 +82,51 @@ async def create_contacts(contact, db: Session, current_user):
         :return: The newly created contact.
         :rtype: Contact
         """
-    new_contact = Contact(**contact.model_dump(exclude_unset=True), user_id=current_user.id)
+    # read once, commits expire the user and reading it again would cost a SELECT
+    user_id = current_user.id
+    new_contact = Contact(**contact.model_dump(exclude_unset=True), user_id=user_id)
     db.add(new_contact)
+    count_contact(db, user_id, new_contact.birth_date, 1)
     db.commit()
+    flight.invalidate(user_id)
     db.refresh(new_contact)
+    await events.publish(user_id, events.CREATED, new_contact)
     return new_contact
 
 
-async def get_contact(contact_id, db, current_user):
+@tracing.traced
+async def create_contacts_bulk(contacts, db: Session, current_user):
+    """
+        Creates several contacts for a specific user in one transaction.
+
+        :param contacts: The data for the contacts to create.
+        :type contacts: List[ContactModel]
+        :param current_user: The user to create the contacts for.
+        :type current_user: User
+        :param db: The database session.
+        :type db: Session
+        :return: The newly created contacts.
+        :rtype: List[Contact]
+        """
+    user_id = current_user.id
+    new_contacts = [Contact(**contact.model_dump(exclude_unset=True), user_id=user_id) for contact in contacts]
+    db.add_all(new_contacts)
+    count_contacts(db, user_id, [new_contact.birth_date for new_contact in new_contacts], 1)
+    db.flush()
+    ids = [new_contact.id for new_contact in new_contacts]
+    db.commit()
+    flight.invalidate(user_id)
+    # one select reloads all of them instead of a refresh per contact
+    db.query(Contact).filter(Contact.id.in_(ids)).all()
+    for new_contact in new_contacts:
+        await events.publish(user_id, events.CREATED, new_contact)
+    return new_contacts
+
+
+@tracing.traced
+@coalesce(key=lambda contact_id, db, current_user: (current_user.id, contact_id))
+@read_only
+def get_contact(contact_id, db, current_user):
     """
         Get contact with the specified id for a specific user
 
@@ -56,13 +137,15 @@ async def get_contact(contact_id, db, current_user):
         :param db: The database session.
         :type db: Session
         :return: The contact with the specified ID, or None if it does not exist.
-        :rtype: Contact | None
+        :rtype: ContactRow | None
         """
-    contact = db.query(Contact).filter(Contact.user_id == current_user.id).filter(Contact.id == contact_id).first()
-    return contact
+    return _row(db.execute(CONTACT_ROW_BY_ID, {"user_id": current_user.id, "contact_id": contact_id}).first())
 
 
-async def get_contact_by_name(contact_name, db, current_user):
+@tracing.traced
+@coalesce(key=lambda contact_name, db, current_user: (current_user.id, contact_name))
+@read_only
+def get_contact_by_name(contact_name, db, current_user):
     """
                 Get contact with the specified name for a specific user.
 
@@ -73,13 +156,15 @@ async def get_contact_by_name(contact_name, db, current_user):
                 :param db: The database session.
                 :type db: Session
                 :return: The contact with the specified name, or None if it does not exist.
-                :rtype: Contact | None
+                :rtype: ContactRow | None
                 """
-    contact = db.query(Contact).filter(Contact.user_id == current_user.id).filter(Contact.name == contact_name).first()
-    return contact
+    return _row(db.execute(CONTACT_BY_NAME, {"user_id": current_user.id, "name": contact_name}).first())
 
 
-async def get_contact_by_surname(contact_surname, db, current_user):
+@tracing.traced
+@coalesce(key=lambda contact_surname, db, current_user: (current_user.id, contact_surname))
+@read_only
+def get_contact_by_surname(contact_surname, db, current_user):
     """
                 Get contact with the specified surname for a specific user.
 
@@ -90,14 +175,15 @@ async def get_contact_by_surname(contact_surname, db, current_user):
                 :param db: The database session.
                 :type db: Session
                 :return: The contact with the specified email, or None if it does not exist.
-                :rtype: Contact | None
+                :rtype: ContactRow | None
                 """
-    contact = db.query(Contact).filter(Contact.user_id == current_user.id).filter(
-        Contact.surname == contact_surname).first()
-    return contact
+    return _row(db.execute(CONTACT_BY_SURNAME, {"user_id": current_user.id, "surname": contact_surname}).first())
 
 
-async def get_contact_by_email(contact_email, db, current_user):
+@tracing.traced
+@coalesce(key=lambda contact_email, db, current_user: (current_user.id, contact_email))
+@read_only
+def get_contact_by_email(contact_email, db, current_user):
     """
             Get contact with the specified email for a specific user.
 
@@ -108,14 +194,38 @@ async def get_contact_by_email(contact_email, db, current_user):
             :param db: The database session.
             :type db: Session
             :return: The contact with the specified email, or None if it does not exist.
-            :rtype: Contact | None
+            :rtype: ContactRow | None
             """
-    contact = db.query(Contact).filter(Contact.user_id == current_user.id).filter(
-        Contact.email == contact_email).first()
-    return contact
+    return _row(db.execute(CONTACT_BY_EMAIL, {"user_id": current_user.id,
+                                              "email": normalize_email(contact_email)}).first())
 
 
-async def get_birthdays(db, current_user):
+@tracing.traced
+@coalesce(key=lambda contact_phone, db, current_user: (current_user.id, contact_phone))
+@read_only
+def get_contact_by_phone(contact_phone, db, current_user):
+    """
+            Get contact with the specified phone for a specific user, whatever formatting is used.
+
+            :param contact_phone: The phone of the contact to get.
+            :type contact_phone: str
+            :param current_user: The user to get the contact for.
+            :type current_user: User
+            :param db: The database session.
+            :type db: Session
+            :return: The contact with the specified phone, or None if it does not exist.
+            :rtype: ContactRow | None
+            """
+    phone = normalize_phone(contact_phone)
+    if phone is None:
+        return None
+    return _row(db.execute(CONTACT_BY_PHONE, {"user_id": current_user.id, "phone": phone}).first())
+
+
+@tracing.traced
+@coalesce(key=lambda db, current_user: (current_user.id,))
+@read_only
+def get_birthdays(db, current_user):
     """
         Get contacts with the specified birthdays for a specific user.
 
@@ -124,18 +234,16 @@ async def get_birthdays(db, current_user):
         :param db: The database session.
         :type db: Session
         :return: The contact with the specified email, or None if it does not exist.
-        :rtype: Contact | None
+        :rtype: tuple[ContactRow]
         """
     now = datetime.now().date()
     after = now + timedelta(days=7)
-    birth_day = extract('day', Contact.birth_date)
-    birth_month = extract('month', Contact.birth_date)
-    contacts = db.query(Contact).filter(Contact.user_id == current_user.id).filter(
-        birth_month == extract('month', now),
-        birth_day.between(extract('day', now), extract('day', after))).all()
-    return contacts
+    rows = db.execute(BIRTHDAYS, {"user_id": current_user.id, "month": now.month, "first_day": now.day,
+                                  "last_day": after.day})
+    return tuple(_row(row) for row in rows)
 
 
+@tracing.traced
 async def update_contact(contact_id: int, body: ContactModel, db: Session, current_user) -> Contact | None:
     """
         Updates a single contact with the specified ID for a specific user.
@@ -151,7 +259,8 @@ async def update_contact(contact_id: int, body: ContactModel, db: Session, curre
         :return: The updated contact, or None if it does not exist.
         :rtype: Contact | None
         """
-    contact = db.query(Contact).filter(Contact.user_id == current_user.id).filter(Contact.id == contact_id).first()
+    user_id = current_user.id
+    contact = db.scalars(CONTACT_BY_ID, {"user_id": user_id, "contact_id": contact_id}).first()
     if contact:
         contact.name = body.name
         contact.surname = body.surname
@@ -159,9 +268,12 @@ async def update_contact(contact_id: int, body: ContactModel, db: Session, curre
         contact.phone = body.phone
         contact.description = contact.description
         db.commit()
+        flight.invalidate(user_id)
+        await events.publish(user_id, events.UPDATED, contact)
     return contact
 
 
+@tracing.traced
 async def remove_contact(contact_id: int, db: Session, current_user) -> Contact | None:
     """
         Removes a single contact with the specified ID for a specific user.
@@ -175,8 +287,165 @@ async def remove_contact(contact_id: int, db: Session, current_user) -> Contact
         :return: The removed contact, or None if it does not exist.
         :rtype: Contact | None
         """
-    contact = db.query(Contact).filter(Contact.user_id == current_user.id).filter(Contact.id == contact_id).first()
+    user_id = current_user.id
+    contact = db.scalars(CONTACT_BY_ID, {"user_id": user_id, "contact_id": contact_id}).first()
     if contact:
         db.delete(contact)
+        count_contact(db, user_id, contact.birth_date, -1)
         db.commit()
+        flight.invalidate(user_id)
+        await events.publish(user_id, events.DELETED, contact)
     return contact
+
+
+@tracing.traced
+async def merge_contacts(primary_id: int, duplicate_ids: list[int], db: Session, current_user) -> Contact | None:
+    """
+        Merges duplicates into one contact of a specific user in a single transaction.
+
+        Empty fields of the primary contact are filled from the duplicates, then the duplicates are removed.
+
+        :param primary_id: The ID of the contact to keep.
+        :type primary_id: int
+        :param duplicate_ids: The IDs of the contacts merged into it.
+        :type duplicate_ids: list[int]
+        :param current_user: The user to merge the contacts for.
+        :type current_user: User
+        :param db: The database session.
+        :type db: Session
+        :return: The merged contact, or None if any of the contacts does not exist.
+        :rtype: Contact | None
+        """
+    user_id = current_user.id
+    duplicate_ids = [contact_id for contact_id in dict.fromkeys(duplicate_ids) if contact_id != primary_id]
+    ids = [primary_id, *duplicate_ids]
+    contacts = {contact.id: contact for contact in db.query(Contact).filter(Contact.user_id == user_id).filter(
+        Contact.id.in_(ids)).with_for_update().all()}
+    if len(contacts) != len(ids):
+        db.rollback()
+        return None
+    primary = contacts[primary_id]
+    for contact_id in duplicate_ids:
+        duplicate = contacts[contact_id]
+        for name in MERGED_FIELDS:
+            if not getattr(primary, name) and getattr(duplicate, name):
+                setattr(primary, name, getattr(duplicate, name))
+        db.delete(duplicate)
+    count_contacts(db, user_id, [contacts[contact_id].birth_date for contact_id in duplicate_ids], -1)
+    db.commit()
+    flight.invalidate(user_id)
+    db.refresh(primary)
+    for contact_id in duplicate_ids:
+        await events.publish(user_id, events.DELETED, contacts[contact_id])
+    await events.publish(user_id, events.UPDATED, primary)
+    return primary
+
+
+@tracing.traced
+def count_contact(db: Session, user_id: int, birth_date, delta: int):
+    """
+        Adjusts the cached contact count of a user in the same transaction as the write.
+
+        Users whose counters were never computed are skipped, they are computed by reconciliation.
+
+        :param db: The database session.
+        :type db: Session
+        :param user_id: The id of the user.
+        :type user_id: int
+        :param birth_date: The birth date of the created or removed contact.
+        :type birth_date: date
+        :param delta: 1 for a created contact, -1 for a removed one.
+        :type delta: int
+        :return: Nothing.
+        :rtype: None
+        """
+    count_contacts(db, user_id, [birth_date], delta)
+
+
+@tracing.traced
+def count_contacts(db: Session, user_id: int, birth_dates, delta: int):
+    """
+        Adjusts the cached contact counts of a user for several contacts, with one update per birth month.
+
+        :param db: The database session.
+        :type db: Session
+        :param user_id: The id of the user.
+        :type user_id: int
+        :param birth_dates: The birth dates of the created or removed contacts.
+        :type birth_dates: List[date]
+        :param delta: 1 for created contacts, -1 for removed ones.
+        :type delta: int
+        :return: Nothing.
+        :rtype: None
+        """
+    months = Counter(birth_date.month for birth_date in birth_dates if birth_date is not None)
+    for month, contacts in sorted(months.items()):
+        db.query(ContactCounter).filter(ContactCounter.user_id == user_id,
+                                        ContactCounter.birth_month == month).update(
+            {ContactCounter.count: ContactCounter.count + delta * contacts}, synchronize_session=False)
+
+
+@tracing.traced
+def reconcile_contact_counters(db: Session, user_ids: list[int]):
+    """
+        Recomputes cached contact counts of users from the contacts table.
+
+        :param db: The database session.
+        :type db: Session
+        :param user_ids: The ids of the users.
+        :type user_ids: list[int]
+        :return: Nothing.
+        :rtype: None
+        """
+    birth_month = extract('month', Contact.birth_date)
+    rows = db.query(Contact.user_id, birth_month, func.count(Contact.id)).filter(
+        Contact.user_id.in_(user_ids)).group_by(Contact.user_id, birth_month).all()
+    counts = {(user_id, month): 0 for user_id in user_ids for month in range(1, 13)}
+    for user_id, month, count in rows:
+        counts[(user_id, int(month))] = count
+    statement = dialect_insert(db, ContactCounter).values(
+        [{"user_id": user_id, "birth_month": month, "count": count} for (user_id, month), count in counts.items()])
+    statement = statement.on_conflict_do_update(index_elements=[ContactCounter.user_id, ContactCounter.birth_month],
+                                                set_={"count": statement.excluded.count})
+    db.execute(statement)
+    db.commit()
+
+
+@tracing.traced
+async def get_contact_counts(db: Session, current_user) -> dict[int, int]:
+    """
+        Cached contact counts of a user by birth month, computed on first use.
+
+        :param current_user: The user to count contacts for.
+        :type current_user: User
+        :param db: The database session.
+        :type db: Session
+        :return: The number of contacts for each birth month.
+        :rtype: dict[int, int]
+        """
+    user_id = current_user.id
+    rows = db.execute(CONTACT_COUNTS, {"user_id": user_id}).all()
+    if not rows:
+        reconcile_contact_counters(db, [user_id])
+        rows = db.execute(CONTACT_COUNTS, {"user_id": user_id}).all()
+    return {month: count for month, count in rows}
+
+
+@tracing.traced
+async def get_contact_stats(db: Session, current_user, recent: int = 5) -> dict:
+    """
+        Statistics of contacts for a specific user.
+
+        :param current_user: The user to get statistics for.
+        :type current_user: User
+        :param db: The database session.
+        :type db: Session
+        :param recent: The number of recently added contacts.
+        :type recent: int
+        :return: total, counts by birth month and recently added contacts.
+        :rtype: dict
+        """
+    user_id = current_user.id
+    counts = await get_contact_counts(db, current_user)
+    recently_added = db.scalars(RECENT_CONTACTS, {"user_id": user_id, "recent": recent}).all()
+    return {"total": sum(counts.values()), "by_birth_month": counts, "recent": recently_added}
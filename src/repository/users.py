@@ -1,7 +1,45 @@
+from dataclasses import asdict, make_dataclass
+
 from libgravatar import Gravatar
+from sqlalchemy import bindparam, select
+from sqlalchemy.orm import Session, make_transient_to_detached
+from src.database.db import dialect_insert
 from src.database.models import User
+from src.services import email_filter, tracing
+from src.services.single_flight import coalesce, flight
+
+# built once, every request looks its user up with it, only the parameter changes between calls.
+# Users are read on the primary: logins and tokens must see a user as soon as it is created or changed,
+# and the loaded user is changed and committed in the request session.
+USER_BY_EMAIL = select(User).where(User.email == bindparam("email")).limit(1)
+
+# the user of an access token is looked up by every request, concurrent lookups share a frozen row
+UserRow = make_dataclass("UserRow", [column.key for column in User.__table__.columns], frozen=True)
+USER_ROW_BY_EMAIL = select(*(getattr(User, column.key) for column in User.__table__.columns)).where(
+    User.email == bindparam("email")).limit(1)
+
+
+def _commit_keeping_loaded(db, user):
+    """
+        Commits the session without expiring the user, whose attributes are still used by the request.
+
+        A commit expires every loaded attribute, reading one of them again would cost another SELECT,
+        so the user is flushed and detached first.
+
+        :param db: The database session.
+        :type db: Session
+        :param user: The user to keep, None to only commit.
+        :type user: User | None
+        :return: Nothing.
+        :rtype: None
+        """
+    db.flush()
+    if user is not None:
+        db.expunge(user)
+    db.commit()
 
 
+@tracing.traced
 async def check_exist_user(email, db):
     """
                 check exist user
@@ -13,52 +51,79 @@ async def check_exist_user(email, db):
                 :return: The user with the specified email, or None if it does not exist.
                 :rtype: User | None
                 """
-    exist_user = db.query(User).filter(User.email == email).first()
+    exist_user = db.scalars(USER_BY_EMAIL, {"email": email}).first()
     return exist_user
 
 
-async def create_new_user(body, db):
+@tracing.traced
+async def create_user_if_not_exists(body, db):
     """
-                Create a new user
+                Create a new user in a single INSERT ... ON CONFLICT (email) DO NOTHING
 
-                :param body: The detail of user.
+                :param body: The detail of user, the password must already be hashed.
                 :type body: UserModel
                 :param db: The database session.
                 :type db: Session
-                :return: The new user.
+                :return: The new user, or None if the email is already taken.
                 :rtype: User | None
                 """
-    avatar = None
+    statement = dialect_insert(db, User).values(**body.model_dump()).on_conflict_do_nothing(
+        index_elements=[User.email]).returning(User)
+    new_user = db.execute(statement).scalar_one_or_none()
+    if new_user is not None and getattr(db, "shards", None) is not None:
+        # pin the user in the same transaction, so no request has to write the placement later
+        db.shards.pin(db, new_user.id)
+    _commit_keeping_loaded(db, new_user)
+    if new_user is not None:
+        await email_filter.registered.add(new_user.email)
+    return new_user
+
+
+@tracing.traced
+async def assign_gravatar(user_id, email, bind):
+    """
+                Set gravatar as avatar of a user that has none, meant to run as a background task
+
+                :param user_id: The id of user.
+                :type user_id: int
+                :param email: the email of user.
+                :type email: str
+                :param bind: The engine to connect with.
+                :type bind: Engine
+                :return: Nothing.
+                :rtype: None
+                """
     try:
-        g = Gravatar(body.email)
-        avatar = g.get_image()
+        avatar = Gravatar(email).get_image()
+        with Session(bind=bind) as db:
+            db.query(User).filter(User.id == user_id, User.avatar.is_(None)).update(
+                {User.avatar: avatar}, synchronize_session=False)
+            db.commit()
+        flight.invalidate(email)
     except Exception as err:
         print(err)
-    new_user = User(**body.model_dump(), avatar=avatar)
-    db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
-    return new_user
 
 
-async def token_to_db(user, token, db):
+@tracing.traced
+async def update_password(user, password: str, db) -> None:
     """
-            put refresh token to db
+            Replace the password hash of a user, e.g. with one of the current hashing policy
 
-            :param token: the refresh token for user.
-            :type token: str
+            :param user: The user to update.
+            :type user: User
+            :param password: The new hash of the password.
+            :type password: str
             :param db: The database session.
             :type db: Session
-            :param user: The user to put refresh token to db for
-            :type user: User
-            :return: The user with the specified email, or None if it does not exist.
-            :rtype: User | None
+            :return: Nothing.
+            :rtype: None
             """
-    user.refresh_token = token
-    db.commit()
-    return token
+    user.password = password
+    _commit_keeping_loaded(db, user)
+    flight.invalidate(user.email)
 
 
+@tracing.traced
 async def find_user_by_email(email, db):
     """
         Get contact with the specified email for a specific user
@@ -70,10 +135,44 @@ async def find_user_by_email(email, db):
         :return: The user with the specified email, or None if it does not exist.
         :rtype: User | None
         """
-    user = db.query(User).filter(User.email == email).first()
+    user = db.scalars(USER_BY_EMAIL, {"email": email}).first()
     return user
 
 
+@tracing.traced
+@coalesce(key=lambda email, db: (email,))
+def get_authenticated_user(email, db):
+    """
+        Get the user of an access token, concurrent lookups of a user share one query
+
+        :param email: the email of user.
+        :type email: str
+        :param db: The database session.
+        :type db: Session
+        :return: A snapshot of the user with the specified email, or None if it does not exist.
+        :rtype: UserRow | None
+        """
+    row = db.execute(USER_ROW_BY_EMAIL, {"email": email}).first()
+    return UserRow(**row._mapping) if row is not None else None
+
+
+def attach_user(row, db) -> User:
+    """
+        The user of a snapshot as an instance of the session, without a query.
+
+        :param row: The snapshot of the user.
+        :type row: UserRow
+        :param db: The database session.
+        :type db: Session
+        :return: The user, its attributes are those of the snapshot.
+        :rtype: User
+        """
+    user = User(**asdict(row))
+    make_transient_to_detached(user)
+    return db.merge(user, load=False)
+
+
+@tracing.traced
 async def confirmed_email(email: str, db) -> None:
     """
         Confirmation of email
@@ -88,8 +187,10 @@ async def confirmed_email(email: str, db) -> None:
     user = await find_user_by_email(email, db)
     user.confirmed = True
     db.commit()
+    flight.invalidate(email)
 
 
+@tracing.traced
 async def update_avatar(email, url: str, db) -> User:
     """
             Update user avatar
@@ -100,9 +201,11 @@ async def update_avatar(email, url: str, db) -> User:
             :type email: str
             :param db: The database session.
             :type db: Session
-            :return: Nothing.
-            :rtype: None
+            :return: The updated user.
+            :rtype: User
             """
     user = await find_user_by_email(email, db)
     user.avatar = url
-    db.commit()
+    _commit_keeping_loaded(db, user)
+    flight.invalidate(email)
+    return user
@@ -1,27 +1,45 @@
-from fastapi import Depends, Query, APIRouter, Path, HTTPException
-from fastapi_limiter.depends import RateLimiter
+from fastapi import Depends, Query, APIRouter, Path, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
 from src.database.auth import auth_service
-from src.database.db import get_db
+from src.database.db import get_db, Deadline
 from src.database.models import User
+from src.database.query_budget import query_budget
 from src.repository import contacts as repository_contacts
-from src.schemas import ContactModel, ResponseContactModel
+from src.services.limiter import RateLimiter
+from src.schemas import ContactModel, ResponseContactModel, DuplicateGroupModel, MergeContactsModel, \
+    ContactStatsModel, BulkContactsModel, MAX_BULK_CONTACTS, MAX_MERGED_DUPLICATES
+from src.services import events, tracing
+from src.services.dedupe import find_duplicates
 from starlette import status
 
-router = APIRouter(prefix="/contacts", tags=['contacts'])
+router = APIRouter(prefix="/contacts", tags=['contacts'], route_class=tracing.TracedRoute)
 
+MAX_PAGE_SIZE = 100
+# a user has a contact counter per birth month, the budgets below count them
+BIRTH_MONTHS = 12
 
-@router.get("/")
-async def get_contacts(limit: int = Query(10, le=100), offset: int = 0, db: Session = Depends(get_db),
+
+@router.get("/", dependencies=[Depends(Deadline(3))])
+# the first count of a user computes the counters and commits, which expires the user: the user, the empty
+# counters, the months counted, the upserted counters, the counters again, the user again and the page
+@query_budget(statements=7, rows=2 + 3 * BIRTH_MONTHS + MAX_PAGE_SIZE)
+async def get_contacts(response: Response, limit: int = Query(10, le=MAX_PAGE_SIZE), offset: int = 0,
+                       include_total: bool = False, db: Session = Depends(get_db),
                        current_user: User = Depends(auth_service.get_current_user)) -> list[
     ResponseContactModel]:
     """"
         Get list of contacts with the specified number of them for a specific user.
 
+        :param response: The response, gets the X-Total-Count header if include_total is set.
+        :type response: Response
         :param offset: The number of contacts to skip.
         :type offset: int
         :param limit: The maximum number of contact to return.
         :type limit: int
+        :param include_total: Whether to return the total number of contacts.
+        :type include_total: bool
         :param current_user: The user to retrieve contacts for.
         :type current_user: User
         :param db: The database session.
@@ -29,11 +47,54 @@ async def get_contacts(limit: int = Query(10, le=100), offset: int = 0, db: Sess
         :return: A list of contacts.
         :rtype: List[Contact]
         """
-    contacts = await repository_contacts.get_contacts(limit, offset, db, current_user)
-    return contacts
+    if include_total:
+        counts = await repository_contacts.get_contact_counts(db, current_user)
+        response.headers["X-Total-Count"] = str(sum(counts.values()))
+    return await repository_contacts.get_contacts(limit, offset, db, current_user)
+
+
+@router.get("/stats", response_model=ContactStatsModel, dependencies=[Depends(Deadline(3))])
+@query_budget(statements=3, rows=18)
+async def get_contact_stats(db: Session = Depends(get_db),
+                            current_user: User = Depends(auth_service.get_current_user)):
+    """
+        Get the number of contacts, counts by birth month and recently added contacts for a specific user.
+
+        :param current_user: The user to get statistics for.
+        :type current_user: User
+        :param db: The database session.
+        :type db: Session
+        :return: The statistics.
+        :rtype: ContactStatsModel
+        """
+    return await repository_contacts.get_contact_stats(db, current_user)
+
+
+@router.get("/events", response_class=StreamingResponse)
+async def contact_events(request: Request, db: Session = Depends(get_db),
+                         current_user: User = Depends(auth_service.get_current_user)):
+    """
+        Streams created, updated and deleted contacts of a specific user as Server-Sent Events.
+
+        A resync event means some events were missed and the contacts should be reloaded.
+
+        :param request: The request, to notice the client going away.
+        :type request: Request
+        :param current_user: The user to stream the changes of.
+        :type current_user: User
+        :param db: The database session.
+        :type db: Session
+        :return: The event stream.
+        :rtype: StreamingResponse
+        """
+    # the stream may stay open for hours, don't hold a pooled connection for it
+    db.close()
+    return StreamingResponse(events.stream(current_user.id, request.is_disconnected), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 @router.get("/by_id/{contact_id}", response_model=ResponseContactModel)
+@query_budget(statements=2, rows=2)
 async def get_contact(contact_id: int = Path(description="The ID of the contact to get", gt=0, le=10),
                       db: Session = Depends(get_db), current_user: User = Depends(auth_service.get_current_user)):
     """
@@ -55,6 +116,7 @@ async def get_contact(contact_id: int = Path(description="The ID of the contact
 
 
 @router.get("/by_name/{contact_name}", response_model=ResponseContactModel)
+@query_budget(statements=2, rows=2)
 async def get_contact_by_name(contact_name: str, db: Session = Depends(get_db),
                               current_user: User = Depends(auth_service.get_current_user)):
     """
@@ -76,6 +138,7 @@ async def get_contact_by_name(contact_name: str, db: Session = Depends(get_db),
 
 
 @router.get("/by_surname/{contact_surname}")
+@query_budget(statements=2, rows=2)
 async def get_contact_by_surname(contact_surname: str, db: Session = Depends(get_db),
                                  current_user: User = Depends(auth_service.get_current_user)):
     """
@@ -98,6 +161,7 @@ async def get_contact_by_surname(contact_surname: str, db: Session = Depends(get
 
 @router.get("/by_email/{contact_email}", dependencies=[Depends(RateLimiter(times=2, seconds=5))],
             response_model=ResponseContactModel)
+@query_budget(statements=2, rows=2)
 async def get_contact_by_email(contact_email: str, db: Session = Depends(get_db),
                                current_user: User = Depends(auth_service.get_current_user)):
     """
@@ -118,7 +182,30 @@ async def get_contact_by_email(contact_email: str, db: Session = Depends(get_db)
     return contact
 
 
-@router.get("/get_birthdays")
+@router.get("/by_phone/{contact_phone}", response_model=ResponseContactModel)
+@query_budget(statements=2, rows=2)
+async def get_contact_by_phone(contact_phone: str, db: Session = Depends(get_db),
+                               current_user: User = Depends(auth_service.get_current_user)):
+    """
+                Get contact with the specified phone for a specific user.
+
+                :param contact_phone: The phone of the contact to get, in any format.
+                :type contact_phone: str
+                :param current_user: The user to get the contact for.
+                :type current_user: User
+                :param db: The database session.
+                :type db: Session
+                :return: The contact with the specified phone, or None if it does not exist.
+                :rtype: Contact | None
+                """
+    contact = await repository_contacts.get_contact_by_phone(contact_phone, db, current_user)
+    if contact is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Not found')
+    return contact
+
+
+@router.get("/get_birthdays", dependencies=[Depends(Deadline(3))])
+@query_budget(statements=2)
 async def get_birthdays(db: Session = Depends(get_db), current_user: User = Depends(auth_service.get_current_user)):
     """
         Get contacts with the specified birthdays for a specific user.
@@ -136,8 +223,49 @@ async def get_birthdays(db: Session = Depends(get_db), current_user: User = Depe
     return contact
 
 
+@router.get("/duplicates", response_model=list[DuplicateGroupModel],
+            dependencies=[Depends(RateLimiter(times=1, seconds=10)), Depends(Deadline(15))])
+@query_budget(statements=2)
+async def get_duplicates(db: Session = Depends(get_db), current_user: User = Depends(auth_service.get_current_user)):
+    """
+        Get groups of probable duplicate contacts with merge suggestions for a specific user.
+
+        :param current_user: The user to find duplicates for.
+        :type current_user: User
+        :param db: The database session.
+        :type db: Session
+        :return: Duplicate groups, the most certain first.
+        :rtype: List[DuplicateGroupModel]
+        """
+    return await run_in_threadpool(find_duplicates, db, current_user.id)
+
+
+@router.post("/merge", response_model=ResponseContactModel)
+# the user, the locked contacts, a counter update per month, one DELETE for the duplicates and the refresh
+@query_budget(statements=4 + BIRTH_MONTHS, rows=3 + 2 * MAX_MERGED_DUPLICATES + BIRTH_MONTHS)
+async def merge_contacts(body: MergeContactsModel, db: Session = Depends(get_db),
+                         current_user: User = Depends(auth_service.get_current_user)):
+    """
+        Merges duplicate contacts into one for a specific user.
+
+        :param body: The contact to keep and the duplicates to merge into it.
+        :type body: MergeContactsModel
+        :param current_user: The user to merge the contacts for.
+        :type current_user: User
+        :param db: The database session.
+        :type db: Session
+        :return: The merged contact.
+        :rtype: Contact
+        """
+    contact = await repository_contacts.merge_contacts(body.primary_id, body.duplicate_ids, db, current_user)
+    if contact is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Contact not found")
+    return contact
+
+
 @router.post("/contact", response_model=ResponseContactModel, status_code=status.HTTP_201_CREATED,
              dependencies=[Depends(RateLimiter(times=2, seconds=5))])
+@query_budget(statements=4, rows=4)
 async def create_contact(contact: ContactModel, db: Session = Depends(get_db),
                          current_user: User = Depends(auth_service.get_current_user)):
     new_contact = await repository_contacts.create_contacts(contact, db, current_user)
@@ -145,7 +273,30 @@ async def create_contact(contact: ContactModel, db: Session = Depends(get_db),
     return new_contact
 
 
+@router.post("/bulk", response_model=list[ResponseContactModel], status_code=status.HTTP_201_CREATED,
+             dependencies=[Depends(RateLimiter(times=2, seconds=5))])
+# the user, a counter update per month, the INSERTs and the reload of the contacts; SQLite inserts the contacts
+# one by one, PostgreSQL in one statement, so the budget allows an INSERT per contact
+@query_budget(statements=2 + BIRTH_MONTHS + MAX_BULK_CONTACTS, rows=1 + BIRTH_MONTHS + MAX_BULK_CONTACTS)
+async def create_contacts_bulk(body: BulkContactsModel, db: Session = Depends(get_db),
+                               current_user: User = Depends(auth_service.get_current_user)):
+    """
+        Creates up to MAX_BULK_CONTACTS contacts at once for a specific user.
+
+        :param body: The contacts to create.
+        :type body: BulkContactsModel
+        :param current_user: The user to create the contacts for.
+        :type current_user: User
+        :param db: The database session.
+        :type db: Session
+        :return: The newly created contacts.
+        :rtype: List[Contact]
+        """
+    return await repository_contacts.create_contacts_bulk(body.contacts, db, current_user)
+
+
 @router.put("/{contact_id}", response_model=ResponseContactModel)
+@query_budget(statements=4, rows=4)
 async def update_contact(body: ContactModel, contact_id: int, db: Session = Depends(get_db),
                          current_user: User = Depends(auth_service.get_current_user)):
     """
@@ -169,6 +320,7 @@ async def update_contact(body: ContactModel, contact_id: int, db: Session = Depe
 
 
 @router.delete("/{contact_id}", response_model=ResponseContactModel)
+@query_budget(statements=4, rows=4)
 async def remove_contact(contact_id: int, db: Session = Depends(get_db),
                          current_user: User = Depends(auth_service.get_current_user)):
     """
@@ -1,22 +1,29 @@
+import uuid
+
 import cloudinary
 import cloudinary.uploader
-from fastapi import Depends, HTTPException, status, APIRouter, Security, BackgroundTasks, Request, UploadFile, File
+from fastapi import Depends, HTTPException, status, APIRouter, Security, BackgroundTasks, Request, UploadFile, File, \
+    Header
 from fastapi.security import OAuth2PasswordRequestForm, HTTPAuthorizationCredentials, HTTPBearer
-from fastapi_limiter.depends import RateLimiter
 from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
 from src.conf.config import config
 from src.database.auth import auth_service
 from src.database.db import get_db
 from src.database.models import User
+from src.database.query_budget import query_budget
 from src.repository import users as repository_users
 from src.schemas import UserModel, RequestEmail
+from src.services import email_filter, token_store, tracing
 from src.services.email import send_email
+from src.services.limiter import RateLimiter
 
-router = APIRouter(prefix="/users", tags=['users'])
+router = APIRouter(prefix="/users", tags=['users'], route_class=tracing.TracedRoute)
 security = HTTPBearer()
 
 
 @router.get("/me/")
+@query_budget(statements=1, rows=1)
 async def read_users_me(current_user: User = Depends(auth_service.get_current_user)):
     """
        Get a user that authenticated
@@ -30,6 +37,7 @@ async def read_users_me(current_user: User = Depends(auth_service.get_current_us
 
 
 @router.patch('/avatar')
+@query_budget(statements=3, rows=3)
 async def update_avatar_user(file: UploadFile = File(), current_user: User = Depends(auth_service.get_current_user),
                              db: Session = Depends(get_db)):
     """
@@ -50,16 +58,17 @@ async def update_avatar_user(file: UploadFile = File(), current_user: User = Dep
         api_secret=config.CLD_API_SECRET,
         secure=True,
     )
-    r = cloudinary.uploader.upload(file.file, public_id=f'NotesApp/{current_user.username}', overwrite=True)
+    with tracing.span("cloudinary upload", "client"):
+        r = cloudinary.uploader.upload(file.file, public_id=f'NotesApp/{current_user.username}', overwrite=True)
     src_url = cloudinary.CloudinaryImage(f'NotesApp/{current_user.username}') \
         .build_url(width=250, height=250, crop='fill', version=r.get('version'))
 
-    await repository_users.update_avatar(current_user.email, src_url, db)
-    user = await repository_users.find_user_by_email(current_user.email, db)
+    user = await repository_users.update_avatar(current_user.email, src_url, db)
     return {"user": user}
 
 
 @router.post("/signup", status_code=status.HTTP_201_CREATED)
+@query_budget(statements=3, rows=3)
 async def signup(body: UserModel, bt: BackgroundTasks, request: Request, db: Session = Depends(get_db)):
     """
                 Sign up
@@ -75,42 +84,64 @@ async def signup(body: UserModel, bt: BackgroundTasks, request: Request, db: Ses
                 :return: user that sign up.
                 :rtype: User | None
                 """
-    exist_user = await repository_users.check_exist_user(body.email, db)
-    if exist_user:
+    # hashing is slow on purpose, an existing account is turned away before it; the filter saves the lookup
+    # for most new emails, the insert still catches a signup racing this one
+    if (await email_filter.registered.might_exist(body.email)
+            and await repository_users.check_exist_user(body.email, db) is not None):
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Account already exists")
+    body.password = await run_in_threadpool(auth_service.get_password_hash, body.password)
+    new_user = await repository_users.create_user_if_not_exists(body, db)
+    if new_user is None:
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Account already exists")
-    body.password = auth_service.get_password_hash(body.password)
-    new_user = await repository_users.create_new_user(body, db)
+    bt.add_task(repository_users.assign_gravatar, new_user.id, new_user.email, db.get_bind())
     bt.add_task(send_email, new_user.email, new_user.username, str(request.base_url))
     return {"new_user": new_user}
 
 
 @router.post("/login", status_code=status.HTTP_201_CREATED)
-async def login(body: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+@query_budget(statements=5)
+async def login(body: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db),
+                device_id: str | None = Header(None, alias="X-Device-Id", max_length=64)):
     """
                     Login
 
                     :param body: detail of user.
                     :type body: OAuth2PasswordRequestForm
+                    :param device_id: id of the device, a new login on the same device replaces its tokens.
+                    :type device_id: str
                     :param db: The database session.
                     :type db: Session
                     :return: user that login.
                     :rtype: dict | None
                     """
+    # unknown emails, most of them guesses, are turned away before the database and the password hash
+    if not await email_filter.registered.might_exist(body.username):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid email")
     user = await repository_users.check_exist_user(body.username, db)
     if user is None:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid email")
     if not user.confirmed:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Email not confirmed")
-    if not auth_service.verify_password(body.password, user.password):
+    # hashing is slow on purpose, it must not block the event loop
+    verified, new_hash = await run_in_threadpool(auth_service.verify_and_update_password, body.password,
+                                                 user.password)
+    if not verified:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid password")
+    if new_hash is not None:
+        await repository_users.update_password(user, new_hash, db)
     # Generate JWT
     access_token = await auth_service.create_access_token(data={"sub": user.email})
-    refresh_token = await auth_service.create_refresh_token(data={"sub": user.email})
-    user.refresh_token = await repository_users.token_to_db(user, refresh_token, db)
-    return {"access_token": access_token, "token_type": "bearer", "refresh": user.refresh_token}
+    family_id = f"{user.id}:{device_id}" if device_id else uuid.uuid4().hex
+    jti = uuid.uuid4().hex
+    refresh_token = await auth_service.create_refresh_token(
+        data={"sub": user.email, "uid": user.id, "fid": family_id, "jti": jti},
+        expires_delta=config.REFRESH_TOKEN_TTL)
+    await token_store.store.issue(user.id, family_id, jti, config.REFRESH_TOKEN_TTL, db)
+    return {"access_token": access_token, "token_type": "bearer", "refresh": refresh_token}
 
 
 @router.get('/refresh_token', dependencies=[Depends(RateLimiter(times=2, seconds=5))])
+@query_budget(statements=2, rows=2)
 async def refresh_token(credentials: HTTPAuthorizationCredentials = Security(security), db: Session = Depends(get_db)):
     """
                     Get a refresh token
@@ -123,19 +154,46 @@ async def refresh_token(credentials: HTTPAuthorizationCredentials = Security(sec
                     :rtype: dict | None
                     """
     token = credentials.credentials
-    email = await auth_service.decode_refresh_token(token)
-    user = await repository_users.find_user_by_email(email, db)
-    if user.refresh_token != token:
-        user.refresh_token = await repository_users.token_to_db(user, None, db)
+    payload = await auth_service.decode_refresh_token(token)
+    email, user_id, family_id = payload["sub"], payload.get("uid"), payload.get("fid")
+    if family_id is None:
+        # issued before token families, it can't be checked for reuse, the user just logs in again
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid refresh token")
+    new_jti = uuid.uuid4().hex
+    rotated = await token_store.store.rotate(user_id, family_id, payload.get("jti"), new_jti,
+                                             config.REFRESH_TOKEN_TTL, db)
+    if not rotated:
+        auth_service.revoke_token(token)
+        auth_service.revoke_user_tokens(email)
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid refresh token")
 
     access_token = await auth_service.create_access_token(data={"sub": email})
-    refresh_token = await auth_service.create_refresh_token(data={"sub": email})
-    user.refresh_token = await repository_users.token_to_db(user, refresh_token, db)
+    refresh_token = await auth_service.create_refresh_token(
+        data={"sub": email, "uid": user_id, "fid": family_id, "jti": new_jti},
+        expires_delta=config.REFRESH_TOKEN_TTL)
     return {"access_token": access_token, "refresh_token": refresh_token, "token_type": "bearer"}
 
 
+@router.post('/logout_all')
+@query_budget(statements=2)
+async def logout_all(current_user: User = Depends(auth_service.get_current_user), db: Session = Depends(get_db)):
+    """
+                    Revoke refresh tokens of all devices of the user
+
+                    :param current_user: The user to log out.
+                    :type current_user: User
+                    :param db: The database session.
+                    :type db: Session
+                    :return: The message.
+                    :rtype: dict
+                    """
+    await token_store.store.revoke_user(current_user.id, db)
+    auth_service.revoke_user_tokens(current_user.email)
+    return {"message": "Logged out from all devices"}
+
+
 @router.get('/confirmed_email/{token}')
+@query_budget(statements=3, rows=3)
 async def confirmed_email(token: str, db: Session = Depends(get_db)):
     """
                     Check confirmed email
@@ -158,6 +216,7 @@ async def confirmed_email(token: str, db: Session = Depends(get_db)):
 
 
 @router.post('/request_email')
+@query_budget(statements=1, rows=1)
 async def request_email(body: RequestEmail, bt: BackgroundTasks, request: Request,
                         db: Session = Depends(get_db)):
     """
@@ -174,12 +233,12 @@ async def request_email(body: RequestEmail, bt: BackgroundTasks, request: Reques
                 :return: user that sign up.
                 :rtype: dict | None
                 """
+    if not await email_filter.registered.might_exist(body.email):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid email")
     user = await repository_users.find_user_by_email(body.email, db)
-
+    if user is None:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid email")
     if user.confirmed:
         return {"message": "Your email is already confirmed"}
-    if user:
-        bt.add_task(send_email, user.email, user.username, str(request.base_url))
-        return {"message": "Check your email for confirmation."}
-    else:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid email")
+    bt.add_task(send_email, user.email, user.username, str(request.base_url))
+    return {"message": "Check your email for confirmation."}
@@ -2,6 +2,9 @@ from datetime import datetime, date
 
 from pydantic import BaseModel, EmailStr, Field
 
+MAX_BULK_CONTACTS = 100
+MAX_MERGED_DUPLICATES = 100
+
 
 class ContactModel(BaseModel):
     name: str
@@ -37,3 +40,34 @@ class UserModel(BaseModel):
 
 class RequestEmail(BaseModel):
     email: EmailStr
+
+
+class MergedContactModel(BaseModel):
+    name: str | None
+    surname: str | None
+    email: str | None
+    phone: str | None
+    description: str | None
+    birth_date: date | None
+
+
+class DuplicateGroupModel(BaseModel):
+    contact_ids: list[int]
+    score: float
+    primary_id: int
+    merged: MergedContactModel
+
+
+class MergeContactsModel(BaseModel):
+    primary_id: int = Field(ge=1)
+    duplicate_ids: list[int] = Field(min_length=1, max_length=MAX_MERGED_DUPLICATES)
+
+
+class BulkContactsModel(BaseModel):
+    contacts: list[ContactModel] = Field(min_length=1, max_length=MAX_BULK_CONTACTS)
+
+
+class ContactStatsModel(BaseModel):
+    total: int
+    by_birth_month: dict[int, int]
+    recent: list[ResponseContactModel]
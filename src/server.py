@@ -0,0 +1,101 @@
+"""
+Production launcher.
+
+Run with ``python -m src.server --workers 4 --db-connections 80``. Every worker
+gets an equal share of the database connection budget, so adding workers never
+oversubscribes Postgres.
+"""
+import argparse
+import importlib.util
+import os
+
+import uvicorn
+
+from src.conf.config import config
+
+APP = "main:app"
+
+
+def pool_budget(connections: int, workers: int, overflow_ratio: float = 0.25) -> tuple[int, int]:
+    """
+        Pool size and overflow of each worker for a budget of connections to one database.
+
+        :param connections: The connections all workers may open together.
+        :type connections: int
+        :param workers: The number of workers.
+        :type workers: int
+        :param overflow_ratio: The part of each share kept for bursts.
+        :type overflow_ratio: float
+        :return: pool_size and max_overflow of a worker.
+        :rtype: tuple[int, int]
+        """
+    share = connections // workers
+    if share < 1:
+        raise ValueError(f"{connections} connections can't be shared by {workers} workers")
+    max_overflow = int(share * overflow_ratio)
+    return share - max_overflow, max_overflow
+
+
+def default_workers(connections: int, min_connections: int = 2) -> int:
+    """
+        2 * CPUs + 1 workers, fewer if the budget would leave a worker under `min_connections`.
+        """
+    return max(1, min((os.cpu_count() or 1) * 2 + 1, connections // min_connections))
+
+
+def apply_pool_budget(pool_size: int, max_overflow: int):
+    """
+        Sizes the engine of this process and of the workers it starts.
+
+        Workers are new processes that read their settings from the environment,
+        the settings of this process are updated for a worker running in it.
+
+        :param pool_size: The pool size of a worker.
+        :type pool_size: int
+        :param max_overflow: The max overflow of a worker.
+        :type max_overflow: int
+        :return: Nothing.
+        :rtype: None
+        """
+    warmup = min(config.DB_POOL_WARMUP, pool_size)
+    for name, value in (("DB_POOL_SIZE", pool_size), ("DB_MAX_OVERFLOW", max_overflow), ("DB_POOL_WARMUP", warmup)):
+        os.environ[name] = str(value)
+        setattr(config, name, value)
+
+
+def fastest(module: str, fallback: str) -> str:
+    return module if importlib.util.find_spec(module) is not None else fallback
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the API with several workers")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--db-connections", type=int, default=config.DB_CONNECTION_BUDGET,
+                        help="connections to each database (primary and every replica) shared by all workers")
+    parser.add_argument("--workers", type=int, default=None, help="default: 2 * CPUs + 1 within the budget")
+    parser.add_argument("--max-requests", type=int, default=config.WORKER_MAX_REQUESTS,
+                        help="restart a worker after this many requests, 0 to never restart")
+    parser.add_argument("--max-requests-jitter", type=int, default=config.WORKER_MAX_REQUESTS_JITTER,
+                        help="random extra requests, so that workers don't restart together")
+    parser.add_argument("--graceful-timeout", type=int, default=30)
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args(argv)
+
+    workers = args.workers or default_workers(args.db_connections)
+    pool_size, max_overflow = pool_budget(args.db_connections, workers)
+    apply_pool_budget(pool_size, max_overflow)
+    print(f"{workers} workers with pool_size={pool_size} max_overflow={max_overflow} each")
+
+    # import the app once here, with the final pool sizes: a broken app fails now rather than in every
+    # worker, and a single worker serves this instance. Nothing connects on import, so that is safe.
+    import main as application
+
+    uvicorn.run(application.app if workers == 1 else APP, host=args.host, port=args.port, workers=workers,
+                loop=fastest("uvloop", "asyncio"), http=fastest("httptools", "h11"),
+                limit_max_requests=args.max_requests or None, limit_max_requests_jitter=args.max_requests_jitter,
+                timeout_graceful_shutdown=args.graceful_timeout, proxy_headers=True, log_level=args.log_level)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+import asyncio
+import heapq
+import itertools
+import math
+import time
+
+from starlette.responses import JSONResponse
+
+AUTH, DEFAULT, BULK = 0, 1, 2
+CLASS_NAMES = {AUTH: "auth", DEFAULT: "default", BULK: "bulk"}
+
+AUTH_PATHS = ("/api/users/login", "/api/users/refresh_token", "/api/users/signup")
+BULK_PATHS = ("/api/contacts/duplicates", "/api/contacts/stats", "/api/contacts/bulk")
+# the event stream of contacts stays open as long as the client listens, it would hold a slot all that time
+EXEMPT_PATHS = ("/api/healthchecker", "/api/contacts/events", "/docs", "/openapi.json")
+
+
+def classify(path: str) -> int | None:
+    """
+        Priority class of a route, lower goes first; None for routes that are never queued.
+
+        :param path: The request path.
+        :type path: str
+        :return: AUTH, DEFAULT or BULK, None for EXEMPT_PATHS.
+        :rtype: int | None
+        """
+    if path.startswith(EXEMPT_PATHS):
+        return None
+    if path.startswith(AUTH_PATHS):
+        return AUTH
+    if path.startswith(BULK_PATHS):
+        return BULK
+    return DEFAULT
+
+
+class Overloaded(Exception):
+    pass
+
+
+class RouteClass:
+    """
+        Concurrency limit and latency of the routes of one priority class.
+        """
+
+    def __init__(self, limit: int):
+        self.limit = float(limit)
+        self.in_flight = 0
+        self.latency = None
+        self.last_decrease = 0.0
+
+    def stats(self) -> dict:
+        return {"limit": int(self.limit), "in_flight": self.in_flight,
+                "latency_ms": round((self.latency or 0) * 1000, 3)}
+
+
+class AdmissionController:
+    """
+        Concurrency limit with a bounded priority queue and a latency-driven limit per route class.
+
+        Every class has its own limit and latency average, so slow bulk routes don't
+        shrink the limit of logins. A class limit grows by one per `limit` completions
+        while its latency stays under the target and shrinks by 10% (at most once per
+        target interval) when it doesn't; all classes together never run more than
+        `limit` requests. Queued requests are admitted as soon as their class has room,
+        also when its limit grows. When the queue is full a request pushes out a queued
+        request of lower priority, bulk requests may only use a quarter of the queue.
+        """
+
+    def __init__(self, limit: int, min_limit: int = 1, queue_size: int = 100, queue_timeout: float = 2.0,
+                 target_latency: float = 0.5):
+        self.max_limit = limit
+        self.min_limit = min(min_limit, limit)
+        self.classes = {priority: RouteClass(limit) for priority in CLASS_NAMES}
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.target_latency = target_latency
+        self.shed = 0
+        self._waiters = []
+        self._counter = itertools.count()
+
+    @property
+    def in_flight(self) -> int:
+        return sum(route_class.in_flight for route_class in self.classes.values())
+
+    def max_queue(self, priority: int) -> int:
+        return max(self.queue_size // 4, 1) if priority == BULK else self.queue_size
+
+    def _has_room(self, priority: int) -> bool:
+        route_class = self.classes[priority]
+        return route_class.in_flight < int(route_class.limit) and self.in_flight < self.max_limit
+
+    async def acquire(self, priority: int = DEFAULT):
+        """
+            Waits for a slot.
+
+            :param priority: AUTH, DEFAULT or BULK.
+            :type priority: int
+            :raises Overloaded: If the request is shed.
+            :return: Nothing.
+            :rtype: None
+            """
+        queued = any(waiter[0] == priority and not waiter[2].done() for waiter in self._waiters)
+        if self._has_room(priority) and not queued:
+            self.classes[priority].in_flight += 1
+            return
+        self._make_room(priority)
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), future))
+        try:
+            await asyncio.wait_for(future, self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.shed += 1
+            raise Overloaded()
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release(priority, None)
+            raise
+
+    def _make_room(self, priority: int):
+        self._waiters = [waiter for waiter in self._waiters if not waiter[2].done()]
+        heapq.heapify(self._waiters)
+        if priority == BULK:
+            queued = sum(1 for waiter in self._waiters if waiter[0] == BULK)
+            if queued >= self.max_queue(BULK) or len(self._waiters) >= self.queue_size:
+                self.shed += 1
+                raise Overloaded()
+            return
+        if len(self._waiters) < self.queue_size:
+            return
+        worst = max(self._waiters)
+        if worst[0] <= priority:
+            self.shed += 1
+            raise Overloaded()
+        self._waiters.remove(worst)
+        heapq.heapify(self._waiters)
+        worst[2].set_exception(Overloaded())
+        self.shed += 1
+
+    def release(self, priority: int, latency: float | None):
+        """
+            Frees a slot and admits the queued requests that have room now.
+
+            :param priority: The class of the request, AUTH, DEFAULT or BULK.
+            :type priority: int
+            :param latency: How long the request took, None if it didn't run.
+            :type latency: float | None
+            :return: Nothing.
+            :rtype: None
+            """
+        route_class = self.classes[priority]
+        route_class.in_flight -= 1
+        if latency is not None:
+            self._observe(route_class, latency)
+        self._wake()
+
+    def _wake(self):
+        # first come first served within a class, a class without room doesn't hold up the others
+        waiting = []
+        while self._waiters:
+            waiter = heapq.heappop(self._waiters)
+            priority, _, future = waiter
+            if future.done():
+                continue
+            if self._has_room(priority):
+                self.classes[priority].in_flight += 1
+                future.set_result(None)
+                continue
+            waiting.append(waiter)
+            if self.in_flight >= self.max_limit:
+                break
+        waiting.extend(self._waiters)
+        heapq.heapify(waiting)
+        self._waiters = waiting
+
+    def _observe(self, route_class: RouteClass, latency: float):
+        route_class.latency = latency if route_class.latency is None else 0.9 * route_class.latency + 0.1 * latency
+        now = time.monotonic()
+        if route_class.latency > self.target_latency:
+            if now - route_class.last_decrease >= self.target_latency:
+                route_class.limit = max(self.min_limit, route_class.limit * 0.9)
+                route_class.last_decrease = now
+        else:
+            route_class.limit = min(self.max_limit, route_class.limit + 1 / route_class.limit)
+
+    def retry_after(self, priority: int = DEFAULT) -> int:
+        route_class = self.classes[priority]
+        latency = route_class.latency or self.target_latency
+        return max(1, math.ceil(latency * (len(self._waiters) + 1) / max(int(route_class.limit), 1)))
+
+    def stats(self) -> dict:
+        return {"limit": self.max_limit, "in_flight": self.in_flight, "queued": len(self._waiters), "shed": self.shed,
+                "classes": {CLASS_NAMES[priority]: route_class.stats()
+                            for priority, route_class in self.classes.items()}}
+
+
+class AdmissionMiddleware:
+    """
+        Sheds requests with 503 and Retry-After when the controller has no room for them.
+        """
+
+    def __init__(self, app, controller: AdmissionController, classifier=classify):
+        self.app = app
+        self.controller = controller
+        self.classifier = classifier
+
+    async def __call__(self, scope, receive, send):
+        priority = self.classifier(scope["path"]) if scope["type"] == "http" else None
+        if priority is None:
+            await self.app(scope, receive, send)
+            return
+        try:
+            await self.controller.acquire(priority)
+        except Overloaded:
+            response = JSONResponse({"detail": "Service is overloaded, try again later"}, status_code=503,
+                                    headers={"Retry-After": str(self.controller.retry_after(priority))})
+            await response(scope, receive, send)
+            return
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.controller.release(priority, time.perf_counter() - start)
@@ -0,0 +1,272 @@
+"""
+Daily birthday reminders.
+
+Run once (e.g. from cron) with ``python -m src.services.birthdays`` or keep it
+running with ``--daemon`` to send the digests every day at BIRTHDAY_RUN_HOUR; a failed
+run is retried with backoff until every digest of the day is sent.
+"""
+import argparse
+import asyncio
+import calendar
+import heapq
+import json
+import os
+from datetime import date, datetime, timedelta
+from itertools import groupby, islice
+from pathlib import Path
+
+from sqlalchemy import and_, extract, or_, select
+from sqlalchemy.orm import Session
+from src.conf.config import config
+from src.database.db import DBSession
+from src.database.models import Contact, User
+from src.services.email import send_birthday_digests
+
+
+def upcoming_birthdays(today: date, days: int):
+    """
+        Filter for contacts with birthday between today and `days` days later, across month ends.
+
+        :param today: The first day of the window.
+        :type today: date
+        :param days: The length of the window in days.
+        :type days: int
+        :return: The filter clause.
+        :rtype: ColumnElement
+        """
+    birth_month = extract('month', Contact.birth_date)
+    birth_day = extract('day', Contact.birth_date)
+    dates = []
+    for day in (today + timedelta(days=i) for i in range(days + 1)):
+        dates.append((day.month, day.day))
+        # birthdays on February 29 are celebrated on February 28 in other years
+        if (day.month, day.day) == (2, 28) and not calendar.isleap(day.year):
+            dates.append((2, 29))
+    return or_(*[and_(birth_month == month, birth_day == day) for month, day in dates])
+
+
+def iter_digests(db: Session, today: date, days: int, after_user_id: int = 0, yield_per: int = 1000):
+    """
+        Upcoming birthdays of all users in one query, streamed and grouped by user.
+
+        :param db: The database session.
+        :type db: Session
+        :param today: The first day of the window.
+        :type today: date
+        :param days: The length of the window in days.
+        :type days: int
+        :param after_user_id: Users up to this id are skipped.
+        :type after_user_id: int
+        :param yield_per: The number of rows fetched at once.
+        :type yield_per: int
+        :return: dicts with user_id, email, username and contacts, ordered by user_id.
+        :rtype: Iterator[dict]
+        """
+    shards = getattr(db, "shards", None)
+    if shards is not None:
+        yield from _iter_sharded_digests(db, shards, today, days, after_user_id, yield_per)
+        return
+    statement = select(User.id, User.email, User.username, Contact.name, Contact.surname, Contact.birth_date) \
+        .join(Contact, Contact.user_id == User.id) \
+        .where(User.id > after_user_id, upcoming_birthdays(today, days)) \
+        .order_by(User.id, Contact.id) \
+        .execution_options(yield_per=yield_per)
+    for user_id, rows in groupby(db.execute(statement), key=lambda row: row.id):
+        rows = list(rows)
+        yield _digest(user_id, rows[0].email, rows[0].username, rows)
+
+
+def _iter_sharded_digests(db: Session, shards, today: date, days: int, after_user_id: int, yield_per: int):
+    # contacts and users live in different databases: merge the contacts of every shard by user,
+    # then look the users up in batches
+    streams = []
+    for shard in shards.engines:
+        db.info["shard"] = shard
+        streams.append(db.execute(
+            select(Contact.user_id, Contact.name, Contact.surname, Contact.birth_date)
+            .where(Contact.user_id > after_user_id, upcoming_birthdays(today, days))
+            .order_by(Contact.user_id, Contact.id)
+            .execution_options(yield_per=yield_per)))
+    db.info.pop("shard", None)
+    groups = ((user_id, list(rows)) for user_id, rows in groupby(heapq.merge(*streams, key=lambda row: row.user_id),
+                                                                  key=lambda row: row.user_id))
+    while batch := list(islice(groups, yield_per)):
+        users = {user.id: user for user in db.execute(
+            select(User.id, User.email, User.username).where(User.id.in_([user_id for user_id, _ in batch])))}
+        for user_id, rows in batch:
+            user = users.get(user_id)
+            if user is not None:
+                yield _digest(user_id, user.email, user.username, rows)
+
+
+def _digest(user_id: int, email: str, username: str, rows) -> dict:
+    return {
+        "user_id": user_id,
+        "email": email,
+        "username": username,
+        "contacts": [{"name": row.name, "surname": row.surname, "birth_date": row.birth_date.isoformat()}
+                     for row in rows],
+    }
+
+
+class DigestsNotSent(Exception):
+    """
+        Some digests of a batch weren't sent, the next run of the day sends them again.
+        """
+
+
+def load_checkpoint(path: Path, today: date) -> tuple[int, set[int]]:
+    """
+        Progress of today's run: the user up to which every digest was sent, 0 if today's run hasn't started,
+        and the users after it whose digests were sent.
+        """
+    try:
+        checkpoint = json.loads(path.read_text())
+    except (FileNotFoundError, ValueError):
+        return 0, set()
+    if checkpoint.get("date") != today.isoformat():
+        return 0, set()
+    return checkpoint["user_id"], set(checkpoint.get("sent", []))
+
+
+def save_checkpoint(path: Path, today: date, user_id: int, sent: set[int] = frozenset()):
+    """
+        Writes the progress of today's run, replacing the file at once so a crash never leaves half of it.
+
+        :param path: The checkpoint file.
+        :type path: Path
+        :param today: The day of the run.
+        :type today: date
+        :param user_id: Every digest up to this user was sent.
+        :type user_id: int
+        :param sent: Users after `user_id` whose digests were sent.
+        :type sent: set[int]
+        :return: Nothing.
+        :rtype: None
+        """
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps({"date": today.isoformat(), "user_id": user_id, "sent": sorted(sent)}))
+    os.replace(tmp, path)
+
+
+async def run(today: date | None = None, days: int = config.BIRTHDAY_WINDOW_DAYS,
+              batch_size: int = config.BIRTHDAY_BATCH_SIZE, checkpoint: Path = Path(config.BIRTHDAY_CHECKPOINT_FILE),
+              session_factory=DBSession, send=send_birthday_digests) -> int:
+    """
+        Sends today's birthday digests in batches, resuming after the last checkpoint.
+
+        Progress is saved after every batch, per digest, so a resumed run sends only the digests
+        that weren't sent. When some digests of a batch fail the run stops with DigestsNotSent.
+
+        :param today: The day of the run.
+        :type today: date
+        :param days: The length of the window in days.
+        :type days: int
+        :param batch_size: The number of digests sent between checkpoints.
+        :type batch_size: int
+        :param checkpoint: The file with progress of the run.
+        :type checkpoint: Path
+        :param session_factory: Creates the database session.
+        :type session_factory: sessionmaker
+        :param send: Sends a batch of digests, returns the error of every digest or None.
+        :type send: Callable
+        :return: The number of digests sent.
+        :rtype: int
+        """
+    today = today or date.today()
+    done, sent_ahead = load_checkpoint(checkpoint, today)
+    sent = 0
+
+    async def send_batch(batch):
+        # digests sent by an earlier run of the day are in the batch only to move the checkpoint past them
+        nonlocal done, sent
+        pending = [digest for digest in batch if digest["user_id"] not in sent_ahead]
+        results = dict(zip([digest["user_id"] for digest in pending], await send(pending) if pending else []))
+        failed = {user_id: result for user_id, result in results.items() if result is not None}
+        for digest in batch:
+            if digest["user_id"] in failed:
+                break
+            done = digest["user_id"]
+        sent_ahead.update(user_id for user_id, result in results.items() if result is None)
+        sent_ahead.difference_update([user_id for user_id in sent_ahead if user_id <= done])
+        save_checkpoint(checkpoint, today, done, sent_ahead)
+        sent += len(results) - len(failed)
+        if failed:
+            user_id, error = next(iter(failed.items()))
+            raise DigestsNotSent(f"{len(failed)} of {len(results)} birthday digests weren't sent, "
+                                 f"first to user {user_id}") from error
+
+    with session_factory() as db:
+        batch, pending = [], 0
+        for digest in iter_digests(db, today, days, after_user_id=done):
+            batch.append(digest)
+            pending += digest["user_id"] not in sent_ahead
+            if pending >= batch_size:
+                await send_batch(batch)
+                batch, pending = [], 0
+        if batch:
+            await send_batch(batch)
+    return sent
+
+
+async def run_until_sent(today: date, deadline: datetime, retry_delay: float = config.BIRTHDAY_RETRY_DELAY,
+                         max_retry_delay: float = config.BIRTHDAY_MAX_RETRY_DELAY, job=run) -> int | None:
+    """
+        Runs the job of a day and retries it with backoff until its checkpoint is complete.
+
+        :param today: The day of the run.
+        :type today: date
+        :param deadline: When to give up, the next run of the job.
+        :type deadline: datetime
+        :param retry_delay: The first delay between runs in seconds, it doubles after every failure.
+        :type retry_delay: float
+        :param max_retry_delay: The longest delay between runs in seconds.
+        :type max_retry_delay: float
+        :param job: Sends the digests of a day.
+        :type job: Callable
+        :return: The number of digests sent by the last run, None if the deadline came first.
+        :rtype: int | None
+        """
+    delay = retry_delay
+    while True:
+        try:
+            return await job(today=today)
+        except Exception as err:
+            print(err)
+        if datetime.now() + timedelta(seconds=delay) >= deadline:
+            return None
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, max_retry_delay)
+
+
+async def run_daily(hour: int = config.BIRTHDAY_RUN_HOUR):
+    """
+        Runs the job every day at `hour`, retrying a failed run until the next one.
+        """
+    while True:
+        now = datetime.now()
+        next_run = now.replace(hour=hour, minute=0, second=0, microsecond=0)
+        if next_run <= now:
+            next_run += timedelta(days=1)
+        await asyncio.sleep((next_run - now).total_seconds())
+        sent = await run_until_sent(next_run.date(), next_run + timedelta(days=1))
+        if sent is not None:
+            print(f"Sent {sent} birthday digests")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Send upcoming birthday digests")
+    parser.add_argument("--date", type=date.fromisoformat, default=None, help="day of the run, YYYY-MM-DD")
+    parser.add_argument("--days", type=int, default=config.BIRTHDAY_WINDOW_DAYS)
+    parser.add_argument("--batch-size", type=int, default=config.BIRTHDAY_BATCH_SIZE)
+    parser.add_argument("--daemon", action="store_true", help="keep running and send digests every day")
+    args = parser.parse_args()
+    if args.daemon:
+        asyncio.run(run_daily())
+    else:
+        sent = asyncio.run(run(today=args.date, days=args.days, batch_size=args.batch_size))
+        print(f"Sent {sent} birthday digests")
+
+
+if __name__ == "__main__":
+    main()
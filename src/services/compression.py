@@ -0,0 +1,252 @@
+import zlib
+from collections import OrderedDict
+
+from starlette.datastructures import Headers, MutableHeaders
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSIBLE_TYPES = ("text/", "application/json", "application/javascript", "application/xml",
+                      "application/problem+json", "image/svg+xml")
+NOT_COMPRESSED_TYPES = ("text/event-stream",)
+
+
+class GzipEncoder:
+    name = "gzip"
+
+    def __init__(self, level: int = 6):
+        self.level = level
+
+    def compress(self, body: bytes) -> bytes:
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+        return compressor.compress(body) + compressor.flush()
+
+    def stream(self):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+        return lambda chunk, last: compressor.compress(chunk) + compressor.flush(
+            zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class BrotliEncoder:
+    name = "br"
+
+    def __init__(self, quality: int = 4):
+        self.quality = quality
+
+    def compress(self, body: bytes) -> bytes:
+        return brotli.compress(body, quality=self.quality)
+
+    def stream(self):
+        compressor = brotli.Compressor(quality=self.quality)
+        return lambda chunk, last: compressor.process(chunk) + (compressor.finish() if last else compressor.flush())
+
+
+class ZstdEncoder:
+    name = "zstd"
+
+    def __init__(self, level: int = 3):
+        self.level = level
+
+    def compress(self, body: bytes) -> bytes:
+        return zstandard.ZstdCompressor(level=self.level).compress(body)
+
+    def stream(self):
+        compressor = zstandard.ZstdCompressor(level=self.level).compressobj()
+        return lambda chunk, last: compressor.compress(chunk) + compressor.flush(
+            zstandard.COMPRESSOBJ_FLUSH_FINISH if last else zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+
+def available_encoders() -> list:
+    """
+        Encoders this process can use, the preferred first.
+
+        :return: zstd and br when their packages are installed, and gzip.
+        :rtype: list
+        """
+    encoders = []
+    if zstandard is not None:
+        encoders.append(ZstdEncoder())
+    if brotli is not None:
+        encoders.append(BrotliEncoder())
+    encoders.append(GzipEncoder())
+    return encoders
+
+
+def negotiate(accept_encoding: str, encoders: list):
+    """
+        The encoder for an Accept-Encoding header.
+
+        :param accept_encoding: The Accept-Encoding header.
+        :type accept_encoding: str
+        :param encoders: The available encoders, the preferred first.
+        :type encoders: list
+        :return: The accepted encoder with the highest q, the preferred one on ties, None if none is accepted.
+        :rtype: GzipEncoder | BrotliEncoder | ZstdEncoder | None
+        """
+    accepted = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name.strip().lower()] = q
+    best, best_q = None, 0.0
+    for encoder in encoders:
+        q = accepted.get(encoder.name, accepted.get("*", 0.0))
+        if q > best_q:
+            best, best_q = encoder, q
+    return best
+
+
+class CompressedCache:
+    """
+        LRU of compressed bodies by resource, ETag and encoding.
+        """
+
+    def __init__(self, size: int = 256):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._bodies = OrderedDict()
+
+    def get_or_compress(self, encoder, body: bytes, key: tuple | None = None) -> bytes:
+        """
+            The compressed body, from the cache when it holds one for the key.
+
+            :param encoder: The encoder to compress with.
+            :type encoder: GzipEncoder | BrotliEncoder | ZstdEncoder
+            :param body: The whole response body.
+            :type body: bytes
+            :param key: The resource and its ETag, None to compress without caching.
+            :type key: tuple | None
+            :return: The compressed body.
+            :rtype: bytes
+            """
+        if key is None or not self.size:
+            return encoder.compress(body)
+        key = (*key, encoder.name)
+        compressed = self._bodies.get(key)
+        if compressed is not None:
+            self._bodies.move_to_end(key)
+            self.hits += 1
+            return compressed
+        self.misses += 1
+        compressed = encoder.compress(body)
+        self._bodies[key] = compressed
+        if len(self._bodies) > self.size:
+            self._bodies.popitem(last=False)
+        return compressed
+
+    def stats(self) -> dict:
+        return {"size": len(self._bodies), "hits": self.hits, "misses": self.misses}
+
+
+class CompressionMiddleware:
+    """
+        Compresses responses with the best encoding the client accepts.
+
+        Bodies under `minimum_size`, event streams and already encoded or binary
+        responses are sent as they are. Streaming responses are compressed chunk by
+        chunk with a flush after each, so clients still get every chunk right away.
+        Whole bodies are cached compressed only when the response has an ETag, so
+        per-user bodies without one never evict the shared representations.
+        """
+
+    def __init__(self, app, minimum_size: int = 500, cache: CompressedCache | None = None, encoders: list | None = None):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.encoders = encoders if encoders is not None else available_encoders()
+        self.cache = cache if cache is not None else CompressedCache()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoder = negotiate(Headers(scope=scope).get("Accept-Encoding", ""), self.encoders)
+        if encoder is None:
+            await self.app(scope, receive, send)
+            return
+        await _CompressedResponder(self, encoder, send, scope)(scope, receive)
+
+
+def _cache_key(scope, etag: str | None) -> tuple | None:
+    # an ETag is only unique per resource, so the path and query are part of the key
+    if not etag:
+        return None
+    return scope.get("path", ""), scope.get("query_string", b""), etag
+
+
+class _CompressedResponder:
+    def __init__(self, middleware: CompressionMiddleware, encoder, send, scope):
+        self.middleware = middleware
+        self.scope = scope
+        self.encoder = encoder
+        self.send = send
+        self.start = None
+        self.compress = None
+        self.passthrough = False
+
+    async def __call__(self, scope, receive):
+        await self.middleware.app(scope, receive, self.on_send)
+
+    async def on_send(self, message):
+        if message["type"] == "http.response.start":
+            self.start = message
+            headers = Headers(raw=message.get("headers", []))
+            content_type = headers.get("Content-Type", "")
+            self.passthrough = ("Content-Encoding" in headers or content_type.startswith(NOT_COMPRESSED_TYPES) or
+                                not content_type.startswith(COMPRESSIBLE_TYPES))
+            if self.passthrough:
+                await self.send(message)
+            return
+        if message["type"] != "http.response.body" or self.passthrough:
+            await self.send(message)
+            return
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if self.compress is not None:
+            await self.send({"type": "http.response.body", "body": self.compress(body, not more_body),
+                             "more_body": more_body})
+            return
+        if not more_body:
+            await self.send_whole(body)
+            return
+        headers = self.encoded_headers()
+        del headers["Content-Length"]
+        self.compress = self.encoder.stream()
+        await self.send(self.start)
+        await self.send({"type": "http.response.body", "body": self.compress(body, False), "more_body": True})
+
+    async def send_whole(self, body: bytes):
+        if len(body) < self.middleware.minimum_size:
+            await self.send(self.start)
+            await self.send({"type": "http.response.body", "body": body})
+            return
+        key = _cache_key(self.scope, Headers(raw=self.start.get("headers", [])).get("ETag"))
+        headers = self.encoded_headers()
+        compressed = self.middleware.cache.get_or_compress(self.encoder, body, key)
+        headers["Content-Length"] = str(len(compressed))
+        await self.send(self.start)
+        await self.send({"type": "http.response.body", "body": compressed})
+
+    def encoded_headers(self) -> MutableHeaders:
+        self.start["headers"] = list(self.start.get("headers", []))
+        headers = MutableHeaders(raw=self.start["headers"])
+        headers["Content-Encoding"] = self.encoder.name
+        headers.add_vary_header("Accept-Encoding")
+        etag = headers.get("ETag")
+        if etag and not etag.startswith("W/"):
+            # the compressed body is another representation, only weakly equal to the original
+            headers["ETag"] = f"W/{etag}"
+        return headers
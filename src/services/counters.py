@@ -0,0 +1,50 @@
+"""
+Periodic reconciliation of cached contact counts.
+
+Run with ``python -m src.services.counters``, e.g. nightly from cron.
+"""
+import argparse
+
+from src.database.db import DBSession
+from src.database.models import User
+from src.repository.contacts import reconcile_contact_counters
+
+
+def reconcile_all(session_factory=DBSession, batch_size: int = 500) -> int:
+    """
+        Recomputes cached contact counts of all users, `batch_size` users per transaction.
+
+        :param session_factory: Creates the database session.
+        :type session_factory: sessionmaker
+        :param batch_size: The number of users per transaction.
+        :type batch_size: int
+        :return: The number of users reconciled.
+        :rtype: int
+        """
+    reconciled = 0
+    last_id = 0
+    with session_factory() as db:
+        while True:
+            user_ids = [user_id for user_id, in db.query(User.id).filter(User.id > last_id).order_by(User.id).limit(
+                batch_size)]
+            if not user_ids:
+                break
+            shards = getattr(db, "shards", None)
+            for shard, shard_user_ids in (shards.group_by_shard(user_ids).items() if shards else [(None, user_ids)]):
+                db.info["shard"] = shard
+                reconcile_contact_counters(db, shard_user_ids)
+            db.info.pop("shard", None)
+            reconciled += len(user_ids)
+            last_id = user_ids[-1]
+    return reconciled
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recompute cached contact counts")
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+    print(f"Reconciled contact counts of {reconcile_all(batch_size=args.batch_size)} users")
+
+
+if __name__ == "__main__":
+    main()
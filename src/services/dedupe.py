@@ -0,0 +1,257 @@
+"""
+Duplicate contacts.
+
+The contacts route finds the duplicates of one user on request. ``python -m src.services.dedupe``
+finds them for every user, e.g. nightly from cron, and writes one JSON line per user that has any;
+nothing is merged by the job.
+"""
+import argparse
+import json
+import sys
+from collections import defaultdict
+from dataclasses import dataclass, field
+
+from sqlalchemy.orm import Session
+from src.database.db import DBSession
+from src.database.models import MERGED_FIELDS, Contact, User
+from src.database.normalize import normalize_email, normalize_phone, soundex
+
+EMAIL_WEIGHT = 0.6
+PHONE_WEIGHT = 0.4
+NAME_WEIGHT = 0.4
+THRESHOLD = 0.6
+# the name alone can't reach THRESHOLD, contacts that share a soundex block and don't contradict
+# each other are duplicates when their full names are this similar
+NAME_THRESHOLD = 0.8
+WINDOW = 10
+
+
+@dataclass
+class Candidate:
+    id: int
+    name: str | None = None
+    surname: str | None = None
+    email: str | None = None
+    phone: str | None = None
+    description: str | None = None
+    birth_date: object = None
+    email_key: str | None = field(init=False)
+    phone_key: str | None = field(init=False)
+    name_key: str = field(init=False)
+    trigrams: frozenset = field(init=False)
+
+    def __post_init__(self):
+        self.email_key = normalize_email(self.email)
+        self.phone_key = normalize_phone(self.phone)
+        self.name_key = soundex(self.name) + soundex(self.surname)
+        full_name = f"  {self.name or ''} {self.surname or ''} ".casefold()
+        self.trigrams = frozenset(full_name[i:i + 3] for i in range(len(full_name) - 2))
+
+    def blocking_keys(self):
+        if self.email_key:
+            yield "email", self.email_key
+        if self.phone_key:
+            yield "phone", self.phone_key
+        if self.name_key:
+            yield "name", self.name_key
+
+
+def name_similarity(a: Candidate, b: Candidate) -> float:
+    # Jaccard index of the trigrams of the full names
+    if not a.trigrams or not b.trigrams:
+        return 0.0
+    return len(a.trigrams & b.trigrams) / len(a.trigrams | b.trigrams)
+
+
+def contradicts(a: Candidate, b: Candidate) -> bool:
+    # both have an email or a phone, and they differ
+    return bool((a.email_key and b.email_key and a.email_key != b.email_key)
+                or (a.phone_key and b.phone_key and a.phone_key != b.phone_key))
+
+
+def similarity(a: Candidate, b: Candidate) -> float:
+    """
+        Score of two contacts being the same person, from 0 to 1.
+
+        :param a: The first contact.
+        :type a: Candidate
+        :param b: The second contact.
+        :type b: Candidate
+        :return: The score.
+        :rtype: float
+        """
+    score = 0.0
+    if a.email_key and a.email_key == b.email_key:
+        score += EMAIL_WEIGHT
+    if a.phone_key and a.phone_key == b.phone_key:
+        score += PHONE_WEIGHT
+    score += NAME_WEIGHT * name_similarity(a, b)
+    return min(score, 1.0)
+
+
+def find_duplicate_groups(candidates: list[Candidate], threshold: float = THRESHOLD, window: int = WINDOW,
+                          name_threshold: float = NAME_THRESHOLD):
+    """
+        Groups of contacts that are probably the same person.
+
+        Contacts are only compared inside blocks sharing a normalized email, phone
+        or phonetic name, and inside a block each contact is compared with the
+        next `window` contacts in name order. That keeps the work linear in the
+        number of contacts instead of comparing every pair.
+
+        A pair is a duplicate when its score reaches `threshold`, or when it shares the
+        phonetic name block, its names reach `name_threshold` and no email or phone differs.
+
+        :param candidates: The contacts of one user.
+        :type candidates: list[Candidate]
+        :param threshold: The lowest score of a duplicate pair.
+        :type threshold: float
+        :param name_threshold: The lowest name similarity of a duplicate pair matched by name only.
+        :type name_threshold: float
+        :param window: How many neighbours in a block each contact is compared with.
+        :type window: int
+        :return: dicts with contact_ids, score, primary_id and the merged values.
+        :rtype: list[dict]
+        """
+    blocks = defaultdict(list)
+    for candidate in candidates:
+        for key in candidate.blocking_keys():
+            blocks[key].append(candidate)
+
+    parent = {candidate.id: candidate.id for candidate in candidates}
+
+    def find(contact_id):
+        while parent[contact_id] != contact_id:
+            parent[contact_id] = parent[parent[contact_id]]
+            contact_id = parent[contact_id]
+        return contact_id
+
+    best = {}
+    seen = set()
+    for block in blocks.values():
+        if len(block) < 2:
+            continue
+        block.sort(key=lambda c: (c.name_key, c.id))
+        for i, a in enumerate(block):
+            for b in block[i + 1:i + 1 + window]:
+                pair = (a.id, b.id) if a.id < b.id else (b.id, a.id)
+                if pair in seen:
+                    continue
+                seen.add(pair)
+                score = similarity(a, b)
+                if score >= threshold or (a.name_key == b.name_key and not contradicts(a, b)
+                                          and name_similarity(a, b) >= name_threshold):
+                    root_a, root_b = find(a.id), find(b.id)
+                    if root_a != root_b:
+                        parent[root_b] = root_a
+                    best[pair] = score
+
+    groups = defaultdict(list)
+    for candidate in candidates:
+        groups[find(candidate.id)].append(candidate)
+    scores = defaultdict(float)
+    for (a_id, _), score in best.items():
+        root = find(a_id)
+        scores[root] = max(scores[root], score)
+
+    result = []
+    for root, members in groups.items():
+        if len(members) < 2:
+            continue
+        primary, merged = merge_suggestion(members)
+        result.append({"contact_ids": sorted(member.id for member in members), "score": round(scores[root], 3),
+                       "primary_id": primary.id, "merged": merged})
+    result.sort(key=lambda group: -group["score"])
+    return result
+
+
+def merge_suggestion(members):
+    """
+        The contact to keep, the most complete one, and the values it gets from the others.
+        """
+    ordered = sorted(members, key=lambda c: (-sum(bool(getattr(c, name)) for name in MERGED_FIELDS), c.id))
+    merged = {name: next((getattr(c, name) for c in ordered if getattr(c, name)), None) for name in MERGED_FIELDS}
+    return ordered[0], merged
+
+
+def load_candidates(db: Session, user_id: int, yield_per: int = 5000) -> list[Candidate]:
+    """
+        Contacts of a user with only the columns needed for matching.
+
+        :param db: The database session.
+        :type db: Session
+        :param user_id: The id of the user.
+        :type user_id: int
+        :param yield_per: The number of rows fetched at once.
+        :type yield_per: int
+        :return: The candidates.
+        :rtype: list[Candidate]
+        """
+    rows = db.query(Contact.id, Contact.name, Contact.surname, Contact.email, Contact.phone, Contact.description,
+                    Contact.birth_date).filter(Contact.user_id == user_id).yield_per(yield_per)
+    return [Candidate(*row) for row in rows]
+
+
+def find_duplicates(db: Session, user_id: int) -> list[dict]:
+    """
+        Duplicate groups with merge suggestions for a user.
+
+        :param db: The database session.
+        :type db: Session
+        :param user_id: The id of the user.
+        :type user_id: int
+        :return: dicts with contact_ids, score, primary_id and the merged values.
+        :rtype: list[dict]
+        """
+    return find_duplicate_groups(load_candidates(db, user_id))
+
+
+def find_all_duplicates(session_factory=DBSession, batch_size: int = 500, threshold: float = THRESHOLD):
+    """
+        Duplicate groups of every user that has any, users are read `batch_size` at a time.
+
+        :param session_factory: Creates the database session.
+        :type session_factory: sessionmaker
+        :param batch_size: The number of users read at once.
+        :type batch_size: int
+        :param threshold: The lowest score of a duplicate pair.
+        :type threshold: float
+        :return: dicts with user_id and groups.
+        :rtype: Iterator[dict]
+        """
+    last_id = 0
+    with session_factory() as db:
+        while True:
+            user_ids = [user_id for user_id, in db.query(User.id).filter(User.id > last_id).order_by(User.id).limit(
+                batch_size)]
+            if not user_ids:
+                break
+            shards = getattr(db, "shards", None)
+            for shard, shard_user_ids in (shards.group_by_shard(user_ids).items() if shards else [(None, user_ids)]):
+                db.info["shard"] = shard
+                for user_id in shard_user_ids:
+                    groups = find_duplicate_groups(load_candidates(db, user_id), threshold)
+                    if groups:
+                        yield {"user_id": user_id, "groups": groups}
+            db.info.pop("shard", None)
+            # one read transaction per batch, a long job doesn't hold one snapshot open
+            db.rollback()
+            last_id = user_ids[-1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Find duplicate contacts of every user")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--threshold", type=float, default=THRESHOLD, help="the lowest score of a duplicate pair")
+    parser.add_argument("--output", type=argparse.FileType("w"), default=sys.stdout, help="default: stdout")
+    args = parser.parse_args()
+    users = groups = 0
+    for report in find_all_duplicates(batch_size=args.batch_size, threshold=args.threshold):
+        args.output.write(json.dumps(report, default=str) + "\n")
+        users += 1
+        groups += len(report["groups"])
+    print(f"Found {groups} duplicate groups of {users} users", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
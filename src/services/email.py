@@ -1,3 +1,4 @@
+import asyncio
 from pathlib import Path
 
 from fastapi_mail import FastMail, MessageSchema, ConnectionConfig, MessageType
@@ -5,6 +6,7 @@ from fastapi_mail.errors import ConnectionErrors
 from pydantic import EmailStr
 from src.conf.config import config
 from src.database.auth import auth_service
+from src.services import tracing
 
 conf = ConnectionConfig(
     MAIL_USERNAME=config.MAIL_USERNAME,
@@ -44,6 +46,55 @@ async def send_email(email: EmailStr, username: str, host: str):
         )
 
         fm = FastMail(conf)
-        await fm.send_message(message, template_name="example_email.html")
+        with tracing.span("email send", "client", template="example_email.html"):
+            await fm.send_message(message, template_name="example_email.html")
     except ConnectionErrors as err:
         print(err)
+
+
+async def send_birthday_digest(email: EmailStr, username: str, contacts: list[dict], fm: FastMail | None = None):
+    """
+           Sends the list of upcoming birthdays to a user
+
+           :param email: the email of the user.
+           :type email: str
+           :param username: username of the user.
+           :type username: str
+           :param contacts: name, surname and birth_date of contacts.
+           :type contacts: list[dict]
+           :param fm: mail client to reuse.
+           :type fm: FastMail
+           :return: Nothing.
+           :rtype: None
+           :raises ConnectionErrors: the message wasn't sent.
+           """
+    message = MessageSchema(
+        subject="Upcoming birthdays",
+        recipients=[email],
+        template_body={"username": username, "contacts": contacts},
+        subtype=MessageType.html
+    )
+    with tracing.span("email send", "client", template="birthday_digest.html"):
+        await (fm or FastMail(conf)).send_message(message, template_name="birthday_digest.html")
+
+
+async def send_birthday_digests(digests: list[dict], concurrency: int = 10) -> list[BaseException | None]:
+    """
+           Sends a batch of birthday digests, at most `concurrency` at a time
+
+           :param digests: dicts with email, username and contacts.
+           :type digests: list[dict]
+           :param concurrency: the number of messages sent at once.
+           :type concurrency: int
+           :return: the error of every digest, None for the digests sent.
+           :rtype: list[BaseException | None]
+           """
+    fm = FastMail(conf)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def send(digest):
+        async with semaphore:
+            await send_birthday_digest(digest["email"], digest["username"], digest["contacts"], fm)
+
+    # one failed message doesn't stop the others, every digest gets its own result
+    return await asyncio.gather(*(send(digest) for digest in digests), return_exceptions=True)
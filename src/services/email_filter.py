@@ -0,0 +1,345 @@
+"""
+Bloom filter of registered emails.
+
+Logins and confirmation requests for emails that were never registered are answered
+without a database query or a password hash. The filter may say an email exists
+when it doesn't (at most the configured rate), never the other way round, so a
+"maybe" still goes to the database.
+
+Every worker keeps its own filter, built at startup and caught up with users created
+by other workers every few seconds; with Redis the workers share one filter instead.
+Ids are assigned before commit, so a user can show up after one with a higher id: the
+last ``EMAIL_FILTER_SYNC_WINDOW`` ids are read again on every catch-up.
+``python -m src.services.email_filter rebuild`` rebuilds it, e.g. after users were
+removed.
+"""
+import argparse
+import asyncio
+import hashlib
+import math
+import time
+
+import redis.asyncio as redis
+from redis.exceptions import RedisError
+from sqlalchemy import select
+from starlette.concurrency import run_in_threadpool
+
+from src.conf.config import config
+from src.database.db import DBSession
+from src.database.models import User
+from src.database.normalize import normalize_email
+
+
+class BloomFilter:
+    """
+        Bits of a Bloom filter sized for a capacity and false positive rate.
+
+        Bit ``i`` is the ``i % 8``-th most significant bit of byte ``i // 8``, as in Redis
+        SETBIT, so the bits can be copied to Redis as they are.
+        """
+
+    def __init__(self, capacity: int = config.EMAIL_FILTER_CAPACITY,
+                 error_rate: float = config.EMAIL_FILTER_ERROR_RATE):
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, item: str) -> list[int]:
+        # two halves of one digest give all positions (Kirsch-Mitzenmacher)
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], "big"), int.from_bytes(digest[8:], "big") | 1
+        return [(first + number * second) % self.size for number in range(self.hashes)]
+
+    def add(self, item: str):
+        for position in self.positions(item):
+            self.bits[position // 8] |= 0x80 >> (position % 8)
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.bits[position // 8] & (0x80 >> (position % 8)) for position in self.positions(item))
+
+
+def email_key(email: str) -> str:
+    # matching is looser than the exact lookup of the repository, so no registered email is missed
+    return normalize_email(email) or ""
+
+
+class LocalEmailFilter:
+    """
+        The filter in the memory of this worker.
+
+        Until it is built every email may exist. Users created by other workers are read by
+        id every ``sync_interval`` seconds, which is one indexed query however many requests come,
+        starting ``sync_window`` ids before the last one read for users committed out of order.
+        """
+
+    def __init__(self, session_factory=DBSession, capacity: int = config.EMAIL_FILTER_CAPACITY,
+                 error_rate: float = config.EMAIL_FILTER_ERROR_RATE,
+                 sync_interval: float = config.EMAIL_FILTER_SYNC_INTERVAL,
+                 sync_window: int = config.EMAIL_FILTER_SYNC_WINDOW):
+        self.session_factory = session_factory
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.sync_interval = sync_interval
+        self.sync_window = sync_window
+        self.bloom = None
+        self.last_id = 0
+        self.synced_at = 0.0
+        self.rejected = 0
+        self._sync_lock = asyncio.Lock()
+
+    def _load(self, target, after_id: int = 0) -> int:
+        # target is a BloomFilter or a set, the id of the last user read is returned
+        last_id = after_id
+        statement = select(User.id, User.email).where(User.id > after_id).order_by(User.id)
+        with self.session_factory() as db:
+            for user_id, email in db.execute(statement.execution_options(yield_per=10000)):
+                key = email_key(email)
+                # the window is read again, only emails not in the filter yet count
+                if key not in target:
+                    target.add(key)
+                last_id = user_id
+        return last_id
+
+    def _load_since(self, target, last_id: int) -> int:
+        return max(last_id, self._load(target, max(0, last_id - self.sync_window)))
+
+    def build(self) -> int:
+        """
+            Builds the filter from the users table, blocking.
+
+            :return: The number of emails in the filter.
+            :rtype: int
+            """
+        bloom = BloomFilter(self.capacity, self.error_rate)
+        last_id = self._load(bloom)
+        self.bloom, self.last_id, self.synced_at = bloom, last_id, time.monotonic()
+        return bloom.count
+
+    async def rebuild(self) -> int:
+        return await run_in_threadpool(self.build)
+
+    async def warm_up(self):
+        await self.rebuild()
+
+    async def add(self, email: str):
+        if self.bloom is not None:
+            self.bloom.add(email_key(email))
+
+    async def _sync(self):
+        async with self._sync_lock:
+            if time.monotonic() - self.synced_at < self.sync_interval:
+                return
+            self.last_id = await run_in_threadpool(self._load_since, self.bloom, self.last_id)
+            self.synced_at = time.monotonic()
+
+    async def might_exist(self, email: str) -> bool:
+        """
+            Whether a user with the email may exist.
+
+            :param email: The email to check.
+            :type email: str
+            :return: False only if no user has the email.
+            :rtype: bool
+            """
+        if self.bloom is None:
+            return True
+        key = email_key(email)
+        if key in self.bloom:
+            return True
+        if time.monotonic() - self.synced_at >= self.sync_interval:
+            await self._sync()
+            if key in self.bloom:
+                return True
+        self.rejected += 1
+        return False
+
+    def stats(self) -> dict:
+        if self.bloom is None:
+            return {"ready": False}
+        return {"ready": True, "emails": self.bloom.count, "bits": self.bloom.size, "hashes": self.bloom.hashes,
+                "rejected": self.rejected}
+
+
+class RedisEmailFilter:
+    """
+        The filter shared by all workers as a Redis bit string, so every worker knows new users at once.
+
+        When Redis is unavailable calls go to the fallback filter. An email the filter misses
+        is checked again after catching up with the users table, at most every ``sync_interval``
+        seconds, so users whose bits were never set (a worker lost Redis while adding them, or
+        committed out of order) are not rejected. A worker that failed to set bits answers from
+        the fallback filter until it has rebuilt the shared one.
+        """
+
+    def __init__(self, redis, fallback: LocalEmailFilter | None = None, key: str = "email_filter",
+                 capacity: int = config.EMAIL_FILTER_CAPACITY, error_rate: float = config.EMAIL_FILTER_ERROR_RATE,
+                 sync_interval: float = config.EMAIL_FILTER_SYNC_INTERVAL):
+        self.redis = redis
+        self.fallback = fallback or LocalEmailFilter(capacity=capacity, error_rate=error_rate)
+        self.key = key
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.sync_interval = sync_interval
+        # only the sizes and hash functions are used, the bits live in Redis
+        self.layout = BloomFilter(capacity, error_rate)
+        self.layout.bits = bytearray()
+        self.rejected = 0
+        self.synced_at = 0.0
+        self.stale = False
+        self.failed_at = 0.0
+        self._sync_lock = asyncio.Lock()
+
+    async def rebuild(self) -> int:
+        """
+            Builds the filter from the users table and swaps it in.
+
+            Users created while it was built are added again after the swap.
+            """
+        bloom = BloomFilter(self.capacity, self.error_rate)
+        last_id = await run_in_threadpool(self.fallback._load, bloom)
+        await self.redis.set(f"{self.key}:new", bytes(bloom.bits))
+        await self.redis.rename(f"{self.key}:new", self.key)
+        created = set()
+        last_id = await run_in_threadpool(self.fallback._load_since, created, last_id)
+        await self._set_bits(created)
+        await self.redis.set(f"{self.key}:last_id", last_id)
+        return bloom.count + len(created)
+
+    async def build_if_missing(self) -> bool:
+        """
+            Builds the filter unless another worker has built it or is building it.
+
+            :return: Whether this worker built it.
+            :rtype: bool
+            """
+        if await self.redis.exists(self.key):
+            return False
+        if not await self.redis.set(f"{self.key}:lock", 1, nx=True, ex=300):
+            return False
+        try:
+            await self.rebuild()
+        finally:
+            await self.redis.delete(f"{self.key}:lock")
+        return True
+
+    async def warm_up(self):
+        # the local filter answers while Redis is down
+        await self.fallback.rebuild()
+        await self.build_if_missing()
+
+    async def _set_bits(self, keys):
+        if not keys:
+            return
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for key in keys:
+                for position in self.layout.positions(key):
+                    pipe.setbit(self.key, position, 1)
+            await pipe.execute()
+
+    async def _get_bits(self, key: str) -> bool:
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.exists(self.key)
+            for position in self.layout.positions(key):
+                pipe.getbit(self.key, position)
+            exists, *bits = await pipe.execute()
+        # until it is built every email may exist
+        return not exists or all(bits)
+
+    async def _catch_up(self) -> bool:
+        # sets the bits of users created since the last catch-up of any worker, True if there were any
+        async with self._sync_lock:
+            if time.monotonic() - self.synced_at < self.sync_interval:
+                return False
+            last_id = int(await self.redis.get(f"{self.key}:last_id") or 0)
+            created = set()
+            last_id = await run_in_threadpool(self.fallback._load_since, created, last_id)
+            await self._set_bits(created)
+            await self.redis.set(f"{self.key}:last_id", last_id)
+            self.synced_at = time.monotonic()
+            return bool(created)
+
+    async def _recover(self):
+        # the shared filter misses an email this worker added, it is rebuilt once Redis answers again
+        async with self._sync_lock:
+            if not self.stale or time.monotonic() - self.failed_at < self.sync_interval:
+                return
+            self.stale = False
+            try:
+                await self.rebuild()
+            except RedisError as err:
+                print(err)
+                self.stale, self.failed_at = True, time.monotonic()
+
+    async def add(self, email: str):
+        try:
+            await self._set_bits([email_key(email)])
+        except RedisError as err:
+            print(err)
+            self.stale, self.failed_at = True, time.monotonic()
+        await self.fallback.add(email)
+
+    async def might_exist(self, email: str) -> bool:
+        if self.stale:
+            await self._recover()
+            if self.stale:
+                return await self.fallback.might_exist(email)
+        key = email_key(email)
+        try:
+            if await self._get_bits(key) or (await self._catch_up() and await self._get_bits(key)):
+                return True
+        except RedisError as err:
+            print(err)
+            return await self.fallback.might_exist(email)
+        self.rejected += 1
+        return False
+
+    def stats(self) -> dict:
+        return {"shared": True, "bits": self.layout.size, "hashes": self.layout.hashes, "rejected": self.rejected,
+                "stale": self.stale}
+
+
+registered = LocalEmailFilter()
+
+
+def init(new_filter):
+    """
+        Replaces the filter of registered emails.
+
+        :param new_filter: LocalEmailFilter or RedisEmailFilter.
+        :type new_filter: LocalEmailFilter | RedisEmailFilter
+        :return: Nothing.
+        :rtype: None
+        """
+    global registered
+    registered = new_filter
+
+
+async def rebuild_shared() -> int:
+    r = redis.Redis(host=config.REDIS_DOMAIN, port=config.REDIS_PORT, password=config.REDIS_PASSWORD, db=0)
+    try:
+        return await RedisEmailFilter(r).rebuild()
+    finally:
+        await r.aclose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Filter of registered emails")
+    parser.add_argument("command", choices=["rebuild", "size"])
+    parser.add_argument("--capacity", type=int, default=config.EMAIL_FILTER_CAPACITY)
+    parser.add_argument("--error-rate", type=float, default=config.EMAIL_FILTER_ERROR_RATE)
+    args = parser.parse_args()
+    bloom = BloomFilter(args.capacity, args.error_rate)
+    print(f"{bloom.size} bits ({bloom.size / 8 / 1024 / 1024:.1f} MiB), {bloom.hashes} hashes "
+          f"for {args.capacity} emails at {args.error_rate:.2%} false positives")
+    if args.command == "rebuild":
+        # workers build their local filters at startup, so only the shared one is rebuilt here
+        count = asyncio.run(rebuild_shared())
+        print(f"Rebuilt the shared filter with {count} emails")
+        if count > args.capacity:
+            print("More emails than EMAIL_FILTER_CAPACITY, raise it to keep the false positive rate")
+
+
+if __name__ == "__main__":
+    main()
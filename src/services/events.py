@@ -0,0 +1,252 @@
+import asyncio
+import json
+from collections import defaultdict
+from contextlib import asynccontextmanager
+
+from redis.exceptions import RedisError
+
+CREATED, UPDATED, DELETED = "created", "updated", "deleted"
+# sent instead of the events a slow subscriber missed, the client reloads its contacts then
+RESYNC = "resync"
+CONTACT_FIELDS = ("id", "name", "surname", "email", "phone", "description", "birth_date")
+
+
+def contact_event(kind: str, contact) -> dict:
+    """
+        The event of a change of a contact.
+
+        :param kind: CREATED, UPDATED or DELETED.
+        :type kind: str
+        :param contact: The changed contact.
+        :type contact: Contact
+        :return: The event with the type and the contact, only the id for deleted contacts.
+        :rtype: dict
+        """
+    fields = ("id",) if kind == DELETED else CONTACT_FIELDS
+    data = {name: getattr(contact, name) for name in fields}
+    if data.get("birth_date") is not None:
+        data["birth_date"] = data["birth_date"].isoformat()
+    return {"type": kind, "contact": data}
+
+
+class LocalSubscription:
+    def __init__(self, queue: asyncio.Queue):
+        self.queue = queue
+        self.overflowed = False
+
+    async def get(self, timeout: float) -> dict | None:
+        """
+            The next event, None if there was none for `timeout` seconds.
+            """
+        if self.overflowed:
+            self.overflowed = False
+            return {"type": RESYNC}
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class InMemoryBroker:
+    """
+        Delivers events to the subscribers of this process, for single node setups and tests.
+        """
+
+    def __init__(self, queue_size: int = 100):
+        self.queue_size = queue_size
+        self._subscriptions = defaultdict(set)
+
+    async def publish(self, user_id: int, event: dict):
+        """
+            Sends an event to every subscription of a user.
+
+            :param user_id: The id of the user.
+            :type user_id: int
+            :param event: The event.
+            :type event: dict
+            :return: Nothing.
+            :rtype: None
+            """
+        for subscription in self._subscriptions.get(user_id, ()):
+            try:
+                subscription.queue.put_nowait(event)
+            except asyncio.QueueFull:
+                subscription.overflowed = True
+
+    @asynccontextmanager
+    async def subscribe(self, user_id: int):
+        """
+            Subscribes to the events of a user for the duration of the context.
+
+            :param user_id: The id of the user.
+            :type user_id: int
+            :return: The subscription.
+            :rtype: LocalSubscription
+            """
+        subscription = LocalSubscription(asyncio.Queue(self.queue_size))
+        self._subscriptions[user_id].add(subscription)
+        try:
+            yield subscription
+        finally:
+            self._subscriptions[user_id].discard(subscription)
+            if not self._subscriptions[user_id]:
+                del self._subscriptions[user_id]
+
+    def stats(self) -> dict:
+        return {"users": len(self._subscriptions),
+                "subscriptions": sum(len(subscriptions) for subscriptions in self._subscriptions.values())}
+
+
+class RedisBroker:
+    """
+        Delivers events to the subscribers of every node through Redis pub/sub channels ``events:<user_id>``.
+
+        A process has one pub/sub connection, subscribed to the channels of the users with a
+        subscriber here; a reader task hands the messages to the local broker, which fans them
+        out to the queues of the subscribers. When Redis is unavailable events are published to
+        the local broker, so only the subscribers of the same process get them.
+        """
+
+    def __init__(self, redis, fallback: InMemoryBroker | None = None, prefix: str = "events",
+                 retry_delay: float = 1.0):
+        self.redis = redis
+        self.fallback = fallback or InMemoryBroker()
+        self.prefix = prefix
+        self.retry_delay = retry_delay
+        self._pubsub = None
+        self._reader = None
+        # local subscribers of each user whose channel is subscribed in Redis
+        self._channels = defaultdict(int)
+        self._lock = asyncio.Lock()
+
+    def _channel(self, user_id):
+        return f"{self.prefix}:{user_id}"
+
+    async def publish(self, user_id: int, event: dict):
+        try:
+            await self.redis.publish(self._channel(user_id), json.dumps(event))
+        except RedisError as err:
+            print(err)
+            await self.fallback.publish(user_id, event)
+
+    async def _read(self):
+        while True:
+            try:
+                message = await self._pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except RedisError as err:
+                print(err)
+                await asyncio.sleep(self.retry_delay)
+                continue
+            if message is None:
+                continue
+            channel = message["channel"]
+            if isinstance(channel, bytes):
+                channel = channel.decode()
+            user_id = int(channel.rsplit(":", 1)[1])
+            await self.fallback.publish(user_id, json.loads(message["data"]))
+
+    async def _join(self, user_id: int) -> bool:
+        async with self._lock:
+            if not self._channels[user_id]:
+                try:
+                    if self._pubsub is None:
+                        self._pubsub = self.redis.pubsub()
+                    await self._pubsub.subscribe(self._channel(user_id))
+                except RedisError as err:
+                    print(err)
+                    del self._channels[user_id]
+                    return False
+                if self._reader is None or self._reader.done():
+                    self._reader = asyncio.create_task(self._read())
+            self._channels[user_id] += 1
+            return True
+
+    async def _leave(self, user_id: int):
+        async with self._lock:
+            self._channels[user_id] -= 1
+            if self._channels[user_id]:
+                return
+            del self._channels[user_id]
+            try:
+                await self._pubsub.unsubscribe(self._channel(user_id))
+            except RedisError as err:
+                print(err)
+
+    @asynccontextmanager
+    async def subscribe(self, user_id: int):
+        # events of the channel, or of this process only while Redis is unavailable
+        async with self.fallback.subscribe(user_id) as subscription:
+            joined = await self._join(user_id)
+            try:
+                yield subscription
+            finally:
+                if joined:
+                    await self._leave(user_id)
+
+    async def aclose(self):
+        if self._reader is not None:
+            self._reader.cancel()
+        if self._pubsub is not None:
+            await self._pubsub.aclose()
+
+    def stats(self) -> dict:
+        return {"backend": "redis", "connections": int(self._pubsub is not None), "channels": len(self._channels),
+                "subscriptions": sum(self._channels.values())}
+
+
+broker = InMemoryBroker()
+
+
+def init(new_broker):
+    """
+        Replaces the broker used for contact events.
+
+        :param new_broker: InMemoryBroker or RedisBroker.
+        :type new_broker: InMemoryBroker | RedisBroker
+        :return: Nothing.
+        :rtype: None
+        """
+    global broker
+    broker = new_broker
+
+
+async def publish(user_id: int, kind: str, contact):
+    """
+        Publishes a change of a contact to the devices of its owner, errors are only logged.
+
+        :param user_id: The id of the owner.
+        :type user_id: int
+        :param kind: CREATED, UPDATED or DELETED.
+        :type kind: str
+        :param contact: The changed contact.
+        :type contact: Contact
+        :return: Nothing.
+        :rtype: None
+        """
+    try:
+        await broker.publish(user_id, contact_event(kind, contact))
+    except Exception as err:
+        print(err)
+
+
+async def stream(user_id: int, is_disconnected, heartbeat: float = 15):
+    """
+        Server-Sent Events of a user, with a comment every `heartbeat` seconds to keep the connection open.
+
+        :param user_id: The id of the user.
+        :type user_id: int
+        :param is_disconnected: Tells whether the client went away.
+        :type is_disconnected: Callable
+        :param heartbeat: Seconds between keepalive comments.
+        :type heartbeat: float
+        :return: Encoded SSE messages.
+        :rtype: AsyncIterator[str]
+        """
+    async with broker.subscribe(user_id) as subscription:
+        yield ": connected\n\n"
+        while not await is_disconnected():
+            event = await subscription.get(heartbeat)
+            if event is None:
+                yield ": keepalive\n\n"
+                continue
+            yield f"event: {event['type']}\ndata: {json.dumps(event.get('contact'))}\n\n"
@@ -0,0 +1,264 @@
+import base64
+import hashlib
+import json
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+from redis.exceptions import RedisError
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+
+from src.conf.config import config
+from src.database.db import DBSession, dialect_insert
+from src.database.models import IdempotencyKey
+from src.services.limiter import user_identifier
+
+HEADER = "Idempotency-Key"
+METHODS = ("POST", "PUT", "PATCH")
+PATHS = ("/api/contacts",)
+MAX_KEY_LENGTH = 255
+# retrying these is expected to give another answer, so they are not replayed
+NOT_STORED = (409, 429)
+
+
+@dataclass
+class StoredResponse:
+    request_hash: str
+    status_code: int | None = None
+    content_type: str | None = None
+    body: bytes | None = None
+
+    @property
+    def pending(self) -> bool:
+        return self.status_code is None
+
+
+class DBIdempotencyStore:
+    """
+        Idempotency keys kept in the idempotency_keys table, expired rows are purged on the way.
+        """
+
+    def __init__(self, session_factory=DBSession):
+        self.session_factory = session_factory
+
+    async def begin(self, key: str, request_hash: str, ttl: int) -> StoredResponse | None:
+        """
+            Claims a key for a request.
+
+            :param key: The scoped idempotency key.
+            :type key: str
+            :param request_hash: The hash of the request body.
+            :type request_hash: str
+            :param ttl: How long the claim is kept without a response, in seconds.
+            :type ttl: int
+            :return: None if the key has been claimed, what is stored for it otherwise.
+            :rtype: StoredResponse | None
+            """
+        return await run_in_threadpool(self._begin, key, request_hash, ttl)
+
+    def _begin(self, key, request_hash, ttl):
+        now = datetime.utcnow()
+        with self.session_factory() as db:
+            db.query(IdempotencyKey).filter(IdempotencyKey.expires_at <= now).delete(synchronize_session=False)
+            claimed = db.execute(dialect_insert(db, IdempotencyKey).values(
+                key=key, request_hash=request_hash, expires_at=now + timedelta(seconds=ttl)
+            ).on_conflict_do_nothing().returning(IdempotencyKey.key)).first()
+            row = None if claimed else db.get(IdempotencyKey, key)
+            stored = StoredResponse(row.request_hash, row.status_code, row.content_type, row.body) if row else None
+            db.commit()
+        return stored
+
+    async def complete(self, key: str, response: StoredResponse, ttl: int):
+        """
+            Stores the response of the request that claimed a key.
+
+            :param key: The scoped idempotency key.
+            :type key: str
+            :param response: The response to replay.
+            :type response: StoredResponse
+            :param ttl: How long the response is kept, in seconds.
+            :type ttl: int
+            :return: Nothing.
+            :rtype: None
+            """
+        await run_in_threadpool(self._complete, key, response, ttl)
+
+    def _complete(self, key, response, ttl):
+        with self.session_factory() as db:
+            db.query(IdempotencyKey).filter(IdempotencyKey.key == key).update(
+                {IdempotencyKey.status_code: response.status_code, IdempotencyKey.content_type: response.content_type,
+                 IdempotencyKey.body: response.body,
+                 IdempotencyKey.expires_at: datetime.utcnow() + timedelta(seconds=ttl)}, synchronize_session=False)
+            db.commit()
+
+    async def release(self, key: str):
+        """
+            Frees a key whose request failed, so that a retry runs again.
+
+            :param key: The scoped idempotency key.
+            :type key: str
+            :return: Nothing.
+            :rtype: None
+            """
+        await run_in_threadpool(self._release, key)
+
+    def _release(self, key):
+        with self.session_factory() as db:
+            db.query(IdempotencyKey).filter(IdempotencyKey.key == key, IdempotencyKey.status_code.is_(None)).delete(
+                synchronize_session=False)
+            db.commit()
+
+
+class RedisIdempotencyStore:
+    """
+        Idempotency keys kept in Redis as ``idem:<key>`` JSON strings, expired by key TTL.
+
+        When Redis is unavailable calls go to the fallback store.
+        """
+
+    def __init__(self, redis, fallback: DBIdempotencyStore | None = None, prefix: str = "idem"):
+        self.redis = redis
+        self.fallback = fallback or DBIdempotencyStore()
+        self.prefix = prefix
+
+    def _key(self, key):
+        return f"{self.prefix}:{key}"
+
+    async def begin(self, key: str, request_hash: str, ttl: int) -> StoredResponse | None:
+        try:
+            if await self.redis.set(self._key(key), json.dumps({"request_hash": request_hash}), nx=True, ex=ttl):
+                return None
+            value = await self.redis.get(self._key(key))
+        except RedisError as err:
+            print(err)
+            return await self.fallback.begin(key, request_hash, ttl)
+        if value is None:
+            # expired between the two calls
+            return await self.begin(key, request_hash, ttl)
+        stored = json.loads(value)
+        body = stored.get("body")
+        return StoredResponse(stored["request_hash"], stored.get("status_code"), stored.get("content_type"),
+                              base64.b64decode(body) if body is not None else None)
+
+    async def complete(self, key: str, response: StoredResponse, ttl: int):
+        value = {"request_hash": response.request_hash, "status_code": response.status_code,
+                 "content_type": response.content_type, "body": base64.b64encode(response.body).decode()}
+        try:
+            await self.redis.set(self._key(key), json.dumps(value), ex=ttl)
+        except RedisError as err:
+            print(err)
+            await self.fallback.complete(key, response, ttl)
+
+    async def release(self, key: str):
+        try:
+            await self.redis.delete(self._key(key))
+        except RedisError as err:
+            print(err)
+            await self.fallback.release(key)
+
+
+store = DBIdempotencyStore()
+
+
+def init(new_store):
+    """
+        Replaces the store used for idempotency keys.
+
+        :param new_store: DBIdempotencyStore or RedisIdempotencyStore.
+        :type new_store: DBIdempotencyStore | RedisIdempotencyStore
+        :return: Nothing.
+        :rtype: None
+        """
+    global store
+    store = new_store
+
+
+def _digest(value: bytes) -> str:
+    return hashlib.sha256(value).hexdigest()
+
+
+class IdempotencyMiddleware:
+    """
+        Replays the stored response of a write retried with the same Idempotency-Key header.
+
+        Keys are scoped to the client, the method and the path. A replay doesn't reach
+        the route, so it isn't rate limited and doesn't touch the contacts table. Reusing
+        a key with another body answers 422, retrying while the first request still runs
+        answers 409. Responses of 5xx, 409 and 429 are not stored, so those can be retried.
+
+        A claim is only held for `lease` seconds until the response is stored for `ttl`,
+        so a request whose worker died blocks its key for the lease, not for the whole TTL.
+        """
+
+    def __init__(self, app, ttl: int = config.IDEMPOTENCY_TTL, lease: int = config.IDEMPOTENCY_LEASE,
+                 methods=METHODS, paths=PATHS):
+        self.app = app
+        self.ttl = ttl
+        self.lease = lease
+        self.methods = methods
+        self.paths = paths
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] not in self.methods or not scope["path"].startswith(self.paths):
+            await self.app(scope, receive, send)
+            return
+        request = Request(scope, receive)
+        idempotency_key = request.headers.get(HEADER)
+        if idempotency_key is None:
+            await self.app(scope, receive, send)
+            return
+        if not 0 < len(idempotency_key) <= MAX_KEY_LENGTH:
+            response = JSONResponse({"detail": f"{HEADER} must be 1 to {MAX_KEY_LENGTH} characters"}, status_code=400)
+            await response(scope, receive, send)
+            return
+        body = await request.body()
+        key = _digest(f"{user_identifier(request)} {scope['method']} {scope['path']} {idempotency_key}".encode())
+        request_hash = _digest(body)
+        stored = await store.begin(key, request_hash, self.lease)
+        if stored is not None:
+            await self._answer(stored, request_hash, scope, receive, send)
+            return
+        await self._run(key, request_hash, body, scope, receive, send)
+
+    @staticmethod
+    async def _answer(stored, request_hash, scope, receive, send):
+        if stored.request_hash != request_hash:
+            response = JSONResponse({"detail": f"{HEADER} was used with another request"}, status_code=422)
+        elif stored.pending:
+            response = JSONResponse({"detail": f"A request with this {HEADER} is in progress"}, status_code=409,
+                                    headers={"Retry-After": "1"})
+        else:
+            response = Response(stored.body, status_code=stored.status_code, media_type=stored.content_type,
+                                headers={"Idempotent-Replayed": "true"})
+        await response(scope, receive, send)
+
+    async def _run(self, key, request_hash, body, scope, receive, send):
+        body_sent = False
+        captured = StoredResponse(request_hash, body=b"")
+
+        async def replay_receive():
+            nonlocal body_sent
+            if not body_sent:
+                body_sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+
+        async def capture_send(message):
+            if message["type"] == "http.response.start":
+                captured.status_code = message["status"]
+                captured.content_type = next((value.decode("latin-1") for name, value in message.get("headers", [])
+                                              if name.lower() == b"content-type"), None)
+            elif message["type"] == "http.response.body":
+                captured.body += message.get("body", b"")
+            await send(message)
+
+        try:
+            await self.app(scope, replay_receive, capture_send)
+        except BaseException:
+            await store.release(key)
+            raise
+        if captured.status_code is None or captured.status_code >= 500 or captured.status_code in NOT_STORED:
+            await store.release(key)
+        else:
+            await store.complete(key, captured, self.ttl)
@@ -0,0 +1,144 @@
+import math
+import time
+import uuid
+from collections import OrderedDict
+
+from fastapi import HTTPException, Request
+from jose import JWTError
+from redis.exceptions import RedisError
+from src.conf.config import config
+from src.database.auth import auth_service
+from starlette import status
+
+SLIDING_WINDOW_LUA = """
+local now = redis.call('TIME')
+local now_ms = tonumber(now[1]) * 1000 + math.floor(tonumber(now[2]) / 1000)
+local window = tonumber(ARGV[1])
+local limit = tonumber(ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], 0, now_ms - window)
+if redis.call('ZCARD', KEYS[1]) < limit then
+    redis.call('ZADD', KEYS[1], now_ms, ARGV[3])
+    redis.call('PEXPIRE', KEYS[1], window)
+    return 0
+end
+local oldest = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+return math.max(tonumber(oldest[2]) + window - now_ms, 1)
+"""
+
+
+class LocalBackend:
+    """
+        In-process GCRA limiter for single-node deployments and tests.
+
+        At most `max_keys` keys are kept; the keys hit least recently are forgotten first.
+        """
+
+    def __init__(self, max_keys: int = 100_000):
+        self.max_keys = max_keys
+        # ordered from the least to the most recently hit key
+        self._tat = OrderedDict()
+
+    async def hit(self, key: str, times: int, seconds: float) -> int:
+        """
+            Registers a call
+
+            :param key: The key of the limited client.
+            :type key: str
+            :param times: The number of calls allowed in the window.
+            :type times: int
+            :param seconds: The window length.
+            :type seconds: float
+            :return: Milliseconds to wait before retrying, or 0 if the call is allowed.
+            :rtype: int
+            """
+        now = time.monotonic()
+        interval = seconds / times
+        tat = max(self._tat.get(key, now), now)
+        allow_at = tat + interval - seconds
+        if now < allow_at:
+            return math.ceil((allow_at - now) * 1000)
+        self._tat[key] = tat + interval
+        self._tat.move_to_end(key)
+        self._evict()
+        return 0
+
+    def _evict(self):
+        while len(self._tat) > self.max_keys:
+            self._tat.popitem(last=False)
+
+
+class RedisBackend:
+    """
+        Sliding window limiter shared between workers, done atomically in a Lua script.
+        """
+
+    def __init__(self, redis, fallback: LocalBackend | None = None):
+        self.redis = redis
+        self.fallback = fallback or LocalBackend()
+        self._script = redis.register_script(SLIDING_WINDOW_LUA)
+
+    async def hit(self, key: str, times: int, seconds: float) -> int:
+        try:
+            return int(await self._script(keys=[key], args=[int(seconds * 1000), times, uuid.uuid4().hex]))
+        except RedisError as err:
+            print(err)
+            return await self.fallback.hit(key, times, seconds)
+
+
+backend = LocalBackend()
+
+
+def init(new_backend):
+    """
+        Replaces the backend used by all rate limiters.
+
+        The local backend is used until this is called. Startup calls it with a RedisBackend only
+        when RATE_LIMIT_BACKEND is redis and Redis at REDIS_DOMAIN answers a ping.
+
+        :param new_backend: LocalBackend or RedisBackend.
+        :type new_backend: LocalBackend | RedisBackend
+        :return: Nothing.
+        :rtype: None
+        """
+    global backend
+    backend = new_backend
+
+
+def user_identifier(request: Request) -> str:
+    """
+        Key of the client: the subject of a valid bearer token, or the client ip otherwise.
+
+        :param request: request.
+        :type request: Request
+        :return: The client key.
+        :rtype: str
+        """
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    if scheme.lower() == "bearer" and token:
+        try:
+            payload = auth_service.verify_token(token)
+            if payload.get("sub"):
+                return f"user:{payload['sub']}"
+        except JWTError:
+            pass
+    return f"ip:{request.client.host if request.client else 'unknown'}"
+
+
+class RateLimiter:
+    """
+        Dependency that allows `times` calls per `seconds` for each user on a route.
+        """
+
+    def __init__(self, times: int, seconds: float, identifier=user_identifier):
+        self.times = times
+        self.seconds = seconds
+        self.identifier = identifier
+
+    async def __call__(self, request: Request):
+        route = request.scope.get("route")
+        path = route.path if route is not None else request.url.path
+        key = f"{config.RATE_LIMIT_PREFIX}:{self.identifier(request)}:{request.method}:{path}"
+        retry_after = await backend.hit(key, self.times, self.seconds)
+        if retry_after:
+            raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail="Too Many Requests",
+                                headers={"Retry-After": str(math.ceil(retry_after / 1000))})
@@ -0,0 +1,139 @@
+"""
+Password hashing policy.
+
+New hashes use argon2id with the memory and time costs of the config, bcrypt hashes
+stay valid and are replaced on the next successful login, as are argon2 hashes made
+with other costs. argon2 needs the argon2-cffi package, without it the service only
+starts with PASSWORD_SCHEME=bcrypt.
+
+``python -m src.services.passwords --target-ms 250`` measures this machine and prints
+the costs that make one verification take about that long.
+"""
+import argparse
+import statistics
+import time
+
+from passlib.context import CryptContext
+from passlib.hash import argon2
+
+from src.conf.config import config
+
+ARGON2 = "argon2"
+BCRYPT = "bcrypt"
+
+
+def argon2_available() -> bool:
+    return argon2.has_backend()
+
+
+def build_context(scheme: str = config.PASSWORD_SCHEME, memory_cost: int = config.ARGON2_MEMORY_COST,
+                  time_cost: int = config.ARGON2_TIME_COST, parallelism: int = config.ARGON2_PARALLELISM,
+                  bcrypt_rounds: int = config.BCRYPT_ROUNDS) -> CryptContext:
+    """
+        The context that hashes new passwords with the scheme and verifies both schemes.
+
+        argon2 hashes are only verifiable with argon2-cffi installed.
+
+        :param scheme: argon2 or bcrypt.
+        :type scheme: str
+        :param memory_cost: Memory of one argon2 hash in KiB.
+        :type memory_cost: int
+        :param time_cost: Passes of argon2 over the memory.
+        :type time_cost: int
+        :param parallelism: Lanes of argon2.
+        :type parallelism: int
+        :param bcrypt_rounds: The log2 cost of bcrypt.
+        :type bcrypt_rounds: int
+        :return: The context, hashes of the other scheme or other costs need an update.
+        :rtype: CryptContext
+        :raises RuntimeError: If the scheme is argon2 and argon2-cffi is missing.
+        """
+    if not argon2_available():
+        if scheme == ARGON2:
+            # failing here stops the service at startup, instead of every login with an argon2 hash failing
+            raise RuntimeError("PASSWORD_SCHEME is argon2 but argon2-cffi is not installed")
+        return CryptContext(schemes=[BCRYPT], deprecated="auto", bcrypt__rounds=bcrypt_rounds)
+    # the first scheme hashes, the other one is deprecated: it still verifies but needs an update
+    return CryptContext(schemes=[ARGON2, BCRYPT] if scheme == ARGON2 else [BCRYPT, ARGON2], deprecated="auto",
+                        argon2__type="ID", argon2__memory_cost=memory_cost, argon2__time_cost=time_cost,
+                        argon2__parallelism=parallelism, bcrypt__rounds=bcrypt_rounds)
+
+
+def verify_time(context: CryptContext, samples: int = 5) -> float:
+    """
+        Median time of verifying a password with the context.
+
+        :param context: The context to measure.
+        :type context: CryptContext
+        :param samples: The number of verifications.
+        :type samples: int
+        :return: Seconds.
+        :rtype: float
+        """
+    hashed = context.hash("calibration password")
+    times = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        context.verify("calibration password", hashed)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def calibrate(target: float, memory_cost: int = config.ARGON2_MEMORY_COST,
+              parallelism: int = config.ARGON2_PARALLELISM, scheme: str = config.PASSWORD_SCHEME,
+              max_time_cost: int = 20, max_rounds: int = 16) -> dict:
+    """
+        The cheapest costs whose verification takes at least the target time on this machine.
+
+        argon2 keeps the memory cost, which is bounded by the RAM of concurrent logins, and
+        raises the time cost; bcrypt raises the rounds.
+
+        :param target: The verify time to reach, in seconds.
+        :type target: float
+        :param memory_cost: Memory of one argon2 hash in KiB.
+        :type memory_cost: int
+        :param parallelism: Lanes of argon2.
+        :type parallelism: int
+        :param scheme: The scheme to calibrate.
+        :type scheme: str
+        :param max_time_cost: The highest argon2 time cost tried.
+        :type max_time_cost: int
+        :param max_rounds: The highest bcrypt cost tried.
+        :type max_rounds: int
+        :return: The config values and the measured verify time in seconds.
+        :rtype: dict
+        """
+    if scheme == ARGON2 and argon2_available():
+        for time_cost in range(1, max_time_cost + 1):
+            seconds = verify_time(build_context(ARGON2, memory_cost, time_cost, parallelism))
+            if seconds >= target:
+                break
+        return {"PASSWORD_SCHEME": ARGON2, "ARGON2_MEMORY_COST": memory_cost, "ARGON2_TIME_COST": time_cost,
+                "ARGON2_PARALLELISM": parallelism, "seconds": seconds}
+    for rounds in range(4, max_rounds + 1):
+        seconds = verify_time(build_context(BCRYPT, bcrypt_rounds=rounds), samples=3)
+        if seconds >= target:
+            break
+    return {"PASSWORD_SCHEME": BCRYPT, "BCRYPT_ROUNDS": rounds, "seconds": seconds}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pick password hashing costs for a target verify time")
+    parser.add_argument("--target-ms", type=float, default=250)
+    parser.add_argument("--memory-kib", type=int, default=config.ARGON2_MEMORY_COST)
+    parser.add_argument("--parallelism", type=int, default=config.ARGON2_PARALLELISM)
+    parser.add_argument("--scheme", choices=[ARGON2, BCRYPT], default=config.PASSWORD_SCHEME)
+    args = parser.parse_args()
+    if args.scheme == ARGON2 and not argon2_available():
+        print("argon2-cffi is not installed, calibrating bcrypt")
+    result = calibrate(args.target_ms / 1000, args.memory_kib, args.parallelism, args.scheme)
+    seconds = result.pop("seconds")
+    print(f"# one verification takes {seconds * 1000:.0f} ms")
+    if result.get("ARGON2_TIME_COST") == 1 and seconds > args.target_ms / 1000:
+        print("# already slower than the target at the lowest time cost, lower --memory-kib to go faster")
+    for name, value in result.items():
+        print(f"{name}={value}")
+
+
+if __name__ == "__main__":
+    main()
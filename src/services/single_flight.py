@@ -0,0 +1,106 @@
+import asyncio
+import functools
+
+from starlette.concurrency import run_in_threadpool
+
+
+class SingleFlight:
+    """
+        Lets concurrent identical calls share one execution and its result.
+        """
+
+    def __init__(self):
+        self._in_flight = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    async def do(self, key, fn, *args, scope=None):
+        """
+            Runs `fn(*args)` in a worker thread, unless a call with the same key is already running.
+
+            :param key: The key of identical calls.
+            :type key: Hashable
+            :param fn: The blocking function to run.
+            :type fn: Callable
+            :param scope: The data the call reads, a write to it stops later calls from joining this one.
+            :type scope: Hashable
+            :return: The result of the call that ran.
+            :rtype: Any
+            """
+        self.calls += 1
+        entry = self._in_flight.get(key)
+        if entry is not None:
+            future = entry[0]
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+                # the request that ran the call went away, run it ourselves
+                return await self.do(key, fn, *args, scope=scope)
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = (future, scope)
+        try:
+            result = await run_in_threadpool(fn, *args)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as err:
+            future.set_exception(err)
+            # mark the exception as retrieved when nobody else was waiting
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            # an invalidated call may have been replaced by a newer one with the same key
+            if self._in_flight.get(key, (None,))[0] is future:
+                del self._in_flight[key]
+
+    def invalidate(self, scope):
+        """
+            Called after a write to the scope is committed: calls that start afterwards run a new
+            execution instead of joining one that may have read the data before the write.
+
+            :param scope: The scope that was written.
+            :type scope: Hashable
+            :return: Nothing.
+            :rtype: None
+            """
+        for key in [key for key, (_, call_scope) in self._in_flight.items() if call_scope == scope]:
+            del self._in_flight[key]
+
+    def stats(self) -> dict:
+        return {"calls": self.calls, "coalesced": self.coalesced, "in_flight": len(self._in_flight)}
+
+
+flight = SingleFlight()
+
+
+def coalesce(key):
+    """
+        Shares one execution of a blocking read-only repository function between concurrent identical calls.
+
+        The function is sync and runs in a worker thread. Every caller gets the same result, so it
+        must be immutable: rows or frozen snapshots, never ORM instances of the session that loaded them.
+        The first item of the key is the scope of the data, usually the owner, which writes pass to
+        ``flight.invalidate`` so that later calls read their own writes.
+
+        :param key: Builds the key of identical calls from the arguments of the function, scope first.
+        :type key: Callable
+        :return: The decorator, the decorated function is a coroutine function.
+        :rtype: Callable
+        """
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            call_key = key(*args, **kwargs)
+            return await flight.do((func.__qualname__, call_key), functools.partial(func, *args, **kwargs),
+                                   scope=call_key[0])
+
+        return wrapper
+
+    return decorator
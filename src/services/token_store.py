@@ -0,0 +1,160 @@
+from datetime import datetime, timedelta
+
+from redis.exceptions import RedisError
+from sqlalchemy.orm import Session
+from src.database.models import RefreshToken
+
+# results of ROTATE_LUA
+ROTATED, REUSED, MISSING = 1, 0, -1
+
+ROTATE_LUA = """
+local user = redis.call('HGET', KEYS[1], 'user')
+local jti = redis.call('HGET', KEYS[1], 'jti')
+if not jti then
+    return -1
+end
+if user == ARGV[1] and jti == ARGV[2] then
+    redis.call('HSET', KEYS[1], 'jti', ARGV[3])
+    redis.call('EXPIRE', KEYS[1], ARGV[4])
+    redis.call('EXPIRE', KEYS[2], ARGV[4])
+    return 1
+end
+redis.call('DEL', KEYS[1])
+redis.call('SREM', KEYS[2], ARGV[5])
+return 0
+"""
+
+
+class DBTokenStore:
+    """
+        Refresh token families kept in the refresh_tokens table.
+        """
+
+    async def issue(self, user_id: int, family_id: str, jti: str, ttl: int, db: Session):
+        """
+            Starts (or restarts) a token family for a device.
+
+            :param user_id: The id of the user.
+            :type user_id: int
+            :param family_id: The id of the token family.
+            :type family_id: str
+            :param jti: The id of the current refresh token of the family.
+            :type jti: str
+            :param ttl: Lifetime of the family in seconds.
+            :type ttl: int
+            :param db: The database session.
+            :type db: Session
+            :return: Nothing.
+            :rtype: None
+            """
+        now = datetime.utcnow()
+        db.query(RefreshToken).filter(RefreshToken.user_id == user_id, RefreshToken.expires_at <= now).delete(
+            synchronize_session=False)
+        db.merge(RefreshToken(family_id=family_id, user_id=user_id, jti=jti, expires_at=now + timedelta(seconds=ttl)))
+        db.commit()
+
+    async def rotate(self, user_id: int, family_id: str, jti: str, new_jti: str, ttl: int, db: Session) -> bool:
+        """
+            Replaces the current token of a family.
+
+            Presenting any other token of the family is a reuse, the whole family is revoked then.
+
+            :return: True if the token was the current one and has been rotated.
+            :rtype: bool
+            """
+        now = datetime.utcnow()
+        rotated = db.query(RefreshToken).filter(
+            RefreshToken.family_id == family_id, RefreshToken.user_id == user_id, RefreshToken.jti == jti,
+            RefreshToken.expires_at > now).update(
+            {RefreshToken.jti: new_jti, RefreshToken.expires_at: now + timedelta(seconds=ttl)},
+            synchronize_session=False)
+        if not rotated:
+            db.query(RefreshToken).filter(RefreshToken.family_id == family_id).delete(synchronize_session=False)
+        db.commit()
+        return bool(rotated)
+
+    async def revoke_user(self, user_id: int, db: Session):
+        """
+            Revokes all token families of a user.
+
+            :param user_id: The id of the user.
+            :type user_id: int
+            :param db: The database session.
+            :type db: Session
+            :return: Nothing.
+            :rtype: None
+            """
+        db.query(RefreshToken).filter(RefreshToken.user_id == user_id).delete(synchronize_session=False)
+        db.commit()
+
+
+class RedisTokenStore:
+    """
+        Refresh token families kept in Redis, expired by key TTL.
+
+        Families are hashes ``rt:<family_id>`` with the owner and the current jti,
+        and ``rt:user:<user_id>`` is the set of families of a user. When Redis is
+        unavailable calls go to the fallback store, so families issued during an
+        outage are only known there: a family that Redis doesn't have is rotated
+        by the fallback, not taken for a reuse.
+        """
+
+    def __init__(self, redis, fallback: DBTokenStore | None = None, prefix: str = "rt"):
+        self.redis = redis
+        self.fallback = fallback or DBTokenStore()
+        self.prefix = prefix
+        self._rotate = redis.register_script(ROTATE_LUA)
+
+    def _family_key(self, family_id):
+        return f"{self.prefix}:{family_id}"
+
+    def _user_key(self, user_id):
+        return f"{self.prefix}:user:{user_id}"
+
+    async def issue(self, user_id: int, family_id: str, jti: str, ttl: int, db: Session):
+        try:
+            async with self.redis.pipeline(transaction=True) as pipe:
+                pipe.hset(self._family_key(family_id), mapping={"user": str(user_id), "jti": jti})
+                pipe.expire(self._family_key(family_id), ttl)
+                pipe.sadd(self._user_key(user_id), family_id)
+                pipe.expire(self._user_key(user_id), ttl)
+                await pipe.execute()
+        except RedisError as err:
+            print(err)
+            await self.fallback.issue(user_id, family_id, jti, ttl, db)
+
+    async def rotate(self, user_id: int, family_id: str, jti: str, new_jti: str, ttl: int, db: Session) -> bool:
+        try:
+            result = await self._rotate(keys=[self._family_key(family_id), self._user_key(user_id)],
+                                        args=[str(user_id), jti, new_jti, ttl, family_id])
+        except RedisError as err:
+            print(err)
+            return await self.fallback.rotate(user_id, family_id, jti, new_jti, ttl, db)
+        if int(result) == MISSING:
+            # issued during an outage, or unknown everywhere, which the fallback answers as a reuse
+            return await self.fallback.rotate(user_id, family_id, jti, new_jti, ttl, db)
+        return int(result) == ROTATED
+
+    async def revoke_user(self, user_id: int, db: Session):
+        try:
+            families = await self.redis.smembers(self._user_key(user_id))
+            await self.redis.delete(self._user_key(user_id), *[self._family_key(family) for family in families])
+        except RedisError as err:
+            print(err)
+        await self.fallback.revoke_user(user_id, db)
+
+
+store = DBTokenStore()
+
+
+def init(new_store):
+    """
+        Replaces the store used for refresh tokens.
+
+        :param new_store: DBTokenStore or RedisTokenStore.
+        :type new_store: DBTokenStore | RedisTokenStore
+        :return: Nothing.
+        :rtype: None
+        """
+    global store
+    store = new_store
@@ -0,0 +1,508 @@
+"""
+Request tracing.
+
+A request is a trace of spans: the request itself, its route, the auth dependency, the
+repository functions, every SQL statement, Redis commands and outbound email and
+Cloudinary calls. The trace id comes from the W3C ``traceparent`` header of the caller,
+or is new, and is returned in the ``traceresponse`` header.
+
+Whether a trace is recorded is decided once, at its start (head sampling): the sampled
+flag of callers in TRACING_TRUSTED_UPSTREAMS is followed, other traces are kept at
+TRACING_SAMPLE_RATE, so clients can't make the service record every request. Instrumented
+code of a trace that is not recorded only looks up a context variable.
+
+Spans go to an in-memory ring buffer, or with TRACING_FILE to a JSON lines file;
+``python -m src.services.tracing traces.jsonl`` prints the slowest traces as trees.
+"""
+import argparse
+import functools
+import inspect
+import ipaddress
+import json
+import re
+import secrets
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from fastapi.routing import APIRoute
+from redis.asyncio.client import Pipeline, Redis
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.datastructures import Headers, MutableHeaders
+
+from src.conf.config import config
+
+TRACEPARENT = re.compile(r"^([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})(-.*)?$")
+# statements are cut to this length, the parameters are never recorded
+MAX_STATEMENT_LENGTH = 500
+
+_current: ContextVar = ContextVar("current_span", default=None)
+
+
+def parse_traceparent(header: str | None) -> tuple[str, str, bool] | None:
+    """
+        Reads a W3C traceparent header.
+
+        :param header: The value of the header.
+        :type header: str | None
+        :return: The trace id, the parent span id and the sampled flag, None if the header is missing or invalid.
+        :rtype: tuple[str, str, bool] | None
+        """
+    match = TRACEPARENT.match(header.strip().lower()) if header else None
+    if match is None:
+        return None
+    version, trace_id, parent_id, flags, rest = match.groups()
+    if version == "ff" or (version == "00" and rest) or trace_id == "0" * 32 or parent_id == "0" * 16:
+        return None
+    return trace_id, parent_id, bool(int(flags, 16) & 1)
+
+
+class Span:
+    """
+        One timed operation of a trace. A span that is not sampled only carries the ids.
+        """
+
+    __slots__ = ("tracer", "name", "kind", "trace_id", "span_id", "parent_id", "sampled", "local_root",
+                 "start", "end", "attributes", "events", "status")
+
+    def __init__(self, tracer, name: str, trace_id: str, parent_id: str | None = None, sampled: bool = True,
+                 kind: str = "internal", start: int | None = None, local_root: bool = False):
+        self.tracer = tracer
+        self.name = name
+        self.kind = kind
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.local_root = local_root
+        self.start = start or time.time_ns()
+        self.end = None
+        self.attributes = {}
+        self.events = []
+        self.status = "ok"
+
+    def child(self, name: str, kind: str = "internal", start: int | None = None) -> "Span":
+        return Span(self.tracer, name, self.trace_id, self.span_id, self.sampled, kind, start)
+
+    def add_event(self, name: str):
+        self.events.append((name, time.time_ns()))
+
+    def fail(self, err: BaseException):
+        self.status = "error"
+        self.attributes["error"] = type(err).__name__
+
+    def finish(self, end: int | None = None):
+        self.end = end or time.time_ns()
+        if self.sampled:
+            self.tracer.export(self)
+
+    @property
+    def duration_ms(self) -> float:
+        return ((self.end or time.time_ns()) - self.start) / 1e6
+
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    def to_dict(self) -> dict:
+        return {"trace_id": self.trace_id, "span_id": self.span_id, "parent_id": self.parent_id, "name": self.name,
+                "kind": self.kind, "start": self.start, "duration_ms": round(self.duration_ms, 3),
+                "status": self.status, "attributes": self.attributes,
+                "events": [{"name": name, "time": at} for name, at in self.events]}
+
+
+class InMemoryExporter:
+    """
+        Keeps the latest finished spans.
+        """
+
+    def __init__(self, size: int = config.TRACING_BUFFER_SIZE):
+        self.spans = deque(maxlen=size)
+
+    def export(self, span: Span):
+        self.spans.append(span)
+
+    def trace(self, trace_id: str) -> list[Span]:
+        return [span for span in self.spans if span.trace_id == trace_id]
+
+    def stats(self) -> dict:
+        return {"exporter": "memory", "spans": len(self.spans)}
+
+
+class FileExporter:
+    """
+        Appends finished spans to a JSON lines file, one span per line.
+
+        Lines are buffered and written when the request that made them ends.
+        """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.exported = 0
+        self._lock = threading.Lock()
+        self._file = open(path, "a", encoding="utf-8")
+
+    def export(self, span: Span):
+        line = json.dumps(span.to_dict(), default=str)
+        with self._lock:
+            if self._file.closed:
+                # a request that was still running at shutdown
+                return
+            self._file.write(line + "\n")
+            self.exported += 1
+            if span.local_root:
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def stats(self) -> dict:
+        return {"exporter": "file", "path": self.path, "spans": self.exported}
+
+
+class Tracer:
+    """
+        Starts traces and takes the sampling decision for each of them.
+        """
+
+    def __init__(self, exporter=None, sample_rate: float = config.TRACING_SAMPLE_RATE,
+                 trusted_upstreams: list[str] = config.TRACING_TRUSTED_UPSTREAMS):
+        self.exporter = exporter if exporter is not None else InMemoryExporter()
+        self.sample_rate = sample_rate
+        self.trust_any = "*" in trusted_upstreams
+        self.trusted_networks = [ipaddress.ip_network(upstream, strict=False)
+                                 for upstream in trusted_upstreams if upstream != "*"]
+        self.traces = 0
+        self.sampled = 0
+
+    def should_sample(self, trace_id: str) -> bool:
+        # trace ids are random, so their low half is a uniform number
+        return int(trace_id[16:], 16) < self.sample_rate * 2 ** 64
+
+    def trusts(self, upstream: str | None) -> bool:
+        if self.trust_any:
+            return True
+        try:
+            address = ipaddress.ip_address(upstream)
+        except ValueError:
+            return False
+        return any(address in network for network in self.trusted_networks)
+
+    def start_trace(self, name: str, traceparent: str | None = None, kind: str = "server",
+                    upstream: str | None = None) -> Span:
+        """
+            Starts the local root span of a trace, it still has to be finished.
+
+            :param name: The name of the span.
+            :type name: str
+            :param traceparent: The traceparent header of the caller, it continues the trace.
+            :type traceparent: str | None
+            :param kind: The kind of the span.
+            :type kind: str
+            :param upstream: The address of the caller, its sampled flag is followed if it is trusted.
+            :type upstream: str | None
+            :return: The span.
+            :rtype: Span
+            """
+        parent = parse_traceparent(traceparent)
+        if parent is not None:
+            trace_id, parent_id, sampled = parent
+            if not self.trusts(upstream):
+                sampled = self.should_sample(trace_id)
+        else:
+            trace_id, parent_id = secrets.token_hex(16), None
+            sampled = self.should_sample(trace_id)
+        self.traces += 1
+        self.sampled += sampled
+        return Span(self, name, trace_id, parent_id, sampled, kind, local_root=True)
+
+    def export(self, span: Span):
+        self.exporter.export(span)
+
+    def close(self):
+        close = getattr(self.exporter, "close", None)
+        if close is not None:
+            close()
+
+    def stats(self) -> dict:
+        return {"sample_rate": self.sample_rate, "traces": self.traces, "sampled": self.sampled,
+                **self.exporter.stats()}
+
+
+tracer = Tracer()
+
+
+def init(new_tracer: Tracer):
+    """
+        Replaces the tracer of new requests.
+
+        :param new_tracer: The tracer.
+        :type new_tracer: Tracer
+        :return: Nothing.
+        :rtype: None
+        """
+    global tracer
+    tracer = new_tracer
+
+
+def current_span() -> Span | None:
+    return _current.get()
+
+
+def _recording() -> Span | None:
+    parent = _current.get()
+    return parent if parent is not None and parent.sampled else None
+
+
+@contextmanager
+def activate(span: Span):
+    """
+        Makes the span the parent of the spans started in the block.
+        """
+    token = _current.set(span)
+    try:
+        yield span
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def span(name: str, kind: str = "internal", **attributes):
+    """
+        Times the block as a child of the current span, when the trace is sampled.
+
+        :param name: The name of the span.
+        :type name: str
+        :param kind: internal, or client for calls to other services.
+        :type kind: str
+        :param attributes: Attributes of the span.
+        :return: The span, None when nothing is recorded.
+        :rtype: Span | None
+        """
+    parent = _recording()
+    if parent is None:
+        yield None
+        return
+    child = parent.child(name, kind)
+    child.attributes.update(attributes)
+    token = _current.set(child)
+    try:
+        yield child
+    except BaseException as err:
+        child.fail(err)
+        raise
+    finally:
+        _current.reset(token)
+        child.finish()
+
+
+def traced(func):
+    """
+        Wraps every call of the function, sync or async, in a span named after its module and name.
+        """
+    name = f"{func.__module__.removeprefix('src.')}.{func.__qualname__}"
+
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            if _recording() is None:
+                return await func(*args, **kwargs)
+            with span(name):
+                return await func(*args, **kwargs)
+    else:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _recording() is None:
+                return func(*args, **kwargs)
+            with span(name):
+                return func(*args, **kwargs)
+
+    return wrapper
+
+
+class TracingMiddleware:
+    """
+        Runs every HTTP request in a trace and answers with its ``traceresponse`` header.
+        """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        client = scope.get("client")
+        root = tracer.start_trace(f"{scope['method']} {scope['path']}", Headers(scope=scope).get("traceparent"),
+                                  upstream=client[0] if client else None)
+        root.attributes.update({"http.method": scope["method"], "http.target": scope["path"]})
+
+        async def send_traced(message):
+            if message["type"] == "http.response.start":
+                root.attributes["http.status_code"] = message["status"]
+                MutableHeaders(scope=message).append("traceresponse", root.traceparent())
+            await send(message)
+
+        try:
+            with activate(root):
+                await self.app(scope, receive, send_traced)
+        except BaseException as err:
+            root.fail(err)
+            raise
+        finally:
+            route = scope.get("route")
+            if route is not None:
+                # the template keeps the number of distinct span names small
+                root.name = f"{scope['method']} {route.path}"
+            root.finish()
+
+
+def _endpoint_span(call, name: str):
+    if inspect.iscoroutinefunction(call):
+        async def endpoint(**values):
+            parent = _recording()
+            if parent is None:
+                return await call(**values)
+            with span(name):
+                result = await call(**values)
+            parent.add_event("endpoint returned")
+            return result
+    else:
+        def endpoint(**values):
+            parent = _recording()
+            if parent is None:
+                return call(**values)
+            with span(name):
+                result = call(**values)
+            parent.add_event("endpoint returned")
+            return result
+    return endpoint
+
+
+class TracedRoute(APIRoute):
+    """
+        A route with a span for the whole handler, one for the endpoint function and one for
+        the validation and serialization of its result. Dependencies are children of the route span.
+        """
+
+    def __init__(self, path: str, endpoint, **kwargs):
+        super().__init__(path, endpoint, **kwargs)
+        # the parameters were read from the endpoint already, FastAPI calls it with keywords
+        self.dependant.call = _endpoint_span(self.dependant.call, f"endpoint {endpoint.__name__}")
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def traced_handler(request):
+            with span(f"route {self.path}", **{"http.route": self.path}) as route_span:
+                response = await handler(request)
+                if route_span is not None and route_span.events:
+                    route_span.child("serialize", start=route_span.events[-1][1]).finish()
+            return response
+
+        return traced_handler
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    parent = _recording()
+    if parent is None:
+        return
+    sql = parent.child(f"sql {statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ''}", "client")
+    sql.attributes.update({"db.system": conn.dialect.name, "db.statement": statement[:MAX_STATEMENT_LENGTH]})
+    conn.info.setdefault("trace_spans", []).append(sql)
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    spans = conn.info.get("trace_spans")
+    if spans:
+        sql = spans.pop()
+        if cursor.description is None and cursor.rowcount >= 0:
+            sql.attributes["db.rows"] = cursor.rowcount
+        sql.finish()
+
+
+def _handle_error(exception_context):
+    conn = exception_context.connection
+    spans = conn.info.get("trace_spans") if conn is not None else None
+    if spans:
+        sql = spans.pop()
+        sql.fail(exception_context.original_exception)
+        sql.finish()
+
+
+def instrument_sqlalchemy():
+    """
+        Records a span for every statement of every engine. Safe to call more than once.
+        """
+    for name, listener in (("before_cursor_execute", _before_cursor_execute),
+                           ("after_cursor_execute", _after_cursor_execute), ("handle_error", _handle_error)):
+        if not event.contains(Engine, name, listener):
+            event.listen(Engine, name, listener)
+
+
+class TracedPipeline(Pipeline):
+    async def execute(self, raise_on_error: bool = True):
+        if _recording() is None:
+            return await super().execute(raise_on_error)
+        with span("redis PIPELINE", "client", **{"db.system": "redis", "db.commands": len(self.command_stack)}):
+            return await super().execute(raise_on_error)
+
+
+class TracedRedis(Redis):
+    """
+        Redis client with a span for every command and pipeline.
+        """
+
+    async def execute_command(self, *args, **options):
+        if _recording() is None:
+            return await super().execute_command(*args, **options)
+        with span(f"redis {str(args[0]).upper()}", "client", **{"db.system": "redis"}):
+            return await super().execute_command(*args, **options)
+
+    def pipeline(self, transaction: bool = True, shard_hint: str | None = None) -> TracedPipeline:
+        return TracedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+def _print_tree(spans: list[dict]):
+    children = defaultdict(list)
+    ids = {span["span_id"] for span in spans}
+    for span_dict in sorted(spans, key=lambda item: item["start"]):
+        children[span_dict["parent_id"] if span_dict["parent_id"] in ids else None].append(span_dict)
+
+    def walk(parent_id, depth):
+        for item in children[parent_id]:
+            own = item["duration_ms"] - sum(child["duration_ms"] for child in children[item["span_id"]])
+            statement = item["attributes"].get("db.statement", "")
+            print(f"{item['duration_ms']:>9.2f} {max(own, 0):>9.2f}  {'  ' * depth}{item['name']}"
+                  f"{'  ' + statement[:60] if statement else ''}")
+            walk(item["span_id"], depth + 1)
+
+    walk(None, 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Print the slowest traces of a TRACING_FILE")
+    parser.add_argument("path")
+    parser.add_argument("--slowest", type=int, default=5)
+    args = parser.parse_args()
+    traces = defaultdict(list)
+    with open(args.path, encoding="utf-8") as file:
+        for line in file:
+            span_dict = json.loads(line)
+            traces[span_dict["trace_id"]].append(span_dict)
+
+    def duration(spans):
+        return max((span_dict["duration_ms"] for span_dict in spans), default=0)
+
+    for trace_id, spans in sorted(traces.items(), key=lambda item: duration(item[1]), reverse=True)[:args.slowest]:
+        print(f"trace {trace_id}, {duration(spans):.2f} ms")
+        print(f"{'total ms':>9} {'self ms':>9}")
+        _print_tree(spans)
+        print()
+
+
+if __name__ == "__main__":
+    main()
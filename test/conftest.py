@@ -4,37 +4,88 @@ from os.path import dirname as d
 
 root_dir = d(d(abspath(__file__)))
 sys.path.append(root_dir)
+from contextlib import contextmanager
+from unittest.mock import AsyncMock
+from urllib.parse import urlsplit
+
 import pytest
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import StaticPool
 
 from src.database.models import Base
 from main import app
+from src.database.auth import auth_service
 from src.database.db import get_db
+from src.database.query_budget import QueryBudget, QueryCounter, route_budget
+from src.services import email_filter, events, limiter, passwords, tracing
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
+# in memory, so every process (and every pytest-xdist worker) has its own database
+SQLALCHEMY_DATABASE_URL = "sqlite://"
 
 engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
+    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}, poolclass=StaticPool
 )
-TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
+@event.listens_for(engine, "connect")
+def do_connect(dbapi_connection, connection_record):
+    # let SQLAlchemy emit BEGIN, so that SAVEPOINTs work with pysqlite
+    dbapi_connection.isolation_level = None
+
+
+@event.listens_for(engine, "begin")
+def do_begin(conn):
+    conn.exec_driver_sql("BEGIN")
+
+
+Base.metadata.create_all(bind=engine)
+
+
+def pytest_configure(config):
+    # tests of a module share its transaction and build on each other, so a module runs on one xdist worker
+    if getattr(config.option, "dist", "no") == "load":
+        config.option.dist = "loadfile"
 
 
 @pytest.fixture(scope="module")
-def session():
-    # Create the database
+def connection():
+    # everything a test module writes is rolled back at its end instead of recreating the tables
+    conn = engine.connect()
+    transaction = conn.begin()
+    try:
+        yield conn
+    finally:
+        transaction.rollback()
+        conn.close()
 
-    Base.metadata.drop_all(bind=engine)
-    Base.metadata.create_all(bind=engine)
 
-    db = TestingSessionLocal()
+@pytest.fixture(scope="module")
+def session(connection):
+    # commits of the code under test only release SAVEPOINTs, the module transaction stays open
+    db = Session(bind=connection, join_transaction_mode="create_savepoint", autoflush=False)
     try:
         yield db
     finally:
         db.close()
 
 
+@pytest.fixture
+def db_session(connection):
+    """
+        A session whose changes are rolled back after the test.
+        """
+    savepoint = connection.begin_nested()
+    db = Session(bind=connection, join_transaction_mode="create_savepoint", autoflush=False)
+    try:
+        yield db
+    finally:
+        db.close()
+        if savepoint.is_active:
+            savepoint.rollback()
+
+
 @pytest.fixture(scope="module")
 def client(session):
     # Dependency override
@@ -49,7 +100,60 @@ def client(session):
 
     yield TestClient(app)
 
+    app.dependency_overrides.pop(get_db, None)
+
+
+@pytest.fixture(autouse=True)
+def local_services(monkeypatch):
+    # nothing talks to Redis or sends mail, and every test starts with fresh rate limits
+    monkeypatch.setattr(limiter, "backend", limiter.LocalBackend())
+    monkeypatch.setattr(events, "broker", events.InMemoryBroker())
+    # not built, so every email may exist until a test builds one
+    monkeypatch.setattr(email_filter, "registered", email_filter.LocalEmailFilter())
+    # only requests with a sampled traceparent are traced, into a buffer of the test
+    monkeypatch.setattr(tracing, "tracer", tracing.Tracer(tracing.InMemoryExporter(), sample_rate=0,
+                                                          trusted_upstreams=["*"]))
+    monkeypatch.setattr("src.routes.users.send_email", AsyncMock())
+    monkeypatch.setattr("src.services.email.FastMail.send_message", AsyncMock())
+    # the cheapest hashing costs, hashing at the production costs dominates the run time
+    monkeypatch.setattr(auth_service, "pwd_context",
+                        passwords.build_context(memory_cost=64, time_cost=1, parallelism=1, bcrypt_rounds=4))
+
 
 @pytest.fixture(scope="module")
 def user():
     return {"username": "deadpool", "email": "deadpool@example.com", "password": "123456789"}
+
+
+@pytest.fixture(autouse=True)
+def route_query_budgets(monkeypatch):
+    # every request of the test client has to stay within the query budget of its route
+    request = TestClient.request
+
+    def checked_request(self, method, url, *args, **kwargs):
+        path = urlsplit(str(url)).path
+        budget = route_budget(self.app, method, path)
+        if budget is None:
+            return request(self, method, url, *args, **kwargs)
+        with QueryCounter() as counter:
+            response = request(self, method, url, *args, **kwargs)
+        budget.check(counter, f"{method.upper()} {path}")
+        return response
+
+    monkeypatch.setattr(TestClient, "request", checked_request)
+
+
+@pytest.fixture
+def query_budget():
+    """
+        Fails the test when the block runs more statements or rows than allowed:
+        ``with query_budget(statements=2, rows=10): ...``
+        """
+
+    @contextmanager
+    def within(statements=None, rows=None):
+        with QueryCounter() as counter:
+            yield counter
+        QueryBudget(statements, rows).check(counter)
+
+    return within
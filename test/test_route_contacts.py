@@ -0,0 +1,138 @@
+from datetime import date
+
+import pytest
+
+from src.database.models import User
+from src.routes.contacts import MAX_PAGE_SIZE
+from src.schemas import MAX_BULK_CONTACTS, MAX_MERGED_DUPLICATES
+from src.services import tracing
+
+
+@pytest.fixture
+def headers(client, session):
+    # function scoped, so that signing up and logging in use the cheap password hashing of the tests
+    body = {"username": "wolverine", "email": "wolverine@example.com", "password": "123456789"}
+    if session.query(User).filter(User.email == body["email"]).first() is None:
+        client.post("/api/users/signup", json=body)
+        current_user: User = session.query(User).filter(User.email == body["email"]).first()
+        current_user.confirmed = True
+        session.commit()
+    response = client.post("/api/users/login", data={"username": body["email"], "password": body["password"]})
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+
+def contact(number: int) -> dict:
+    return {"name": "Logan", "surname": f"Howlett{number}", "email": f"logan{number}@example.com",
+            "phone": f"09712345{number:02d}", "description": "friend", "birth_date": date.today().isoformat(),
+            "created_at": "2024-01-01T00:00:00", "updated_at": "2024-01-01T00:00:00"}
+
+
+def test_create_contact(client, headers):
+    response = client.post("/api/contacts/contact", json=contact(1), headers=headers)
+    assert response.status_code == 201, response.text
+    assert response.json()["email"] == "logan1@example.com"
+
+
+def test_create_contacts_bulk(client, headers):
+    response = client.post("/api/contacts/bulk", json={"contacts": [contact(number) for number in range(2, 12)]},
+                           headers=headers)
+    assert response.status_code == 201, response.text
+    assert len(response.json()) == 10
+
+
+def test_get_contacts(client, headers):
+    response = client.get("/api/contacts/", params={"limit": 100, "include_total": True}, headers=headers)
+    assert response.status_code == 200, response.text
+    assert len(response.json()) == 11
+    assert response.headers["X-Total-Count"] == "11"
+
+
+def test_get_contacts_traced(client, headers):
+    trace_id = "4bf92f3577b34da6a3ce929d0e0e4736"
+    response = client.get("/api/contacts/", headers=dict(headers, traceparent=f"00-{trace_id}-00f067aa0ba902b7-01"))
+    assert response.status_code == 200, response.text
+    assert response.headers["traceresponse"].startswith(f"00-{trace_id}-")
+    spans = {span.span_id: span for span in tracing.tracer.exporter.trace(trace_id)}
+    names = [span.name for span in spans.values()]
+    assert "GET /api/contacts/" in names
+    for name in ["route /api/contacts/", "endpoint get_contacts", "serialize", "database.auth.Auth.get_current_user",
+                 "database.auth.Auth.verify_token", "repository.contacts.get_contacts", "sql SELECT"]:
+        assert name in names, names
+    # the statements of the repository function are its children
+    query = next(span for span in spans.values() if span.name == "repository.contacts.get_contacts")
+    assert any(span.parent_id == query.span_id and span.name == "sql SELECT" for span in spans.values())
+
+
+def test_get_contacts_not_sampled(client, headers):
+    response = client.get("/api/contacts/", headers=headers)
+    assert response.status_code == 200, response.text
+    assert response.headers["traceresponse"].endswith("-00")
+    assert len(tracing.tracer.exporter.spans) == 0
+
+
+def test_get_contact_stats(client, headers):
+    response = client.get("/api/contacts/stats", headers=headers)
+    assert response.status_code == 200, response.text
+    assert response.json()["total"] == 11
+
+
+def test_get_contact_by_email(client, headers):
+    response = client.get("/api/contacts/by_email/logan1@example.com", headers=headers)
+    assert response.status_code == 200, response.text
+    assert response.json()["surname"] == "Howlett1"
+
+
+def test_get_birthdays(client, headers):
+    response = client.get("/api/contacts/get_birthdays", headers=headers)
+    assert response.status_code == 200, response.text
+    assert len(response.json()) == 11
+
+
+def test_update_contact(client, headers):
+    contact_id = client.get("/api/contacts/by_email/logan2@example.com", headers=headers).json()["id"]
+    response = client.put(f"/api/contacts/{contact_id}", json=dict(contact(2), name="James"), headers=headers)
+    assert response.status_code == 200, response.text
+    assert response.json()["name"] == "James"
+
+
+def test_merge_contacts(client, headers):
+    contacts = client.get("/api/contacts/", params={"limit": 100}, headers=headers).json()
+    response = client.post("/api/contacts/merge", json={"primary_id": contacts[0]["id"],
+                                                        "duplicate_ids": [item["id"] for item in contacts[1:4]]},
+                           headers=headers)
+    assert response.status_code == 200, response.text
+
+
+def test_remove_contact(client, headers):
+    contact_id = client.get("/api/contacts/", headers=headers).json()[0]["id"]
+    response = client.delete(f"/api/contacts/{contact_id}", headers=headers)
+    assert response.status_code == 200, response.text
+    assert client.get("/api/contacts/stats", headers=headers).json()["total"] == 7
+
+
+def test_budgets_hold_for_the_largest_requests(client, session):
+    # the route budgets are derived from the largest bodies and pages, the query budget fixture checks them
+    body = {"username": "storm", "email": "storm@example.com", "password": "123456789"}
+    client.post("/api/users/signup", json=body)
+    session.query(User).filter(User.email == body["email"]).update({User.confirmed: True})
+    session.commit()
+    response = client.post("/api/users/login", data={"username": body["email"], "password": body["password"]})
+    headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+    for start in (0, MAX_BULK_CONTACTS):
+        contacts = [dict(contact(number), email=f"storm{number}@example.com",
+                         birth_date=date(1990, number % 12 + 1, 1).isoformat())
+                    for number in range(start, start + MAX_BULK_CONTACTS)]
+        response = client.post("/api/contacts/bulk", json={"contacts": contacts}, headers=headers)
+        assert response.status_code == 201, response.text
+        # the first count computes the counters, the second bulk then updates all of them
+        response = client.get("/api/contacts/", params={"limit": MAX_PAGE_SIZE, "offset": start, "include_total": True},
+                              headers=headers)
+        assert response.status_code == 200, response.text
+        assert response.headers["X-Total-Count"] == str(start + MAX_BULK_CONTACTS)
+    ids = [item["id"] for item in response.json()]
+    ids += [item["id"] for item in client.get("/api/contacts/", params={"limit": MAX_PAGE_SIZE},
+                                              headers=headers).json()]
+    response = client.post("/api/contacts/merge", json={"primary_id": ids[0],
+                                                        "duplicate_ids": ids[1:MAX_MERGED_DUPLICATES + 1]},
+                           headers=headers)
+    assert response.status_code == 200, response.text
@@ -1,6 +1,10 @@
+import asyncio
 from unittest.mock import MagicMock
 
+from src.database.auth import auth_service
 from src.database.models import User
+from src.services import email_filter, passwords
+from src.services.limiter import LocalBackend
 
 
 def test_create_user(client, user, monkeypatch):
@@ -27,6 +31,14 @@ def test_repeat_create_user(client, user):
     assert data["detail"] == "Account already exists"
 
 
+def test_repeat_create_user_skips_hashing(client, user, monkeypatch):
+    get_password_hash = MagicMock()
+    monkeypatch.setattr(auth_service, "get_password_hash", get_password_hash)
+    response = client.post("/api/users/signup", json=user)
+    assert response.status_code == 409, response.text
+    get_password_hash.assert_not_called()
+
+
 def test_login_user_not_confirmed(client, user):
     response = client.post(
         "/api/users/login",
@@ -68,3 +80,85 @@ def test_login_wrong_email(client, user):
     assert response.status_code == 401, response.text
     data = response.json()
     assert data["detail"] == "Invalid email"
+
+
+def test_login_unknown_email_skips_database(client, session, user, monkeypatch, query_budget):
+    registered = email_filter.LocalEmailFilter(lambda: session, capacity=1000, error_rate=0.001)
+    asyncio.run(registered.rebuild())
+    monkeypatch.setattr(email_filter, "registered", registered)
+    with query_budget(statements=0):
+        response = client.post(
+            "/api/users/login",
+            data={"username": "nobody@example.com", "password": user.get('password')},
+        )
+    assert response.status_code == 401, response.text
+    assert response.json()["detail"] == "Invalid email"
+    response = client.post(
+        "/api/users/login",
+        data={"username": user.get('email'), "password": user.get('password')},
+    )
+    assert response.status_code == 201, response.text
+
+
+def test_update_avatar(client, user, monkeypatch):
+    cloudinary = MagicMock()
+    cloudinary.CloudinaryImage.return_value.build_url.return_value = "https://res.cloudinary.com/avatar.png"
+    monkeypatch.setattr("src.routes.users.cloudinary", cloudinary)
+    response = client.post(
+        "/api/users/login",
+        data={"username": user.get('email'), "password": user.get('password')},
+    )
+    access_token = response.json()["access_token"]
+    response = client.patch("/api/users/avatar", files={"file": ("avatar.png", b"png")},
+                            headers={"Authorization": f"Bearer {access_token}"})
+    assert response.status_code == 200, response.text
+    assert response.json()["user"]["avatar"] == "https://res.cloudinary.com/avatar.png"
+
+
+def test_login_rehashes_password(client, session, user, monkeypatch):
+    monkeypatch.setattr(auth_service, "pwd_context", passwords.build_context(passwords.BCRYPT, bcrypt_rounds=5))
+    response = client.post(
+        "/api/users/login",
+        data={"username": user.get('email'), "password": user.get('password')},
+    )
+    assert response.status_code == 201, response.text
+    current_user: User = session.query(User).filter(User.email == user.get('email')).first()
+    session.refresh(current_user)
+    assert current_user.password.startswith("$2b$05$")
+
+
+def test_refresh_token_rotation(client, user, monkeypatch):
+    monkeypatch.setattr("src.services.limiter.backend", LocalBackend())
+    response = client.post(
+        "/api/users/login",
+        data={"username": user.get('email'), "password": user.get('password')},
+    )
+    first = response.json()["refresh"]
+    response = client.get("/api/users/refresh_token", headers={"Authorization": f"Bearer {first}"})
+    assert response.status_code == 200, response.text
+    assert response.json()["refresh_token"] != first
+
+
+def test_refresh_token_reuse(client, user, monkeypatch):
+    monkeypatch.setattr("src.services.limiter.backend", LocalBackend())
+    response = client.post(
+        "/api/users/login",
+        data={"username": user.get('email'), "password": user.get('password')},
+        headers={"X-Device-Id": "phone"},
+    )
+    first = response.json()["refresh"]
+    rotated = client.get("/api/users/refresh_token", headers={"Authorization": f"Bearer {first}"})
+    assert rotated.status_code == 200, rotated.text
+    response = client.get("/api/users/refresh_token", headers={"Authorization": f"Bearer {first}"})
+    assert response.status_code == 401, response.text
+    assert response.json()["detail"] == "Invalid refresh token"
+
+
+def test_refresh_token_without_family(client, user, monkeypatch):
+    monkeypatch.setattr("src.services.limiter.backend", LocalBackend())
+    revoke_user_tokens = MagicMock()
+    monkeypatch.setattr(auth_service, "revoke_user_tokens", revoke_user_tokens)
+    legacy = asyncio.run(auth_service.create_refresh_token(data={"sub": user.get('email')}))
+    response = client.get("/api/users/refresh_token", headers={"Authorization": f"Bearer {legacy}"})
+    assert response.status_code == 401, response.text
+    revoke_user_tokens.assert_not_called()
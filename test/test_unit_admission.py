@@ -0,0 +1,101 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath('..'))
+
+import asyncio
+import unittest
+
+from src.services.admission import AUTH, BULK, DEFAULT, AdmissionController, Overloaded, classify
+
+
+class TestAdmissionController(unittest.IsolatedAsyncioTestCase):
+
+    async def test_queued_request_gets_released_slot(self):
+        controller = AdmissionController(1, queue_size=2, queue_timeout=1)
+        await controller.acquire(DEFAULT)
+        waiter = asyncio.create_task(controller.acquire(DEFAULT))
+        await asyncio.sleep(0)
+        self.assertFalse(waiter.done())
+        controller.release(DEFAULT, 0.01)
+        await waiter
+        self.assertEqual(controller.in_flight, 1)
+
+    async def test_timeout_sheds(self):
+        controller = AdmissionController(1, queue_size=2, queue_timeout=0.01)
+        await controller.acquire(DEFAULT)
+        with self.assertRaises(Overloaded):
+            await controller.acquire(DEFAULT)
+        self.assertEqual(controller.shed, 1)
+
+    async def test_auth_goes_first_and_pushes_out_bulk(self):
+        controller = AdmissionController(1, queue_size=2, queue_timeout=1)
+        await controller.acquire(DEFAULT)
+        first = asyncio.create_task(controller.acquire(DEFAULT))
+        bulk = asyncio.create_task(controller.acquire(BULK))
+        await asyncio.sleep(0)
+        auth = asyncio.create_task(controller.acquire(AUTH))
+        await asyncio.sleep(0)
+        with self.assertRaises(Overloaded):
+            await bulk
+        controller.release(DEFAULT, 0.01)
+        await auth
+        self.assertFalse(first.done())
+        controller.release(AUTH, 0.01)
+        await first
+
+    async def test_bulk_is_shed_when_its_share_is_full(self):
+        controller = AdmissionController(1, queue_size=4, queue_timeout=1)
+        await controller.acquire(DEFAULT)
+        queued = asyncio.create_task(controller.acquire(BULK))
+        await asyncio.sleep(0)
+        with self.assertRaises(Overloaded):
+            await controller.acquire(BULK)
+        controller.release(DEFAULT, 0.01)
+        await queued
+
+    async def test_limit_growth_admits_every_waiter_with_room(self):
+        controller = AdmissionController(10, queue_size=4, queue_timeout=1)
+        controller.classes[DEFAULT].limit = 2.9
+        await controller.acquire(DEFAULT)
+        await controller.acquire(DEFAULT)
+        waiters = [asyncio.create_task(controller.acquire(DEFAULT)) for _ in range(2)]
+        await asyncio.sleep(0)
+        controller.release(DEFAULT, 0.01)
+        self.assertEqual(int(controller.classes[DEFAULT].limit), 3)
+        await asyncio.gather(*waiters)
+        self.assertEqual(controller.in_flight, 3)
+
+    async def test_full_class_does_not_hold_up_others(self):
+        controller = AdmissionController(3, queue_size=4, queue_timeout=1)
+        controller.classes[BULK].limit = 1
+        await controller.acquire(BULK)
+        bulk = asyncio.create_task(controller.acquire(BULK))
+        await asyncio.sleep(0)
+        await controller.acquire(DEFAULT)
+        self.assertFalse(bulk.done())
+        self.assertEqual(controller.stats()["classes"]["default"]["in_flight"], 1)
+        controller.release(BULK, 0.01)
+        await bulk
+
+    def test_limit_adapts_to_latency_per_class(self):
+        controller = AdmissionController(10, min_limit=2, target_latency=0.1)
+        controller.classes[BULK].in_flight = 1
+        controller.release(BULK, 1.0)
+        self.assertEqual(int(controller.classes[BULK].limit), 9)
+        self.assertEqual(int(controller.classes[AUTH].limit), 10)
+        controller.classes[BULK].latency = None
+        for _ in range(50):
+            controller.classes[BULK].in_flight = 1
+            controller.release(BULK, 0.01)
+        self.assertEqual(int(controller.classes[BULK].limit), 10)
+
+    def test_classify(self):
+        self.assertEqual(classify("/api/users/login"), AUTH)
+        self.assertEqual(classify("/api/contacts/duplicates"), BULK)
+        self.assertEqual(classify("/api/contacts/"), DEFAULT)
+        self.assertIsNone(classify("/api/healthchecker"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath('..'))
+
+import time
+import unittest
+from unittest.mock import patch
+
+from jose import JWTError, jwt
+
+from src.database.auth import Auth, TokenCache
+
+
+class TestTokenCache(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.auth = Auth()
+        self.auth.token_cache = TokenCache(maxsize=2)
+
+    async def test_repeat_verification_skips_decode(self):
+        token = await self.auth.create_access_token(data={"sub": "a@example.com"})
+        payload = self.auth.verify_token(token)
+        with patch("src.database.auth.jwt.decode") as decode:
+            self.assertEqual(self.auth.verify_token(token), payload)
+            decode.assert_not_called()
+
+    async def test_expired_entry_is_dropped(self):
+        token = await self.auth.create_access_token(data={"sub": "a@example.com"})
+        self.auth.token_cache.put(token, {"sub": "a@example.com", "exp": time.time() - 1})
+        self.assertIsNone(self.auth.token_cache.get(token))
+
+    async def test_lru_is_bounded(self):
+        tokens = [await self.auth.create_access_token(data={"sub": f"{i}@example.com"}) for i in range(3)]
+        for token in tokens:
+            self.auth.verify_token(token)
+        self.assertIsNone(self.auth.token_cache.get(tokens[0]))
+        self.assertIsNotNone(self.auth.token_cache.get(tokens[2]))
+
+    async def test_revoked_token_is_rejected(self):
+        token = await self.auth.create_access_token(data={"sub": "a@example.com"})
+        self.auth.verify_token(token)
+        self.auth.revoke_token(token)
+        with self.assertRaises(JWTError):
+            self.auth.verify_token(token)
+
+    async def test_revoked_subject_is_rejected(self):
+        token = jwt.encode({"sub": "a@example.com", "iat": int(time.time()) - 10, "exp": time.time() + 60,
+                            "scope": "access_token"}, self.auth.SECRET_KEY, algorithm=self.auth.ALGORITHM)
+        self.auth.verify_token(token)
+        self.auth.revoke_user_tokens("a@example.com")
+        with self.assertRaises(JWTError):
+            self.auth.verify_token(token)
+
+    async def test_token_issued_after_revocation_in_same_second_is_valid(self):
+        old = await self.auth.create_access_token(data={"sub": "a@example.com"})
+        with patch("src.database.auth.time.time", side_effect=lambda: 1_000_000_000.25):
+            self.auth.token_cache.revoke_subject("a@example.com")
+        payload = jwt.get_unverified_claims(old)
+        self.assertIsInstance(payload["iat"], float)
+        issued_before = dict(payload, iat=1_000_000_000.1)
+        issued_after = dict(payload, iat=1_000_000_000.5)
+        self.assertTrue(self.auth.token_cache.is_revoked("before", issued_before))
+        self.assertFalse(self.auth.token_cache.is_revoked("after", issued_after))
+
+    async def test_revoked_subjects_are_forgotten_after_access_token_ttl(self):
+        cache = TokenCache(subject_ttl=60)
+        with patch("src.database.auth.time.time", return_value=1000):
+            cache.revoke_subject("a@example.com")
+        with patch("src.database.auth.time.time", return_value=1030):
+            cache.revoke_subject("b@example.com")
+        with patch("src.database.auth.time.time", return_value=1070):
+            cache.revoke_subject("c@example.com")
+        self.assertEqual(sorted(cache._revoked_subjects), ["b@example.com", "c@example.com"])
+
+
+if __name__ == '__main__':
+    unittest.main()
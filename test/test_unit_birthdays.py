@@ -0,0 +1,132 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath('..'))
+
+import json
+import tempfile
+import unittest
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from src.database.models import Base, Contact, User
+from src.services.birthdays import DigestsNotSent, run, run_until_sent
+from src.services.email import send_birthday_digests
+
+
+class TestBirthdayDigests(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.checkpoint = Path(self.tmp.name) / "checkpoint.json"
+        engine = create_engine(f"sqlite:///{self.tmp.name}/test.db")
+        Base.metadata.create_all(bind=engine)
+        self.Session = sessionmaker(bind=engine)
+        with self.Session() as db:
+            for i in range(1, 4):
+                db.add(User(id=i, username=f"user{i}", email=f"user{i}@example.com", password="x"))
+                db.add(Contact(name=f"soon{i}", surname="a", birth_date=date(1990, 1, 2), user_id=i))
+                db.add(Contact(name=f"late{i}", surname="b", birth_date=date(1990, 3, 1), user_id=i))
+            db.add(Contact(name="wrap", surname="c", birth_date=date(1985, 12, 30), user_id=1))
+            db.commit()
+        self.sent = []
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    async def send(self, batch):
+        self.sent.append(batch)
+        return [None] * len(batch)
+
+    async def test_digests_are_batched_per_user(self):
+        count = await run(today=date(2026, 12, 29), days=7, batch_size=2, checkpoint=self.checkpoint,
+                          session_factory=self.Session, send=self.send)
+        self.assertEqual(count, 3)
+        self.assertEqual([len(batch) for batch in self.sent], [2, 1])
+        first = self.sent[0][0]
+        self.assertEqual(first["email"], "user1@example.com")
+        self.assertEqual(sorted(c["name"] for c in first["contacts"]), ["soon1", "wrap"])
+
+    async def test_run_resumes_from_checkpoint(self):
+        async def fail_after_first(batch):
+            self.sent.append(batch)
+            if len(self.sent) == 2:
+                raise RuntimeError("mail server is down")
+            return [None] * len(batch)
+
+        with self.assertRaises(RuntimeError):
+            await run(today=date(2026, 12, 29), days=7, batch_size=1, checkpoint=self.checkpoint,
+                      session_factory=self.Session, send=fail_after_first)
+        self.sent = []
+        count = await run(today=date(2026, 12, 29), days=7, batch_size=1, checkpoint=self.checkpoint,
+                          session_factory=self.Session, send=self.send)
+        self.assertEqual(count, 2)
+        self.assertEqual([batch[0]["user_id"] for batch in self.sent], [2, 3])
+
+    async def test_failed_digests_are_sent_again(self):
+        async def fail_second(batch):
+            self.sent.append(batch)
+            return [None, ConnectionError("refused"), None]
+
+        with self.assertRaises(DigestsNotSent) as raised:
+            await run(today=date(2026, 12, 29), days=7, batch_size=3, checkpoint=self.checkpoint,
+                      session_factory=self.Session, send=fail_second)
+        self.assertIsInstance(raised.exception.__cause__, ConnectionError)
+        self.assertEqual(json.loads(self.checkpoint.read_text())["user_id"], 1)
+        self.assertEqual(json.loads(self.checkpoint.read_text())["sent"], [3])
+        self.sent = []
+        count = await run(today=date(2026, 12, 29), days=7, batch_size=3, checkpoint=self.checkpoint,
+                          session_factory=self.Session, send=self.send)
+        self.assertEqual(count, 1)
+        self.assertEqual([digest["user_id"] for digest in self.sent[0]], [2])
+        self.assertEqual(json.loads(self.checkpoint.read_text()), {"date": "2026-12-29", "user_id": 3, "sent": []})
+
+    async def test_failed_run_is_retried_the_same_day(self):
+        attempts = []
+
+        async def job(today):
+            attempts.append(today)
+            if len(attempts) < 3:
+                raise DigestsNotSent("1 of 3 birthday digests weren't sent, first to user 2")
+            return 3
+
+        deadline = datetime.now() + timedelta(days=1)
+        self.assertEqual(await run_until_sent(date(2026, 1, 1), deadline, retry_delay=0, job=job), 3)
+        self.assertEqual(attempts, [date(2026, 1, 1)] * 3)
+
+    async def test_retries_stop_at_the_next_run(self):
+        job = MagicMock(side_effect=DigestsNotSent("failed"))
+        self.assertIsNone(await run_until_sent(date(2026, 1, 1), datetime.now(), retry_delay=60, job=job))
+        job.assert_called_once()
+
+    async def test_leap_day_birthdays_in_other_years(self):
+        with self.Session() as db:
+            db.add(Contact(name="leap", surname="d", birth_date=date(1992, 2, 29), user_id=2))
+            db.commit()
+        await run(today=date(2027, 2, 25), days=3, checkpoint=self.checkpoint, session_factory=self.Session,
+                  send=self.send)
+        self.assertEqual([c["name"] for digest in self.sent[0] for c in digest["contacts"]], ["leap"])
+        self.sent = []
+        await run(today=date(2028, 2, 25), days=3, checkpoint=self.checkpoint, session_factory=self.Session,
+                  send=self.send)
+        self.assertEqual(self.sent, [])
+
+    async def test_send_returns_error_of_every_digest(self):
+        digests = [{"email": f"user{i}@example.com", "username": f"user{i}", "contacts": []} for i in range(3)]
+        error = ConnectionError("refused")
+        with patch("src.services.email.FastMail") as mail:
+            mail.return_value.send_message = MagicMock(side_effect=[self.done(), error, self.done()])
+            results = await send_birthday_digests(digests)
+        self.assertEqual(results, [None, error, None])
+
+    @staticmethod
+    async def done():
+        return None
+
+
+if __name__ == '__main__':
+    unittest.main()
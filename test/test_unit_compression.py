@@ -0,0 +1,125 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath('..'))
+
+import gzip
+import unittest
+import zlib
+
+from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from fastapi.testclient import TestClient
+
+from src.services.compression import CompressedCache, CompressionMiddleware, GzipEncoder, negotiate
+
+BODY = [{"name": f"name {i}", "email": f"user{i}@example.com"} for i in range(100)]
+
+
+def make_app(cache):
+    app = FastAPI()
+    app.add_middleware(CompressionMiddleware, minimum_size=500, cache=cache, encoders=[GzipEncoder()])
+
+    @app.get("/contacts")
+    async def contacts():
+        return BODY
+
+    @app.get("/small")
+    async def small():
+        return {"message": "ok"}
+
+    @app.get("/tagged")
+    async def tagged():
+        return PlainTextResponse("x" * 1000, headers={"ETag": '"v1"'})
+
+    @app.get("/other/tagged")
+    async def other_tagged():
+        return PlainTextResponse("y" * 1000, headers={"ETag": '"v1"'})
+
+    @app.get("/stream")
+    async def stream():
+        async def chunks():
+            for i in range(3):
+                yield f"line {i}\n" * 100
+
+        return StreamingResponse(chunks(), media_type="text/plain")
+
+    @app.get("/events")
+    async def events():
+        return StreamingResponse(iter(["data: 1\n\n" * 100]), media_type="text/event-stream")
+
+    return app
+
+
+class TestNegotiate(unittest.TestCase):
+
+    def test_negotiate(self):
+        encoders = [GzipEncoder()]
+        self.assertIsNone(negotiate("", encoders))
+        self.assertIsNone(negotiate("br, gzip;q=0", encoders))
+        self.assertEqual(negotiate("br;q=1.0, gzip;q=0.5", encoders).name, "gzip")
+        self.assertEqual(negotiate("*", encoders).name, "gzip")
+
+
+class TestCompressionMiddleware(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = CompressedCache(8)
+        self.client = TestClient(make_app(self.cache))
+
+    def get(self, path, encoding="gzip"):
+        # read the raw body, the test client would decompress it
+        response = self.client.get(path, headers={"Accept-Encoding": encoding})
+        return response, response.content
+
+    def test_large_json_is_compressed_but_not_cached_without_etag(self):
+        response, _ = self.get("/contacts")
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        self.assertEqual(response.headers["Vary"], "Accept-Encoding")
+        self.assertEqual(response.json(), BODY)
+        self.get("/contacts")
+        self.assertEqual(self.cache.stats(), {"size": 0, "hits": 0, "misses": 0})
+
+    def test_tagged_response_is_cached(self):
+        self.get("/tagged")
+        response, _ = self.get("/tagged")
+        self.assertEqual(response.text, "x" * 1000)
+        self.assertEqual(self.cache.stats(), {"size": 1, "hits": 1, "misses": 1})
+
+    def test_small_or_not_accepted_is_sent_as_is(self):
+        response, _ = self.get("/small")
+        self.assertNotIn("Content-Encoding", response.headers)
+        response, _ = self.get("/contacts", encoding="identity")
+        self.assertNotIn("Content-Encoding", response.headers)
+
+    def test_etag_becomes_weak(self):
+        response, _ = self.get("/tagged")
+        self.assertEqual(response.headers["ETag"], 'W/"v1"')
+        self.assertEqual(response.text, "x" * 1000)
+
+    def test_same_etag_of_other_resource_is_not_served_from_cache(self):
+        self.get("/tagged")
+        response, _ = self.get("/other/tagged")
+        self.assertEqual(response.text, "y" * 1000)
+        self.assertEqual(self.cache.stats(), {"size": 2, "hits": 0, "misses": 2})
+
+    def test_streaming_response_is_compressed(self):
+        with self.client.stream("GET", "/stream", headers={"Accept-Encoding": "gzip"}) as response:
+            raw = b"".join(response.iter_raw())
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        self.assertNotIn("Content-Length", response.headers)
+        self.assertEqual(gzip.decompress(raw).decode(), "".join(f"line {i}\n" * 100 for i in range(3)))
+
+    def test_event_stream_is_not_compressed(self):
+        response, _ = self.get("/events")
+        self.assertNotIn("Content-Encoding", response.headers)
+
+    def test_gzip_stream_flushes_each_chunk(self):
+        compress = GzipEncoder().stream()
+        decompressor = zlib.decompressobj(31)
+        self.assertEqual(decompressor.decompress(compress(b"first", False)), b"first")
+        self.assertEqual(decompressor.decompress(compress(b"second", True)), b"second")
+
+
+if __name__ == '__main__':
+    unittest.main()
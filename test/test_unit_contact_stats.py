@@ -0,0 +1,66 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath('..'))
+
+import unittest
+from datetime import date, datetime
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from src.database.models import Base, Contact, ContactCounter, User
+from src.repository.contacts import create_contacts, get_contact_stats, remove_contact
+from src.schemas import ContactModel
+from src.services.counters import reconcile_all
+
+
+class TestContactStats(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        engine = create_engine("sqlite://")
+        Base.metadata.create_all(bind=engine)
+        self.Session = sessionmaker(bind=engine)
+        self.db = self.Session()
+        self.user = User(id=1, username="test_user", email="a@example.com", password="qwerty")
+        self.db.add(self.user)
+        self.db.add_all([Contact(name="a", birth_date=date(1990, 3, 1), user_id=1),
+                         Contact(name="b", birth_date=date(1991, 3, 2), user_id=1),
+                         Contact(name="c", birth_date=date(1992, 7, 3), user_id=1)])
+        self.db.commit()
+
+    def tearDown(self):
+        self.db.close()
+
+    def body(self, birth_date):
+        return ContactModel(name="new", surname="s", email="new@example.com", description="d", phone="0970909090",
+                            birth_date=birth_date, created_at=datetime.now(), updated_at=datetime.now())
+
+    async def test_stats_are_computed_then_maintained(self):
+        stats = await get_contact_stats(self.db, self.user)
+        self.assertEqual(stats["total"], 3)
+        self.assertEqual(stats["by_birth_month"][3], 2)
+        self.assertEqual(stats["by_birth_month"][1], 0)
+
+        new_contact = await create_contacts(self.body(date(2000, 1, 5)), self.db, self.user)
+        stats = await get_contact_stats(self.db, self.user)
+        self.assertEqual(stats["total"], 4)
+        self.assertEqual(stats["by_birth_month"][1], 1)
+        self.assertEqual(stats["recent"][0].id, new_contact.id)
+
+        await remove_contact(new_contact.id, self.db, self.user)
+        stats = await get_contact_stats(self.db, self.user)
+        self.assertEqual(stats["total"], 3)
+
+    async def test_reconcile_fixes_drift(self):
+        await get_contact_stats(self.db, self.user)
+        self.db.query(ContactCounter).filter(ContactCounter.birth_month == 3).update({ContactCounter.count: 10})
+        self.db.commit()
+        self.assertEqual(reconcile_all(self.Session, batch_size=1), 1)
+        self.db.expire_all()
+        stats = await get_contact_stats(self.db, self.user)
+        self.assertEqual(stats["total"], 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
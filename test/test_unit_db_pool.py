@@ -0,0 +1,88 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath('..'))
+
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+
+from fastapi import HTTPException
+from pydantic import ValidationError
+from sqlalchemy import create_engine
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+
+from src.conf.config import Settings
+from src.database.db import InstrumentedQueuePool, dialect_insert, get_db, pool_status, warm_up_pool
+from src.database.models import User
+
+
+class TestInstrumentedPool(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.engine = create_engine(f"sqlite:///{self.tmp.name}/test.db", poolclass=InstrumentedQueuePool,
+                                    pool_size=2, max_overflow=0, pool_timeout=0.05)
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.tmp.cleanup()
+
+    def test_status_counts_checkouts_and_timeouts(self):
+        first, second = self.engine.connect(), self.engine.connect()
+        with self.assertRaises(PoolTimeoutError):
+            self.engine.connect()
+        status = pool_status(self.engine)
+        self.assertEqual((status["size"], status["checkedout"], status["checkedin"]), (2, 2, 0))
+        self.assertEqual((status["checkouts"], status["timeouts"]), (3, 1))
+        # the timed out checkout waited for the whole pool timeout
+        self.assertGreaterEqual(status["wait_max_ms"], 50)
+        self.assertGreater(status["wait_avg_ms"], 0)
+        first.close()
+        second.close()
+        self.assertEqual(pool_status(self.engine)["checkedin"], 2)
+
+    def test_stats_survive_recreate(self):
+        self.engine.connect().close()
+        self.engine.dispose()
+        self.assertEqual(pool_status(self.engine)["checkouts"], 1)
+
+    def test_status_of_pool_without_stats(self):
+        engine = create_engine("sqlite://")
+        self.assertNotIn("checkouts", pool_status(engine))
+        engine.dispose()
+
+    def test_warm_up_opens_connections(self):
+        self.assertEqual(warm_up_pool(self.engine, 2), 2)
+        self.assertEqual(pool_status(self.engine)["checkedin"], 2)
+
+    def test_warm_up_must_fit_the_pool(self):
+        with self.assertRaises(ValidationError):
+            Settings(DB_POOL_SIZE=2, DB_POOL_WARMUP=3, _env_file=None)
+        self.assertEqual(Settings(DB_POOL_SIZE=2, DB_POOL_WARMUP=2, _env_file=None).DB_POOL_WARMUP, 2)
+
+    def test_get_db_answers_503_on_pool_timeout(self):
+        dependency = get_db()
+        next(dependency)
+        with self.assertRaises(HTTPException) as cm:
+            dependency.throw(PoolTimeoutError("QueuePool limit of size 2 overflow 0 reached"))
+        self.assertEqual(cm.exception.status_code, 503)
+
+
+class TestDialectInsert(unittest.TestCase):
+
+    def test_dialect_without_on_conflict(self):
+        bind = MagicMock()
+        bind.dialect.name = "mysql"
+        with self.assertRaises(ValueError):
+            dialect_insert(bind, User.__table__)
+
+    def test_accepts_a_connection(self):
+        engine = create_engine("sqlite://")
+        with engine.connect() as conn:
+            self.assertEqual(dialect_insert(conn, User.__table__).table, User.__table__)
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath('..'))
+
+import tempfile
+import unittest
+
+from sqlalchemy import create_engine, select
+from sqlalchemy.orm import sessionmaker
+
+from src.database.models import Base, User
+from src.database.replicas import ReplicaPool, RoutingSession, read_only
+from src.repository.users import find_user_by_email
+
+
+@read_only
+async def find_username(email, db):
+    return db.scalars(select(User.username).where(User.email == email)).first()
+
+
+class TestReplicaRouting(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.primary = create_engine(f"sqlite:///{self.tmp.name}/primary.db")
+        self.replica = create_engine(f"sqlite:///{self.tmp.name}/replica.db")
+        for engine in (self.primary, self.replica):
+            Base.metadata.create_all(bind=engine)
+        # the same email lives in both databases, the username tells which one answered
+        with self.primary.begin() as conn:
+            conn.execute(User.__table__.insert(), dict(username="primary", email="a@example.com", password="x"))
+        with self.replica.begin() as conn:
+            conn.execute(User.__table__.insert(), dict(username="replica", email="a@example.com", password="x"))
+        self.pool = ReplicaPool([self.replica])
+        self.Session = sessionmaker(class_=RoutingSession, bind=self.primary, replicas=self.pool)
+
+    def tearDown(self):
+        self.primary.dispose()
+        self.replica.dispose()
+        self.tmp.cleanup()
+
+    async def test_read_goes_to_replica(self):
+        with self.Session() as db:
+            self.assertEqual(await find_username("a@example.com", db), "replica")
+            self.assertFalse(db.in_transaction())
+
+    async def test_user_lookups_stay_on_primary(self):
+        with self.Session() as db:
+            user = await find_user_by_email("a@example.com", db)
+        self.assertEqual(user.username, "primary")
+
+    async def test_plain_query_goes_to_primary(self):
+        with self.Session() as db:
+            user = db.query(User).filter(User.email == "a@example.com").first()
+        self.assertEqual(user.username, "primary")
+
+    async def test_read_after_write_stays_on_primary(self):
+        with self.Session() as db:
+            db.add(User(username="new", email="b@example.com", password="x"))
+            db.commit()
+            self.assertEqual(await find_username("b@example.com", db), "new")
+            self.assertEqual(await find_username("a@example.com", db), "primary")
+
+    async def test_read_with_pending_changes_stays_on_primary(self):
+        with self.Session() as db:
+            db.scalars(select(User)).first().username = "changed"
+            self.assertEqual(await find_username("a@example.com", db), "changed")
+
+    async def test_failover_to_primary(self):
+        broken = create_engine(f"sqlite:///{self.tmp.name}/missing/replica.db")
+        pool = ReplicaPool([broken])
+        Session = sessionmaker(class_=RoutingSession, bind=self.primary, replicas=pool)
+        with Session() as db:
+            user = db.scalars(select(User)).first()
+            self.assertEqual(await find_username("a@example.com", db), "primary")
+            # the transaction and the loaded objects of the request are untouched
+            self.assertTrue(db.in_transaction())
+            self.assertIn("username", user.__dict__)
+            db.add(User(username="new", email="b@example.com", password="x"))
+            db.commit()
+        self.assertFalse(pool.is_healthy(broken))
+        self.assertIsNone(pool.choose())
+
+    def test_round_robin(self):
+        other = create_engine("sqlite://")
+        pool = ReplicaPool([self.replica, other])
+        self.assertEqual([pool.choose() for _ in range(4)], [self.replica, other, self.replica, other])
+        pool.mark_down(other)
+        self.assertEqual([pool.choose() for _ in range(2)], [self.replica, self.replica])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath('..'))
+
+import threading
+import time
+import unittest
+
+from fastapi import HTTPException
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+
+from src.database.db import DeadlineExceeded, cancel_queries, get_db, is_deadline_error
+
+SLOW_QUERY = text("WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n) SELECT count(*) FROM n")
+
+
+class TestDeadlines(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine("sqlite://")
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def test_slow_statement_is_interrupted(self):
+        with Session(self.engine) as session:
+            session.info["deadline"] = time.monotonic() + 0.1
+            start = time.monotonic()
+            with self.assertRaises(OperationalError) as cm:
+                session.execute(SLOW_QUERY)
+            self.assertLess(time.monotonic() - start, 5)
+            self.assertTrue(is_deadline_error(cm.exception))
+
+    def test_no_deadline_no_handler(self):
+        with Session(self.engine) as session:
+            self.assertEqual(session.execute(text("SELECT 1")).scalar(), 1)
+
+    def test_expired_deadline_fails_before_begin(self):
+        with Session(self.engine) as session:
+            session.info["deadline"] = time.monotonic() - 1
+            with self.assertRaises(DeadlineExceeded):
+                session.execute(text("SELECT 1"))
+
+    def test_cancel_interrupts_running_statement(self):
+        with Session(self.engine) as session:
+            session.info["deadline"] = time.monotonic() + 30
+            threading.Timer(0.1, cancel_queries, [session]).start()
+            start = time.monotonic()
+            with self.assertRaises(OperationalError) as cm:
+                session.execute(SLOW_QUERY)
+            self.assertLess(time.monotonic() - start, 5)
+            self.assertTrue(is_deadline_error(cm.exception))
+
+    def test_cancel_skips_connections_back_in_the_pool(self):
+        with Session(self.engine) as session:
+            session.info["deadline"] = time.monotonic() + 30
+            session.execute(text("SELECT 1"))
+            session.commit()
+            # the connection may be running the statement of another request by now
+            self.assertEqual(cancel_queries(session), 0)
+            session.execute(text("SELECT 1"))
+            self.assertEqual(cancel_queries(session), 1)
+            session.rollback()
+            self.assertEqual(cancel_queries(session), 0)
+
+    def test_get_db_answers_504(self):
+        dependency = get_db()
+        next(dependency)
+        with self.assertRaises(HTTPException) as cm:
+            dependency.throw(DeadlineExceeded())
+        self.assertEqual(cm.exception.status_code, 504)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath('..'))
+
+import unittest
+from datetime import date
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from src.database.models import Base, Contact, User
+from src.database.normalize import normalize_email, normalize_phone, soundex
+from src.services.dedupe import Candidate, find_all_duplicates, find_duplicate_groups
+
+
+class TestNormalize(unittest.TestCase):
+
+    def test_normalize_email(self):
+        self.assertEqual(normalize_email("  Vasya@Gmail.COM "), "vasya@gmail.com")
+        self.assertIsNone(normalize_email(""))
+
+    def test_normalize_phone(self):
+        self.assertEqual(normalize_phone("097 090-90-90"), "+380970909090")
+        self.assertEqual(normalize_phone("+38 (097) 090 90 90"), "+380970909090")
+        self.assertEqual(normalize_phone("00380970909090"), "+380970909090")
+        self.assertIsNone(normalize_phone("n/a"))
+        self.assertEqual(normalize_phone("+123456789012345"), "+123456789012345")
+        self.assertIsNone(normalize_phone("+1234567890123456"))
+        self.assertIsNone(normalize_phone("0" + "9" * 20))
+
+    def test_soundex(self):
+        self.assertEqual(soundex("Robert"), "R163")
+        self.assertEqual(soundex("Rupert"), "R163")
+        self.assertEqual(soundex("Ashcraft"), "A261")
+        self.assertEqual(soundex("Влад"), "влад")
+
+
+class TestFindDuplicates(unittest.TestCase):
+
+    def test_groups_by_email_phone_and_name(self):
+        candidates = [
+            Candidate(1, "Vlad", "Petrenko", "vlad@example.com", None),
+            Candidate(2, "vlad", "Petrenko", "VLAD@example.com ", "0970909090", "friend"),
+            Candidate(3, "Vladd", "Petrenko", None, "+380 97 090 90 90"),
+            Candidate(4, "Olena", "Shevchenko", "olena@example.com", "0501111111"),
+            Candidate(5, "Petro", "Ivanenko", None, "0970909091"),
+        ]
+        groups = find_duplicate_groups(candidates)
+        self.assertEqual(len(groups), 1)
+        group = groups[0]
+        self.assertEqual(group["contact_ids"], [1, 2, 3])
+        self.assertEqual(group["primary_id"], 2)
+        self.assertEqual(group["merged"]["description"], "friend")
+
+    def test_name_only_near_duplicates_are_grouped(self):
+        # a misspelt surname, nothing else in common and nothing that contradicts
+        candidates = [Candidate(1, "Oleksandr", "Shevchenko"),
+                      Candidate(2, "Oleksandr", "Schevchenko", None, "0970909090"),
+                      Candidate(3, "Olena", "Shevchenko")]
+        groups = find_duplicate_groups(candidates)
+        self.assertEqual([group["contact_ids"] for group in groups], [[1, 2]])
+
+    def test_same_name_with_other_emails_is_not_duplicate(self):
+        candidates = [Candidate(1, "Ivan", "Franko", "ivan@example.com"),
+                      Candidate(2, "Ivan", "Franko", "franko@example.com")]
+        self.assertEqual(find_duplicate_groups(candidates), [])
+
+    def test_job_reports_every_user_with_duplicates(self):
+        engine = create_engine("sqlite://", poolclass=StaticPool)
+        Base.metadata.create_all(engine)
+        sessions = sessionmaker(bind=engine)
+        with sessions() as db:
+            for user_id in range(1, 4):
+                db.add(User(id=user_id, username=f"user{user_id}", email=f"user{user_id}@example.com", password="x"))
+                db.add(Contact(name="Vlad", surname="Petrenko", email="vlad@example.com", birth_date=date(1990, 1, 1),
+                               user_id=user_id))
+            for user_id in (1, 3):
+                db.add(Contact(name="vlad", surname="Petrenko", email="VLAD@example.com", birth_date=date(1990, 1, 1),
+                               user_id=user_id))
+            db.commit()
+        reports = list(find_all_duplicates(sessions, batch_size=2))
+        self.assertEqual([report["user_id"] for report in reports], [1, 3])
+        self.assertEqual([len(report["groups"]) for report in reports], [1, 1])
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,161 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath('..'))
+
+import unittest
+from unittest.mock import AsyncMock, MagicMock
+
+from redis.exceptions import ConnectionError
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from src.database.models import Base, User
+from src.services.email_filter import BloomFilter, LocalEmailFilter, RedisEmailFilter
+
+
+class TestBloomFilter(unittest.TestCase):
+
+    def test_no_false_negatives_and_error_rate(self):
+        bloom = BloomFilter(capacity=10000, error_rate=0.01)
+        for number in range(10000):
+            bloom.add(f"user{number}@example.com")
+        self.assertTrue(all(f"user{number}@example.com" in bloom for number in range(10000)))
+        false_positives = sum(f"stranger{number}@example.com" in bloom for number in range(20000))
+        self.assertLess(false_positives / 20000, 0.02)
+
+    def test_size(self):
+        bloom = BloomFilter(capacity=1_000_000, error_rate=0.01)
+        self.assertEqual(bloom.hashes, 7)
+        self.assertAlmostEqual(bloom.size / 1_000_000, 9.59, places=2)
+
+
+class TestLocalEmailFilter(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+        Base.metadata.create_all(engine)
+        self.sessions = sessionmaker(bind=engine)
+        self.add_user("Wolverine@Example.com")
+        self.filter = LocalEmailFilter(self.sessions, capacity=1000, error_rate=0.001, sync_interval=3600)
+
+    def add_user(self, email):
+        with self.sessions() as db:
+            db.add(User(username=email.split("@")[0], email=email, password="x"))
+            db.commit()
+
+    async def test_not_built_lets_everything_through(self):
+        self.assertTrue(await self.filter.might_exist("nobody@example.com"))
+        self.assertEqual(self.filter.stats(), {"ready": False})
+
+    async def test_build(self):
+        self.assertEqual(await self.filter.rebuild(), 1)
+        self.assertTrue(await self.filter.might_exist("wolverine@example.com"))
+        self.assertFalse(await self.filter.might_exist("nobody@example.com"))
+        self.assertEqual(self.filter.stats()["rejected"], 1)
+
+    async def test_add(self):
+        await self.filter.rebuild()
+        await self.filter.add("storm@example.com")
+        self.assertTrue(await self.filter.might_exist("storm@example.com"))
+
+    async def test_catches_up_with_other_workers(self):
+        await self.filter.rebuild()
+        self.add_user("storm@example.com")
+        self.assertFalse(await self.filter.might_exist("storm@example.com"))
+        self.filter.sync_interval = 0
+        self.assertTrue(await self.filter.might_exist("storm@example.com"))
+
+    async def test_catches_up_with_users_committed_out_of_order(self):
+        await self.filter.rebuild()
+        self.filter.sync_interval = 0
+        with self.sessions() as db:
+            db.add(User(id=5, username="storm", email="storm@example.com", password="x"))
+            db.commit()
+        self.assertTrue(await self.filter.might_exist("storm@example.com"))
+        self.assertEqual(self.filter.last_id, 5)
+        with self.sessions() as db:
+            db.add(User(id=3, username="rogue", email="rogue@example.com", password="x"))
+            db.commit()
+        self.assertTrue(await self.filter.might_exist("rogue@example.com"))
+        self.assertEqual(self.filter.stats()["emails"], 3)
+
+
+class TestRedisEmailFilter(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.redis = MagicMock()
+        self.pipe = MagicMock()
+        self.pipe.execute = AsyncMock()
+        self.redis.pipeline.return_value.__aenter__.return_value = self.pipe
+        self.redis.get = AsyncMock(return_value=b"7")
+        self.redis.set = AsyncMock()
+        self.fallback = MagicMock()
+        self.fallback.might_exist = AsyncMock(return_value=False)
+        self.fallback.add = AsyncMock()
+        self.fallback._load_since.return_value = 7
+        self.filter = RedisEmailFilter(self.redis, fallback=self.fallback, capacity=1000, error_rate=0.01)
+
+    async def test_bits(self):
+        self.pipe.execute.return_value = [1] + [1] * self.filter.layout.hashes
+        self.assertTrue(await self.filter.might_exist("wolverine@example.com"))
+        self.pipe.execute.return_value = [1] + [1, 0] + [1] * (self.filter.layout.hashes - 2)
+        self.assertFalse(await self.filter.might_exist("nobody@example.com"))
+
+    async def test_missing_key_lets_everything_through(self):
+        self.pipe.execute.return_value = [0] + [0] * self.filter.layout.hashes
+        self.assertTrue(await self.filter.might_exist("nobody@example.com"))
+
+    async def test_add_sets_bits_and_fallback(self):
+        await self.filter.add("Storm@Example.com")
+        positions = [call.args[1] for call in self.pipe.setbit.call_args_list]
+        self.assertEqual(positions, self.filter.layout.positions("storm@example.com"))
+        self.fallback.add.assert_awaited_once_with("Storm@Example.com")
+
+    async def test_catches_up_on_a_miss(self):
+        def load_since(target, last_id):
+            target.add("storm@example.com")
+            return 9
+
+        self.fallback._load_since.side_effect = load_since
+        missing = [1, 0] + [1] * (self.filter.layout.hashes - 1)
+        self.pipe.execute.side_effect = [missing, [], [1] + [1] * self.filter.layout.hashes]
+        self.assertTrue(await self.filter.might_exist("Storm@Example.com"))
+        self.fallback._load_since.assert_called_once()
+        self.assertEqual(self.fallback._load_since.call_args.args[1], 7)
+        positions = [call.args[1] for call in self.pipe.setbit.call_args_list]
+        self.assertEqual(positions, self.filter.layout.positions("storm@example.com"))
+        self.redis.set.assert_awaited_once_with("email_filter:last_id", 9)
+        # the next miss within the sync interval is not checked again
+        self.pipe.execute.side_effect = [missing]
+        self.assertFalse(await self.filter.might_exist("nobody@example.com"))
+        self.fallback._load_since.assert_called_once()
+
+    async def test_rebuilds_after_failed_add(self):
+        self.pipe.execute.side_effect = ConnectionError()
+        await self.filter.add("storm@example.com")
+        self.fallback.add.assert_awaited_once_with("storm@example.com")
+        self.assertTrue(self.filter.stats()["stale"])
+        self.filter.rebuild = AsyncMock(side_effect=ConnectionError())
+        self.assertFalse(await self.filter.might_exist("nobody@example.com"))
+        self.filter.rebuild.assert_not_awaited()
+        self.filter.sync_interval = 0
+        self.assertFalse(await self.filter.might_exist("nobody@example.com"))
+        self.filter.rebuild.assert_awaited_once()
+        self.assertEqual(self.fallback.might_exist.await_count, 2)
+        self.filter.rebuild = AsyncMock()
+        self.pipe.execute.side_effect = None
+        self.pipe.execute.return_value = [1] + [1] * self.filter.layout.hashes
+        self.assertTrue(await self.filter.might_exist("storm@example.com"))
+        self.assertFalse(self.filter.stale)
+        self.assertEqual(self.fallback.might_exist.await_count, 2)
+
+    async def test_falls_back_without_redis(self):
+        self.pipe.execute.side_effect = ConnectionError()
+        self.assertFalse(await self.filter.might_exist("nobody@example.com"))
+        self.fallback.might_exist.assert_awaited_once_with("nobody@example.com")
+
+
+if __name__ == '__main__':
+    unittest.main()
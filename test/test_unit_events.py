@@ -0,0 +1,136 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath('..'))
+
+import asyncio
+import json
+import unittest
+from datetime import date, datetime
+from unittest.mock import MagicMock
+
+from sqlalchemy.orm import Session
+
+from src.database.models import Contact, User
+from src.repository.contacts import create_contacts, remove_contact
+from src.schemas import ContactModel
+from src.services import events
+from src.services.events import InMemoryBroker, RedisBroker, contact_event
+
+
+class FakePubSub:
+    def __init__(self, redis):
+        self.redis = redis
+        self.channels = set()
+        self.messages = asyncio.Queue()
+
+    async def subscribe(self, channel):
+        self.channels.add(channel)
+
+    async def unsubscribe(self, channel):
+        self.channels.discard(channel)
+
+    async def get_message(self, ignore_subscribe_messages=False, timeout=None):
+        try:
+            return await asyncio.wait_for(self.messages.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def aclose(self):
+        self.redis.pubsubs.remove(self)
+
+
+class FakeRedis:
+    def __init__(self):
+        self.pubsubs = []
+
+    def pubsub(self):
+        self.pubsubs.append(FakePubSub(self))
+        return self.pubsubs[-1]
+
+    async def publish(self, channel, data):
+        for pubsub in self.pubsubs:
+            if channel in pubsub.channels:
+                pubsub.messages.put_nowait({"type": "message", "channel": channel, "data": data})
+
+
+class TestEvents(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.broker = events.broker
+        events.init(InMemoryBroker(queue_size=2))
+        self.session = MagicMock(spec=Session)
+        self.user = User(id=1, username='test_user', password="qwerty", confirmed=True)
+
+    def tearDown(self):
+        events.init(self.broker)
+
+    def test_contact_event(self):
+        contact = Contact(id=3, name="Vlad", surname="Petrenko", birth_date=date(2000, 3, 2))
+        self.assertEqual(contact_event(events.CREATED, contact)["contact"]["birth_date"], "2000-03-02")
+        self.assertEqual(contact_event(events.DELETED, contact), {"type": "deleted", "contact": {"id": 3}})
+
+    async def test_events_reach_only_the_owner(self):
+        async with events.broker.subscribe(1) as mine, events.broker.subscribe(2) as other:
+            await events.broker.publish(1, {"type": "created"})
+            self.assertEqual(await mine.get(0.1), {"type": "created"})
+            self.assertIsNone(await other.get(0.01))
+        self.assertEqual(events.broker.stats(), {"users": 0, "subscriptions": 0})
+
+    async def test_slow_subscriber_gets_resync(self):
+        async with events.broker.subscribe(1) as subscription:
+            for _ in range(3):
+                await events.broker.publish(1, {"type": "updated"})
+            self.assertEqual(await subscription.get(0.1), {"type": events.RESYNC})
+
+    async def test_repository_writes_publish(self):
+        body = ContactModel(name="test", surname='test1', email='test@gmail.com', description="test note",
+                            phone='0970909090', birth_date=date(2024, 3, 2), created_at=datetime.now(),
+                            updated_at=datetime.now())
+        contact = Contact(id=5, user_id=1, birth_date=date(2024, 3, 2))
+        self.session.scalars.return_value.first.return_value = contact
+        async with events.broker.subscribe(1) as subscription:
+            await create_contacts(body, self.session, self.user)
+            await remove_contact(5, self.session, self.user)
+            created = await subscription.get(0.1)
+            self.assertEqual((created["type"], created["contact"]["name"]), ("created", "test"))
+            self.assertEqual(await subscription.get(0.1), {"type": "deleted", "contact": {"id": 5}})
+
+    async def test_stream(self):
+        disconnected = []
+
+        async def is_disconnected():
+            return bool(disconnected)
+
+        stream = events.stream(1, is_disconnected, heartbeat=0.01)
+        self.assertEqual(await anext(stream), ": connected\n\n")
+        self.assertEqual(await anext(stream), ": keepalive\n\n")
+        await events.broker.publish(1, contact_event(events.DELETED, Contact(id=7)))
+        message = await anext(stream)
+        self.assertTrue(message.startswith("event: deleted\n"))
+        self.assertEqual(json.loads(message.split("data: ")[1]), {"id": 7})
+        disconnected.append(True)
+        with self.assertRaises(StopAsyncIteration):
+            await anext(stream)
+
+
+class TestRedisBroker(unittest.IsolatedAsyncioTestCase):
+
+    async def test_one_connection_fans_out_to_every_subscriber(self):
+        redis = FakeRedis()
+        broker = RedisBroker(redis)
+        async with broker.subscribe(1) as first, broker.subscribe(1) as second, broker.subscribe(2) as other:
+            self.assertEqual(len(redis.pubsubs), 1)
+            self.assertEqual(broker.stats(), {"backend": "redis", "connections": 1, "channels": 2,
+                                              "subscriptions": 3})
+            await broker.publish(1, {"type": "created"})
+            self.assertEqual(await first.get(0.1), {"type": "created"})
+            self.assertEqual(await second.get(0.1), {"type": "created"})
+            self.assertIsNone(await other.get(0.01))
+        self.assertEqual(redis.pubsubs[0].channels, set())
+        self.assertEqual(broker.stats()["channels"], 0)
+        await broker.aclose()
+
+
+if __name__ == '__main__':
+    unittest.main()
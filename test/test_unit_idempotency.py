@@ -0,0 +1,95 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath('..'))
+
+import unittest
+from datetime import datetime, timedelta
+
+from fastapi import FastAPI, HTTPException
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from src.database.models import Base, IdempotencyKey
+from src.services import idempotency
+from src.services.idempotency import DBIdempotencyStore, IdempotencyMiddleware
+
+
+def make_app(calls):
+    app = FastAPI()
+    app.add_middleware(IdempotencyMiddleware, ttl=60, lease=1)
+
+    @app.post("/api/contacts/contact", status_code=201)
+    async def create(body: dict):
+        calls.append(body)
+        if body.get("fail"):
+            raise HTTPException(status_code=503, detail="unavailable")
+        return {"id": len(calls), **body}
+
+    return app
+
+
+class TestIdempotency(unittest.TestCase):
+
+    def setUp(self):
+        engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+        Base.metadata.create_all(bind=engine)
+        self.store = idempotency.store
+        idempotency.init(DBIdempotencyStore(sessionmaker(bind=engine)))
+        self.calls = []
+        self.client = TestClient(make_app(self.calls))
+
+    def tearDown(self):
+        idempotency.init(self.store)
+
+    def post(self, body, key="key-1"):
+        return self.client.post("/api/contacts/contact", json=body, headers={"Idempotency-Key": key})
+
+    def test_retry_is_replayed(self):
+        first = self.post({"name": "Vlad"})
+        second = self.post({"name": "Vlad"})
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(second.status_code, 201)
+        self.assertEqual(second.json(), first.json())
+        self.assertEqual(second.headers["Idempotent-Replayed"], "true")
+        self.assertEqual(len(self.calls), 1)
+
+    def test_other_key_runs_again(self):
+        self.post({"name": "Vlad"})
+        self.post({"name": "Vlad"}, key="key-2")
+        self.client.post("/api/contacts/contact", json={"name": "Vlad"})
+        self.assertEqual(len(self.calls), 3)
+
+    def test_key_reused_with_other_body(self):
+        self.post({"name": "Vlad"})
+        response = self.post({"name": "Olena"})
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(len(self.calls), 1)
+
+    def test_server_errors_are_not_stored(self):
+        self.assertEqual(self.post({"fail": True}).status_code, 503)
+        self.assertEqual(self.post({"fail": True}).status_code, 503)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_pending_key_conflicts(self):
+        idempotency.store._begin("pending", "hash", 60)
+        stored = idempotency.store._begin("pending", "hash", 60)
+        self.assertTrue(stored.pending)
+
+    def test_claim_of_a_dead_request_expires_with_its_lease(self):
+        # the request that claimed the key never finished, e.g. its worker was killed
+        self.assertIsNone(idempotency.store._begin("abandoned", "hash", 0))
+        self.assertIsNone(idempotency.store._begin("abandoned", "hash", 60))
+
+    def test_response_is_kept_for_the_ttl(self):
+        # claimed for the lease of a second, stored for the ttl of a minute
+        self.post({"name": "Vlad"})
+        with idempotency.store.session_factory() as db:
+            expires_at = db.query(IdempotencyKey.expires_at).scalar()
+        self.assertGreater(expires_at, datetime.utcnow() + timedelta(seconds=30))
+
+
+if __name__ == '__main__':
+    unittest.main()
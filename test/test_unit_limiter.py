@@ -0,0 +1,81 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath('..'))
+
+import unittest
+
+from fastapi import HTTPException
+from starlette.requests import Request
+
+from src.database.auth import auth_service
+from src.services import limiter
+from src.services.limiter import LocalBackend, RateLimiter, user_identifier
+
+
+def make_request(token=None, host="127.0.0.1"):
+    headers = [(b"authorization", f"Bearer {token}".encode())] if token else []
+    return Request({"type": "http", "method": "GET", "path": "/api/contacts/contact", "headers": headers,
+                    "client": (host, 5000)})
+
+
+class TestLocalBackend(unittest.IsolatedAsyncioTestCase):
+
+    async def test_allows_burst_then_limits(self):
+        backend = LocalBackend()
+        self.assertEqual(await backend.hit("k", 2, 5), 0)
+        self.assertEqual(await backend.hit("k", 2, 5), 0)
+        retry_after = await backend.hit("k", 2, 5)
+        self.assertGreater(retry_after, 0)
+        self.assertLessEqual(retry_after, 2500)
+
+    async def test_keys_are_independent(self):
+        backend = LocalBackend()
+        await backend.hit("a", 1, 5)
+        self.assertGreater(await backend.hit("a", 1, 5), 0)
+        self.assertEqual(await backend.hit("b", 1, 5), 0)
+
+    async def test_eviction_keeps_size_bounded(self):
+        backend = LocalBackend(max_keys=10)
+        for i in range(100):
+            await backend.hit(str(i), 1, 0.000001)
+        self.assertLessEqual(len(backend._tat), 10)
+
+    async def test_eviction_forgets_least_recently_hit_keys(self):
+        backend = LocalBackend(max_keys=3)
+        for key in ("a", "b", "c"):
+            await backend.hit(key, 10, 60)
+        await backend.hit("a", 10, 60)
+        await backend.hit("d", 10, 60)
+        self.assertEqual(list(backend._tat), ["c", "a", "d"])
+        # keys that are still limited count against the bound too
+        backend = LocalBackend(max_keys=2)
+        for key in ("a", "b", "c"):
+            await backend.hit(key, 1, 60)
+        self.assertEqual(list(backend._tat), ["b", "c"])
+
+
+class TestRateLimiter(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        limiter.init(LocalBackend())
+
+    async def test_identifier_uses_token_subject(self):
+        token = await auth_service.create_access_token(data={"sub": "a@example.com"})
+        self.assertEqual(user_identifier(make_request(token)), "user:a@example.com")
+        self.assertEqual(user_identifier(make_request("forged")), "ip:127.0.0.1")
+
+    async def test_limit_is_per_user(self):
+        rate_limiter = RateLimiter(times=1, seconds=5)
+        first = await auth_service.create_access_token(data={"sub": "a@example.com"})
+        second = await auth_service.create_access_token(data={"sub": "b@example.com"})
+        await rate_limiter(make_request(first))
+        await rate_limiter(make_request(second, host="127.0.0.1"))
+        with self.assertRaises(HTTPException) as err:
+            await rate_limiter(make_request(first, host="10.0.0.1"))
+        self.assertEqual(err.exception.status_code, 429)
+        self.assertIn("Retry-After", err.exception.headers)
+
+
+if __name__ == '__main__':
+    unittest.main()
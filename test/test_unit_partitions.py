@@ -0,0 +1,63 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath('..'))
+
+import unittest
+from unittest.mock import MagicMock, patch
+
+from datetime import date
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session
+
+from src.database.models import Base, Contact, User
+from src.database.partitions import cluster
+
+
+class TestCluster(unittest.TestCase):
+
+    def test_only_scattered_partitions_are_clustered(self):
+        engine = MagicMock()
+        conn = engine.connect.return_value.execution_options.return_value.__enter__.return_value
+        conn.execute.return_value.scalar.return_value = "contacts_p1_pkey"
+        correlations = {"contacts_p0": 0.99, "contacts_p1": 0.2, "contacts_p2": None}
+        with patch("src.database.partitions.partitions", return_value=list(correlations)), \
+                patch("src.database.partitions.correlation", side_effect=lambda _, name: correlations[name]):
+            self.assertEqual(cluster(engine), ["contacts_p1", "contacts_p2"])
+        statements = [str(call.args[0]) for call in conn.execute.call_args_list]
+        self.assertIn("CLUSTER contacts_p1 USING contacts_p1_pkey", statements)
+        self.assertNotIn("CLUSTER contacts_p0 USING contacts_p1_pkey", statements)
+
+
+class TestContactKey(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine("sqlite://")
+        Base.metadata.create_all(self.engine)
+        self.statements = []
+        event.listen(self.engine, "before_cursor_execute",
+                     lambda conn, cursor, statement, *args: self.statements.append(statement))
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def test_flushes_address_the_partition(self):
+        with Session(self.engine) as session:
+            user = User(username="test", email="test@example.com", password="secret")
+            contact = Contact(name="Ann", birth_date=date(1990, 1, 1), user=user)
+            session.add(contact)
+            session.commit()
+            contact.name = "Anna"
+            session.flush()
+            session.delete(contact)
+            session.flush()
+        update = next(statement for statement in self.statements if statement.startswith("UPDATE contacts"))
+        delete = next(statement for statement in self.statements if statement.startswith("DELETE FROM contacts"))
+        for statement in (update, delete):
+            self.assertIn("contacts.user_id = ?", statement)
+            self.assertIn("contacts.id = ?", statement)
+
+
+if __name__ == '__main__':
+    unittest.main()
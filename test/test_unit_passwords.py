@@ -0,0 +1,67 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath('..'))
+
+import unittest
+from unittest.mock import patch
+
+from src.services import passwords
+
+CHEAP_ARGON2 = dict(memory_cost=64, time_cost=1, parallelism=1, bcrypt_rounds=4)
+
+
+class TestPasswordPolicy(unittest.TestCase):
+
+    def test_bcrypt_scheme(self):
+        context = passwords.build_context(passwords.BCRYPT, bcrypt_rounds=4)
+        self.assertTrue(context.hash("secret").startswith("$2b$04$"))
+
+    def test_argon2_needs_argon2_cffi(self):
+        with patch.object(passwords, "argon2_available", return_value=False):
+            with self.assertRaises(RuntimeError):
+                passwords.build_context(passwords.ARGON2, **CHEAP_ARGON2)
+            context = passwords.build_context(passwords.BCRYPT, bcrypt_rounds=4)
+        self.assertEqual(context.schemes(), (passwords.BCRYPT,))
+
+    def test_rehash_when_costs_change(self):
+        old = passwords.build_context(passwords.BCRYPT, bcrypt_rounds=4)
+        new = passwords.build_context(passwords.BCRYPT, bcrypt_rounds=5)
+        verified, new_hash = new.verify_and_update("secret", old.hash("secret"))
+        self.assertTrue(verified)
+        self.assertTrue(new_hash.startswith("$2b$05$"))
+        self.assertEqual(new.verify_and_update("wrong", old.hash("secret")), (False, None))
+
+    @unittest.skipUnless(passwords.argon2_available(), "argon2-cffi is not installed")
+    def test_bcrypt_hashes_move_to_argon2id(self):
+        context = passwords.build_context(passwords.ARGON2, **CHEAP_ARGON2)
+        bcrypt_hash = passwords.build_context(passwords.BCRYPT, bcrypt_rounds=4).hash("secret")
+        verified, new_hash = context.verify_and_update("secret", bcrypt_hash)
+        self.assertTrue(verified)
+        self.assertTrue(new_hash.startswith("$argon2id$v=19$m=64,t=1,p=1$"))
+        self.assertFalse(context.needs_update(new_hash))
+        self.assertTrue(passwords.build_context(passwords.ARGON2, **dict(CHEAP_ARGON2, time_cost=2)).needs_update(
+            new_hash))
+
+    @unittest.skipUnless(passwords.argon2_available(), "argon2-cffi is not installed")
+    def test_bcrypt_policy_still_verifies_argon2id(self):
+        argon2_hash = passwords.build_context(passwords.ARGON2, **CHEAP_ARGON2).hash("secret")
+        verified, new_hash = passwords.build_context(passwords.BCRYPT, bcrypt_rounds=4).verify_and_update(
+            "secret", argon2_hash)
+        self.assertTrue(verified)
+        self.assertTrue(new_hash.startswith("$2b$04$"))
+
+    def test_calibrate_picks_the_cheapest_cost_reaching_the_target(self):
+        result = passwords.calibrate(0, scheme=passwords.BCRYPT)
+        self.assertEqual(result["BCRYPT_ROUNDS"], 4)
+        result = passwords.calibrate(float("inf"), scheme=passwords.BCRYPT, max_rounds=5)
+        self.assertEqual(result["BCRYPT_ROUNDS"], 5)
+
+    @unittest.skipUnless(passwords.argon2_available(), "argon2-cffi is not installed")
+    def test_calibrate_argon2(self):
+        result = passwords.calibrate(0, memory_cost=64, parallelism=1, scheme=passwords.ARGON2)
+        self.assertEqual((result["ARGON2_MEMORY_COST"], result["ARGON2_TIME_COST"]), (64, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import os
+import sys
+import unittest
+
+import pytest
+
+sys.path.append(os.path.abspath('..'))
+
+from src.database.models import User
+from src.database.query_budget import QueryBudget, QueryBudgetExceeded, QueryCounter, query_budget, route_budget
+from main import app
+
+
+@pytest.fixture
+def users(db_session):
+    db_session.add_all([User(username=f"user{number}", email=f"user{number}@example.com", password="secret")
+                        for number in range(3)])
+    db_session.flush()
+    return db_session
+
+
+def test_counts_statements_and_rows(users):
+    with QueryCounter() as counter:
+        users.query(User).all()
+        users.query(User).filter(User.username == "user1").update({User.confirmed: True})
+    assert len(counter.statements) == 2
+    assert counter.statements[0].startswith("SELECT")
+    assert counter.rows == 4
+
+
+def test_stops_counting_on_exit(users):
+    with QueryCounter() as counter:
+        pass
+    users.query(User).all()
+    assert counter.statements == []
+
+
+def test_exceeded_budget_shows_the_sql(users):
+    with QueryCounter() as counter:
+        for number in range(3):
+            users.query(User).filter(User.email == f"user{number}@example.com").first()
+    with pytest.raises(QueryBudgetExceeded) as err:
+        QueryBudget(statements=1).check(counter, "lookup")
+    message = str(err.value)
+    assert message.startswith("lookup ran 3 statements, budget 1")
+    assert "user2@example.com" in message
+
+
+def test_rows_budget(users):
+    with QueryCounter() as counter:
+        users.query(User).all()
+    QueryBudget(statements=1, rows=3).check(counter)
+    with pytest.raises(QueryBudgetExceeded, match="3 rows, budget 2"):
+        QueryBudget(rows=2).check(counter)
+
+
+def test_fixture(users, query_budget):
+    with query_budget(statements=1):
+        users.query(User).all()
+    with pytest.raises(QueryBudgetExceeded):
+        with query_budget(statements=1):
+            users.query(User).all()
+            users.query(User).all()
+
+
+class TestRouteBudget(unittest.TestCase):
+
+    def test_decorator_keeps_the_endpoint(self):
+        def endpoint():
+            return "called"
+
+        self.assertIs(query_budget(statements=2, rows=5)(endpoint), endpoint)
+        self.assertEqual(endpoint.query_budget.statements, 2)
+        self.assertEqual(endpoint.query_budget.rows, 5)
+
+    def test_route_budget(self):
+        budget = route_budget(app, "patch", "/api/users/avatar")
+        self.assertEqual(budget.statements, 3)
+        self.assertIsNone(route_budget(app, "get", "/api/healthchecker"))
+        self.assertIsNone(route_budget(app, "get", "/missing"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,6 +7,8 @@ import collections
 
 collections.Callable = collections.abc.Callable
 import unittest
+from dataclasses import fields
+from types import SimpleNamespace
 from unittest.mock import MagicMock
 
 from sqlalchemy.orm import Session
@@ -17,15 +19,25 @@ from src.repository.contacts import (
     get_contacts,
     get_contact,
     create_contacts,
+    create_contacts_bulk,
     update_contact,
     remove_contact,
     get_birthdays,
     get_contact_by_email,
     get_contact_by_surname,
-    get_contact_by_name
+    get_contact_by_name,
+    get_contact_by_phone,
+    merge_contacts,
+    ContactRow,
+    CONTACT_ROW_BY_ID
 )
 
 
+def row(**values) -> SimpleNamespace:
+    # what Session.execute returns for the columns of a contact
+    return SimpleNamespace(_mapping={field.name: values.get(field.name) for field in fields(ContactRow)})
+
+
 class TestContact(unittest.IsolatedAsyncioTestCase):
 
     def setUp(self):
@@ -33,25 +45,24 @@ class TestContact(unittest.IsolatedAsyncioTestCase):
         self.user = User(id=1, username='test_user', password="qwerty", confirmed=True)
 
     async def test_get_contacts(self):
-        contacts = [Contact(), Contact(), Contact()]
-        mocked_contacts = MagicMock()
-        mocked_contacts.all.return_value = contacts
-        self.session.query.return_value.filter.return_value.limit.return_value.offset.return_value = mocked_contacts
+        rows = [row(id=contact_id, user_id=self.user.id) for contact_id in (1, 2, 3)]
+        self.session.execute.return_value = rows
         result = await get_contacts(10, 0, self.session, self.user)
-        self.assertEqual(result, contacts)
+        self.assertEqual(result, tuple(ContactRow(**found._mapping) for found in rows))
 
     async def test_get_contact_found(self):
         contacts_id = 1
-        contact = Contact(id=contacts_id, user_id=self.user.id)
+        found = row(id=contacts_id, user_id=self.user.id)
 
-        self.session.query.return_value.filter.return_value.filter.return_value.first.return_value = contact
+        self.session.execute.return_value.first.return_value = found
 
         result = await get_contact(contacts_id, self.session, self.user)
-        self.assertEqual(result, contact)
+        self.assertEqual(result, ContactRow(**found._mapping))
+        self.session.execute.assert_called_once_with(CONTACT_ROW_BY_ID, {"user_id": self.user.id, "contact_id": 1})
 
     async def test_get_contact_not_found(self):
         contacts_id = 1
-        self.session.query.return_value.filter.return_value.filter.return_value.first.return_value = None
+        self.session.execute.return_value.first.return_value = None
         result = await get_contact(contacts_id, self.session, self.user)
         self.assertIsNone(result)
 
@@ -67,11 +78,21 @@ class TestContact(unittest.IsolatedAsyncioTestCase):
 
         self.assertTrue(hasattr(result, "id"))
 
+    async def test_create_contacts_bulk(self):
+        bodies = [ContactModel(name=name, surname='test1', email=f'{name}@gmail.com', description="test note",
+                               phone='0970909090', birth_date=datetime(year=2024, day=2, month=3).date(),
+                               created_at=datetime.now(), updated_at=datetime.now())
+                  for name in ("first", "second")]
+        result = await create_contacts_bulk(bodies, self.session, self.user)
+        self.assertEqual([contact.name for contact in result], ["first", "second"])
+        self.session.add_all.assert_called_once()
+        self.session.commit.assert_called_once()
+
     async def test_update_contact(self):
         body = ContactModel(name="test", surname='test1', email='test@gmail.com', description="test note",
                             phone='0970909090', birth_date=datetime(year=2024, day=2, month=3).date(),
                             created_at=datetime.now(), updated_at=datetime.now())
-        self.session.query.return_value.filter.return_value.filter.return_value.first.return_value = Contact(
+        self.session.scalars.return_value.first.return_value = Contact(
             name="test", surname='test1', email='test@gmail.com', description="test note",
             phone='0970909090', birth_date=datetime(year=2024, day=2, month=3).date(), created_at=datetime.now(),
             updated_at=datetime.now())
@@ -81,7 +102,7 @@ class TestContact(unittest.IsolatedAsyncioTestCase):
         self.assertEqual(result.description, body.description)
 
     async def test_delete_contact(self):
-        self.session.query.return_value.filter.return_value.filter.return_value.first.return_value = Contact(
+        self.session.scalars.return_value.first.return_value = Contact(
             name="test", surname='test1', email='test@gmail.com',
             description="test note",
             phone='0970909090',
@@ -94,46 +115,71 @@ class TestContact(unittest.IsolatedAsyncioTestCase):
         self.assertIsInstance(result, Contact)
 
     async def test_get_birthdays(self):
-        contacts = [Contact(name="test", surname='test1', email='test@gmail.com',
-                            description="test note",
-                            phone='0970909090',
-                            birth_date=datetime.now(),
-                            created_at=datetime.now(), updated_at=datetime.now()),
-                    Contact(name="test111", surname='test22221', email='test2312@gmail.com',
-                            description="test note",
-                            phone='0970909090',
-                            birth_date=datetime.now(),
-                            created_at=datetime.now(), updated_at=datetime.now())]
-        mocked_contacts = MagicMock()
-        mocked_contacts.all.return_value = contacts
-        self.session.query.return_value.filter.return_value.filter.return_value.all.return_value = contacts
+        rows = [row(id=1, name="test", surname='test1', email='test@gmail.com', description="test note",
+                    phone='0970909090', birth_date=datetime.now().date(), user_id=self.user.id),
+                row(id=2, name="test111", surname='test22221', email='test2312@gmail.com', description="test note",
+                    phone='0970909090', birth_date=datetime.now().date(), user_id=self.user.id)]
+        self.session.execute.return_value = rows
         result = await get_birthdays(self.session, self.user)
-        self.assertEqual(result, contacts)
+        self.assertEqual(result, tuple(ContactRow(**found._mapping) for found in rows))
 
     async def test_get_contact_by_email(self):
         contacts_email = 'vasya@gmail.com'
-        contact = Contact(email=contacts_email, user_id=self.user.id)
+        found = row(email=contacts_email, email_norm=contacts_email, user_id=self.user.id)
 
-        self.session.query.return_value.filter.return_value.filter.return_value.first.return_value = contact
+        self.session.execute.return_value.first.return_value = found
 
         result = await get_contact_by_email(contacts_email, self.session, self.user)
-        self.assertEqual(result, contact)
+        self.assertEqual(result, ContactRow(**found._mapping))
+
+    async def test_get_contact_by_phone(self):
+        contact = Contact(phone='097 090 90 90', user_id=self.user.id)
+        self.assertEqual(contact.phone_norm, '+380970909090')
+        found = row(phone=contact.phone, phone_norm=contact.phone_norm, user_id=self.user.id)
+        self.session.execute.return_value.first.return_value = found
+
+        result = await get_contact_by_phone('+38 (097) 090-90-90', self.session, self.user)
+        self.assertEqual(result, ContactRow(**found._mapping))
+        self.assertEqual(self.session.execute.call_args.args[1]["phone"], '+380970909090')
+
+    async def test_get_contact_by_phone_without_digits(self):
+        result = await get_contact_by_phone('unknown', self.session, self.user)
+        self.assertIsNone(result)
+        self.session.execute.assert_not_called()
 
     async def test_get_contact_by_surname(self):
         contact_surname = 'Nechuporyk'
-        contact = Contact(surname=contact_surname, user_id=self.user.id)
-        self.session.query.return_value.filter.return_value.filter.return_value.first.return_value = contact
+        found = row(surname=contact_surname, user_id=self.user.id)
+        self.session.execute.return_value.first.return_value = found
 
         result = await get_contact_by_surname(contact_surname, self.session, self.user)
-        self.assertEqual(result, contact)
+        self.assertEqual(result, ContactRow(**found._mapping))
 
     async def test_get_contact_by_name(self):
         contact_name = 'Vladyslav'
-        contact = Contact(surname=contact_name, user_id=self.user.id)
-        self.session.query.return_value.filter.return_value.filter.return_value.first.return_value = contact
+        found = row(name=contact_name, user_id=self.user.id)
+        self.session.execute.return_value.first.return_value = found
 
         result = await get_contact_by_name(contact_name, self.session, self.user)
-        self.assertEqual(result, contact)
+        self.assertEqual(result, ContactRow(**found._mapping))
+
+    async def test_merge_contacts(self):
+        primary = Contact(id=1, name="Vlad", surname="Petrenko", email=None, phone="0970909090", user_id=1)
+        duplicate = Contact(id=2, name="Vlad", surname="Petrenko", email="vlad@gmail.com", phone=None, user_id=1)
+        query = self.session.query.return_value.filter.return_value.filter.return_value.with_for_update.return_value
+        query.all.return_value = [primary, duplicate]
+        result = await merge_contacts(1, [2], self.session, self.user)
+        self.assertEqual(result, primary)
+        self.assertEqual(result.email, "vlad@gmail.com")
+        self.session.delete.assert_called_once_with(duplicate)
+        self.session.commit.assert_called_once()
+
+    async def test_merge_contacts_not_found(self):
+        query = self.session.query.return_value.filter.return_value.filter.return_value.with_for_update.return_value
+        query.all.return_value = [Contact(id=1, user_id=1)]
+        result = await merge_contacts(1, [2], self.session, self.user)
+        self.assertIsNone(result)
+        self.session.delete.assert_not_called()
 
 
 if __name__ == '__main__':
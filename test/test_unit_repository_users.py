@@ -3,21 +3,25 @@ import sys
 
 sys.path.append(os.path.abspath('..'))
 import collections
-from libgravatar import Gravatar
 
 collections.Callable = collections.abc.Callable
 import unittest
+from types import SimpleNamespace
 from unittest.mock import MagicMock
 from src.schemas import UserModel
+from sqlalchemy import create_engine
 from sqlalchemy.orm import Session
-from src.database.models import User
+from src.database.models import Base, User
 from src.repository.users import (
+    UserRow,
+    attach_user,
+    get_authenticated_user,
     check_exist_user,
-    create_new_user,
-    token_to_db,
+    create_user_if_not_exists,
     find_user_by_email,
     confirmed_email,
-    update_avatar
+    update_avatar,
+    update_password
 )
 
 
@@ -30,47 +34,60 @@ class TestContact(unittest.IsolatedAsyncioTestCase):
     async def test_check_exist_user(self):
         email = 'vasya@gmail.com'
         user = User(id=1, email=email)
-        self.session.query.return_value.filter.return_value.first.return_value = user
+        self.session.scalars.return_value.first.return_value = user
         result = await check_exist_user(email, self.session)
         self.assertEqual(result, user)
 
-    async def test_create_new_user(self):
-        email = 'vasya@gmail.com'
+    async def test_create_user_if_not_exists(self):
+        user = User(id=1, email='vasya@gmail.com', password='dfsfsfds', username='vlad')
+        self.session.get_bind.return_value.dialect.name = 'sqlite'
+        self.session.execute.return_value.scalar_one_or_none.return_value = user
+        body = UserModel(email='vasya@gmail.com', password='dfsfsfds', username='vlad')
+        result = await create_user_if_not_exists(body, self.session)
+        self.assertEqual(result, user)
+        self.session.expunge.assert_called_once_with(user)
+        self.session.commit.assert_called_once()
 
-        avatar = None
-        try:
-            g = Gravatar(email)
-            avatar = g.get_image()
-        except Exception as err:
-            print(err)
-        user = UserModel(id=1, email=email, password='dfsfsfds', username='vlad')
-        result = await create_new_user(user, self.session)
-
-        self.assertEqual(result.username, user.username)
-        self.assertEqual(result.password, user.password)
-        self.assertEqual(result.email, user.email)
-        self.assertEqual(result.avatar, avatar)
-
-    async def test_token_to_db(self):
-        refresh_token = '12312313'
-        user = User(id=1)
-        self.session.return_value = user
-        result = await token_to_db(user, refresh_token, self.session)
-        self.assertEqual(refresh_token, result)
+    async def test_create_user_if_exists(self):
+        self.session.get_bind.return_value.dialect.name = 'postgresql'
+        self.session.execute.return_value.scalar_one_or_none.return_value = None
+        body = UserModel(email='vasya@gmail.com', password='dfsfsfds', username='vlad')
+        result = await create_user_if_not_exists(body, self.session)
+        self.assertIsNone(result)
+        self.session.expunge.assert_not_called()
 
     async def test_find_user_by_email(self):
         user_email = 'vasya@gmail.com'
         user = User(email=user_email)
 
-        self.session.query.return_value.filter.return_value.first.return_value = user
+        self.session.scalars.return_value.first.return_value = user
 
         result = await find_user_by_email(user_email, self.session)
         self.assertEqual(user, result)
 
+    async def test_get_authenticated_user(self):
+        values = dict(id=1, username='vlad', email='vasya@gmail.com', password='hash', avatar=None, confirmed=True)
+        self.session.execute.return_value.first.return_value = SimpleNamespace(_mapping=values)
+        result = await get_authenticated_user('vasya@gmail.com', self.session)
+        self.assertEqual(result, UserRow(**values))
+        self.session.execute.return_value.first.return_value = None
+        self.assertIsNone(await get_authenticated_user('nobody@gmail.com', self.session))
+
+    def test_attach_user_without_query(self):
+        engine = create_engine("sqlite://")
+        Base.metadata.create_all(engine)
+        row = UserRow(id=1, username='vlad', email='vasya@gmail.com', password='hash', avatar=None, confirmed=True)
+        with Session(engine) as db:
+            user = attach_user(row, db)
+            self.assertIn(user, db)
+            self.assertEqual((user.id, user.email), (1, 'vasya@gmail.com'))
+            self.assertFalse(db.dirty)
+        engine.dispose()
+
     async def test_confirmed_email(self):
         user_email = 'vasya@gmail.com'
         user = User(email=user_email, confirmed=False)
-        self.session.query.return_value.filter.return_value.first.return_value = user
+        self.session.scalars.return_value.first.return_value = user
         await confirmed_email(user_email, self.session)
         self.assertEqual(user.confirmed, True)
 
@@ -78,9 +95,17 @@ class TestContact(unittest.IsolatedAsyncioTestCase):
         url = 'https://upload.wikimedia.org/wikipedia/commons/thumb/b/b6/Image_created_with_a_mobile_phone.png/1280px-Image_created_with_a_mobile_phone.png'
         user_email = 'vasya@gmail.com'
         user = User(email=user_email, avatar=None)
-        self.session.query.return_value.filter.return_value.first.return_value = user
-        await update_avatar(user_email, url, self.session)
+        self.session.scalars.return_value.first.return_value = user
+        result = await update_avatar(user_email, url, self.session)
         self.assertEqual(url, user.avatar)
+        self.assertIs(result, user)
+
+
+    async def test_update_password(self):
+        user = User(email='vasya@gmail.com', password='$2b$12$old')
+        await update_password(user, '$argon2id$new', self.session)
+        self.assertEqual(user.password, '$argon2id$new')
+        self.session.commit.assert_called_once()
 
 
 if __name__ == '__main__':
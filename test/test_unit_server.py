@@ -0,0 +1,43 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath('..'))
+
+import unittest
+from unittest.mock import patch
+
+from src.conf.config import config
+from src.server import apply_pool_budget, default_workers, pool_budget
+
+
+class TestServer(unittest.TestCase):
+
+    def test_pool_budget(self):
+        self.assertEqual(pool_budget(80, 4), (15, 5))
+        self.assertEqual(pool_budget(3, 3), (1, 0))
+        pool_size, max_overflow = pool_budget(90, 7)
+        self.assertLessEqual((pool_size + max_overflow) * 7, 90)
+        with self.assertRaises(ValueError):
+            pool_budget(2, 3)
+
+    def test_default_workers_stay_within_budget(self):
+        with patch("os.cpu_count", return_value=8):
+            self.assertEqual(default_workers(100), 17)
+            self.assertEqual(default_workers(10), 5)
+            self.assertEqual(default_workers(1), 1)
+
+    def test_apply_pool_budget(self):
+        saved = {name: getattr(config, name) for name in ("DB_POOL_SIZE", "DB_MAX_OVERFLOW", "DB_POOL_WARMUP")}
+        try:
+            with patch.dict(os.environ):
+                apply_pool_budget(3, 1)
+                self.assertEqual(os.environ["DB_POOL_SIZE"], "3")
+                self.assertEqual(os.environ["DB_MAX_OVERFLOW"], "1")
+                self.assertEqual((config.DB_POOL_SIZE, config.DB_POOL_WARMUP), (3, 3))
+        finally:
+            for name, value in saved.items():
+                setattr(config, name, value)
+
+
+if __name__ == '__main__':
+    unittest.main()
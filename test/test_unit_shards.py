@@ -0,0 +1,153 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath('..'))
+
+import tempfile
+import unittest
+from datetime import date, datetime
+from pathlib import Path
+
+from sqlalchemy import create_engine, func, select
+from sqlalchemy.orm import sessionmaker
+
+from src.database.models import Base, Contact, User, UserShard
+from src.database.replicas import RoutingSession
+from src.database.shards import HashRing, ShardMoving, ShardRouter, ShardingError, create_shard_schema, \
+    misplaced_users, move_user
+from src.repository.contacts import create_contacts, get_contacts, update_contact
+from src.repository.users import create_user_if_not_exists
+from src.schemas import UserModel
+from src.schemas import ContactModel
+from src.services.birthdays import iter_digests
+
+
+def contact_body(name, birth_date=date(1990, 3, 2)):
+    return ContactModel(name=name, surname="Petrenko", email=f"{name}@example.com", phone="0970909090",
+                        description="friend", birth_date=birth_date, created_at=datetime.now(),
+                        updated_at=datetime.now())
+
+
+class TestHashRing(unittest.TestCase):
+
+    def test_adding_a_shard_moves_a_fraction_of_users(self):
+        before = HashRing(["a", "b", "c"])
+        after = HashRing(["a", "b", "c", "d"])
+        moved = sum(before.get(user_id) != after.get(user_id) for user_id in range(10000))
+        self.assertLess(moved, 4000)
+        self.assertTrue(all(after.get(user_id) == "d" for user_id in range(10000)
+                            if before.get(user_id) != after.get(user_id)))
+
+
+class TestShards(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        path = Path(self.tmp.name)
+        self.primary = create_engine(f"sqlite:///{path / 'primary.db'}")
+        Base.metadata.create_all(self.primary)
+        self.shard_engines = {name: create_engine(f"sqlite:///{path / name}.db") for name in ("a", "b")}
+        for index, engine in enumerate(self.shard_engines.values()):
+            create_shard_schema(engine, index)
+        self.router = ShardRouter(self.shard_engines, directory=self.primary, cache_ttl=0)
+        self.Session = sessionmaker(class_=RoutingSession, bind=self.primary, shards=self.router, autoflush=False)
+        with self.Session() as db:
+            db.add_all([User(id=user_id, username=f"user{user_id}", email=f"user{user_id}@example.com",
+                             password="secret", confirmed=True) for user_id in (1, 2)])
+            db.commit()
+
+    def tearDown(self):
+        for engine in [self.primary, *self.shard_engines.values()]:
+            engine.dispose()
+        self.tmp.cleanup()
+
+    def session_of(self, user_id):
+        db = self.Session()
+        db.info["user_id"] = user_id
+        return db
+
+    def count(self, shard, user_id):
+        with self.shard_engines[shard].connect() as conn:
+            return conn.execute(select(func.count()).select_from(Contact.__table__).where(
+                Contact.__table__.c.user_id == user_id)).scalar()
+
+    async def test_contacts_go_to_the_shard_of_their_owner(self):
+        user = User(id=1)
+        with self.session_of(1) as db:
+            await create_contacts(contact_body("vlad"), db, user)
+            await create_contacts(contact_body("olena"), db, user)
+        shard = self.router.shard_for(1)
+        other = "b" if shard == "a" else "a"
+        self.assertEqual((self.count(shard, 1), self.count(other, 1)), (2, 0))
+        with self.primary.connect() as conn:
+            self.assertEqual(conn.execute(select(func.count()).select_from(Contact.__table__)).scalar(), 0)
+        with self.session_of(1) as db:
+            self.assertEqual(sorted(c.name for c in await get_contacts(10, 0, db, user)), ["olena", "vlad"])
+
+    async def test_sharded_query_needs_a_user(self):
+        with self.Session() as db:
+            with self.assertRaises(ShardingError):
+                db.query(Contact).all()
+
+    async def test_move_user(self):
+        user = User(id=1)
+        with self.session_of(1) as db:
+            for name in ("vlad", "olena", "petro"):
+                await create_contacts(contact_body(name), db, user)
+        source = self.router.shard_for(1)
+        target = "b" if source == "a" else "a"
+        self.assertEqual(move_user(self.router, 1, target, batch_size=2, settle=0), 3)
+        self.assertEqual((self.count(source, 1), self.count(target, 1)), (0, 3))
+        with self.session_of(1) as db:
+            self.assertEqual(len(await get_contacts(10, 0, db, user)), 3)
+        ring_shard = self.router.ring.get(1)
+        self.assertEqual(misplaced_users(self.router), [(1, target, ring_shard)] if ring_shard != target else [])
+
+    async def test_writes_are_refused_while_moving(self):
+        user = User(id=2)
+        with self.session_of(2) as db:
+            contact = await create_contacts(contact_body("vlad"), db, user)
+            contact_id = contact.id
+        with self.primary.begin() as conn:
+            conn.execute(UserShard.__table__.update().values(moving=True))
+        with self.session_of(2) as db:
+            self.assertEqual(len(await get_contacts(10, 0, db, user)), 1)
+            with self.assertRaises(ShardMoving):
+                await update_contact(contact_id, contact_body("petro"), db, user)
+
+    def pinned(self, user_id):
+        with self.primary.connect() as conn:
+            return conn.execute(select(UserShard.shard).where(UserShard.user_id == user_id)).scalar()
+
+    async def test_reads_do_not_pin(self):
+        with self.session_of(1) as db:
+            self.assertEqual(await get_contacts(10, 0, db, User(id=1)), ())
+        self.assertIsNone(self.pinned(1))
+        with self.session_of(1) as db:
+            await create_contacts(contact_body("vlad"), db, User(id=1))
+        self.assertEqual(self.pinned(1), self.router.ring.get(1))
+
+    async def test_signup_pins_the_user(self):
+        body = UserModel(username="user3", email="user3@example.com", password="secret")
+        with self.Session() as db:
+            user = await create_user_if_not_exists(body, db)
+        self.assertEqual(self.pinned(user.id), self.router.ring.get(user.id))
+
+    def test_cache_is_bounded(self):
+        router = ShardRouter(self.shard_engines, directory=self.primary, cache_size=2)
+        for user_id in (1, 2, 1, 3):
+            router.shard_for(user_id)
+        self.assertEqual(list(router._cache), [1, 3])
+
+    async def test_birthday_digests_merge_shards(self):
+        for user_id in (1, 2):
+            with self.session_of(user_id) as db:
+                await create_contacts(contact_body(f"friend{user_id}", date(1990, 3, 3)), db, User(id=user_id))
+        with self.Session() as db:
+            digests = list(iter_digests(db, date(2026, 3, 1), 7))
+        self.assertEqual([(d["user_id"], d["email"], len(d["contacts"])) for d in digests],
+                         [(1, "user1@example.com", 1), (2, "user2@example.com", 1)])
+
+
+if __name__ == '__main__':
+    unittest.main()
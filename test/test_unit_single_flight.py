@@ -0,0 +1,94 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath('..'))
+
+import asyncio
+import threading
+import unittest
+from dataclasses import FrozenInstanceError, fields
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+
+from sqlalchemy.orm import Session
+
+from src.database.models import User
+from src.repository.contacts import ContactRow, get_contact
+from src.services.single_flight import SingleFlight, flight
+
+
+class TestSingleFlight(unittest.IsolatedAsyncioTestCase):
+
+    async def test_identical_calls_share_one_execution(self):
+        group = SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def query(value):
+            calls.append(value)
+            release.wait(5)
+            return value * 2
+
+        tasks = [asyncio.create_task(group.do("key", query, 21)) for _ in range(5)]
+        await asyncio.sleep(0.05)
+        release.set()
+        self.assertEqual(await asyncio.gather(*tasks), [42] * 5)
+        self.assertEqual(calls, [21])
+        self.assertEqual(group.stats(), {"calls": 5, "coalesced": 4, "in_flight": 0})
+
+    async def test_error_is_shared(self):
+        group = SingleFlight()
+        release = threading.Event()
+
+        def query():
+            release.wait(5)
+            raise ValueError("boom")
+
+        tasks = [asyncio.create_task(group.do("key", query)) for _ in range(2)]
+        await asyncio.sleep(0.05)
+        release.set()
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+
+    async def test_different_keys_run_separately(self):
+        group = SingleFlight()
+        self.assertEqual(await asyncio.gather(group.do("a", lambda: 1), group.do("b", lambda: 2)), [1, 2])
+        self.assertEqual(group.coalesced, 0)
+
+    async def test_write_stops_joining(self):
+        group = SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def query(value):
+            calls.append(value)
+            release.wait(5)
+            return len(calls)
+
+        before = asyncio.create_task(group.do("key", query, 1, scope="owner"))
+        await asyncio.sleep(0.05)
+        group.invalidate("owner")
+        after = asyncio.create_task(group.do("key", query, 2, scope="owner"))
+        await asyncio.sleep(0.05)
+        release.set()
+        await asyncio.gather(before, after)
+        self.assertEqual(calls, [1, 2])
+        self.assertEqual(group.stats()["in_flight"], 0)
+
+    async def test_repository_reads_are_coalesced(self):
+        session = MagicMock(spec=Session)
+        user = User(id=1, username='test_user', password="qwerty", confirmed=True)
+        session.execute.return_value.first.return_value = SimpleNamespace(
+            _mapping={field.name: None for field in fields(ContactRow)} | {"id": 1, "user_id": 1})
+        coalesced = flight.coalesced
+        results = await asyncio.gather(*(get_contact(1, session, user) for _ in range(3)))
+        self.assertEqual(len(set(results)), 1)
+        self.assertEqual(session.execute.call_count, 1)
+        self.assertEqual(flight.coalesced - coalesced, 2)
+        # shared between the requests, so it can't be changed by one of them
+        with self.assertRaises(FrozenInstanceError):
+            results[0].name = "changed"
+
+
+if __name__ == '__main__':
+    unittest.main()
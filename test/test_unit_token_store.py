@@ -0,0 +1,48 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath('..'))
+
+import unittest
+from unittest.mock import AsyncMock, MagicMock
+
+from redis.exceptions import ConnectionError as RedisConnectionError
+
+from src.services.token_store import MISSING, REUSED, ROTATED, DBTokenStore, RedisTokenStore
+
+
+class TestRedisTokenStore(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.script = AsyncMock()
+        redis = MagicMock()
+        redis.register_script.return_value = self.script
+        self.fallback = AsyncMock(spec=DBTokenStore)
+        self.store = RedisTokenStore(redis, fallback=self.fallback)
+
+    async def rotate(self):
+        return await self.store.rotate(1, "family", "jti", "new", 60, MagicMock())
+
+    async def test_rotated_and_reused_are_answered_by_redis(self):
+        self.script.return_value = ROTATED
+        self.assertTrue(await self.rotate())
+        self.script.return_value = REUSED
+        self.assertFalse(await self.rotate())
+        self.fallback.rotate.assert_not_called()
+
+    async def test_missing_family_is_rotated_by_the_fallback(self):
+        # a family issued while Redis was down is only in the fallback
+        self.script.return_value = MISSING
+        self.fallback.rotate.return_value = True
+        self.assertTrue(await self.rotate())
+        self.fallback.rotate.assert_awaited_once()
+
+    async def test_outage_goes_to_the_fallback(self):
+        self.script.side_effect = RedisConnectionError("down")
+        self.fallback.rotate.return_value = False
+        self.assertFalse(await self.rotate())
+        self.fallback.rotate.assert_awaited_once()
+
+
+if __name__ == '__main__':
+    unittest.main()
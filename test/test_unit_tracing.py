@@ -0,0 +1,141 @@
+import os
+import sys
+
+sys.path.append(os.path.abspath('..'))
+
+import json
+import tempfile
+import unittest
+from unittest.mock import AsyncMock, patch
+
+from pydantic import ValidationError
+from redis.asyncio.client import Redis
+from sqlalchemy import create_engine, text
+
+from src.conf.config import Settings
+from src.services import tracing
+
+TRACE_ID = "4bf92f3577b34da6a3ce929d0e0e4736"
+
+
+class TestTraceparent(unittest.TestCase):
+
+    def test_parse(self):
+        self.assertEqual(tracing.parse_traceparent(f"00-{TRACE_ID}-00f067aa0ba902b7-01"),
+                         (TRACE_ID, "00f067aa0ba902b7", True))
+        self.assertEqual(tracing.parse_traceparent(f"00-{TRACE_ID}-00f067aa0ba902b7-00")[2], False)
+
+    def test_invalid(self):
+        for header in [None, "", "garbage", f"ff-{TRACE_ID}-00f067aa0ba902b7-01", f"00-{'0' * 32}-00f067aa0ba902b7-01",
+                       f"00-{TRACE_ID}-{'0' * 16}-01", f"00-{TRACE_ID}-00f067aa0ba902b7-01-extra"]:
+            self.assertIsNone(tracing.parse_traceparent(header), header)
+
+    def test_future_version_may_have_more_fields(self):
+        self.assertIsNotNone(tracing.parse_traceparent(f"01-{TRACE_ID}-00f067aa0ba902b7-01-extra"))
+
+
+class TestSampling(unittest.TestCase):
+
+    def test_rate(self):
+        self.assertFalse(tracing.Tracer(sample_rate=0).start_trace("request").sampled)
+        self.assertTrue(tracing.Tracer(sample_rate=1).start_trace("request").sampled)
+        tracer = tracing.Tracer(sample_rate=0.25)
+        sampled = sum(tracer.start_trace("request").sampled for _ in range(4000))
+        self.assertAlmostEqual(sampled / 4000, 0.25, delta=0.05)
+
+    def test_follows_a_trusted_caller(self):
+        tracer = tracing.Tracer(sample_rate=0, trusted_upstreams=["10.0.0.0/8"])
+        root = tracer.start_trace("request", f"00-{TRACE_ID}-00f067aa0ba902b7-01", upstream="10.1.2.3")
+        self.assertTrue(root.sampled)
+        self.assertEqual((root.trace_id, root.parent_id), (TRACE_ID, "00f067aa0ba902b7"))
+        self.assertEqual(root.traceparent(), f"00-{TRACE_ID}-{root.span_id}-01")
+        tracer = tracing.Tracer(sample_rate=1, trusted_upstreams=["*"])
+        self.assertFalse(tracer.start_trace("request", f"00-{TRACE_ID}-00f067aa0ba902b7-00", upstream="testclient")
+                         .sampled)
+
+    def test_samples_an_untrusted_caller(self):
+        tracer = tracing.Tracer(sample_rate=0, trusted_upstreams=["10.0.0.0/8"])
+        for upstream in ("192.168.1.1", "testclient", None):
+            root = tracer.start_trace("request", f"00-{TRACE_ID}-00f067aa0ba902b7-01", upstream=upstream)
+            self.assertFalse(root.sampled)
+            # the trace is still continued
+            self.assertEqual((root.trace_id, root.parent_id), (TRACE_ID, "00f067aa0ba902b7"))
+        with self.assertRaises(ValidationError):
+            Settings(TRACING_TRUSTED_UPSTREAMS=["proxy"], _env_file=None)
+
+
+class TestSpans(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.tracer = tracing.Tracer(tracing.InMemoryExporter(), sample_rate=1)
+
+    async def test_nesting(self):
+        @tracing.traced
+        async def repository_function():
+            with tracing.span("inner"):
+                return 42
+
+        root = self.tracer.start_trace("request")
+        with tracing.activate(root):
+            self.assertEqual(await repository_function(), 42)
+        root.finish()
+        inner, outer, request = self.tracer.exporter.spans
+        self.assertTrue(outer.name.endswith("TestSpans.test_nesting.<locals>.repository_function"))
+        self.assertEqual((inner.parent_id, outer.parent_id), (outer.span_id, request.span_id))
+        self.assertEqual({span.trace_id for span in self.tracer.exporter.spans}, {root.trace_id})
+
+    def test_error(self):
+        root = self.tracer.start_trace("request")
+        with tracing.activate(root), self.assertRaises(ValueError):
+            with tracing.span("failing"):
+                raise ValueError()
+        failing = self.tracer.exporter.spans[0]
+        self.assertEqual((failing.status, failing.attributes["error"]), ("error", "ValueError"))
+
+    def test_nothing_recorded_outside_sampled_traces(self):
+        with tracing.span("orphan") as span:
+            self.assertIsNone(span)
+        tracer = tracing.Tracer(tracing.InMemoryExporter(), sample_rate=0)
+        root = tracer.start_trace("request")
+        with tracing.activate(root), tracing.span("child") as span:
+            self.assertIsNone(span)
+        root.finish()
+        self.assertEqual(len(tracer.exporter.spans), 0)
+
+    def test_sql(self):
+        tracing.instrument_sqlalchemy()
+        engine = create_engine("sqlite://")
+        root = self.tracer.start_trace("request")
+        with tracing.activate(root), engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+        sql = self.tracer.exporter.spans[0]
+        self.assertEqual((sql.name, sql.kind, sql.parent_id), ("sql SELECT", "client", root.span_id))
+        self.assertEqual(sql.attributes["db.statement"], "SELECT 1")
+
+    async def test_redis(self):
+        client = tracing.TracedRedis()
+        root = self.tracer.start_trace("request")
+        with patch.object(Redis, "execute_command", AsyncMock(return_value="value")), tracing.activate(root):
+            self.assertEqual(await client.get("key"), "value")
+        self.assertEqual(self.tracer.exporter.spans[0].name, "redis GET")
+        self.assertIsInstance(client.pipeline(), tracing.TracedPipeline)
+
+    def test_file_exporter(self):
+        with tempfile.TemporaryDirectory() as directory:
+            exporter = tracing.FileExporter(os.path.join(directory, "traces.jsonl"))
+            tracer = tracing.Tracer(exporter, sample_rate=1)
+            root = tracer.start_trace("request")
+            with tracing.activate(root), tracing.span("child"):
+                pass
+            root.finish()
+            tracer.close()
+            # spans of requests still running at shutdown are dropped
+            tracer.start_trace("late").finish()
+            with open(exporter.path) as file:
+                spans = [json.loads(line) for line in file]
+        self.assertEqual([span["name"] for span in spans], ["child", "request"])
+        self.assertEqual(spans[0]["parent_id"], spans[1]["span_id"])
+
+
+if __name__ == '__main__':
+    unittest.main()